@@ -0,0 +1,131 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from logger import logger
+from metrics import register_cache
+
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+# Cosine similarity above which two questions count as the same; BGE scores paraphrases ~0.93+
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.93"))
+
+class SemanticAnswerCache:
+    """
+    Answers keyed by question meaning rather than text. Each entry belongs to one
+    index version, so a reworded question only matches answers computed over the same
+    dataset contents. Entries expire after `ttl` seconds and the least recently used
+    one is evicted once `maxsize` entries are held.
+    """
+
+    def __init__(
+        self,
+        embed: Optional[Callable[[str], List[float]]] = None,
+        maxsize: int = ANSWER_CACHE_SIZE,
+        ttl: float = ANSWER_CACHE_TTL,
+        threshold: float = ANSWER_CACHE_THRESHOLD
+    ):
+        self._embed = embed
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.threshold = threshold
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+
+    def embed(self, question: str) -> np.ndarray:
+        """Unit-length question embedding, from the shared embedding model by default."""
+        if self._embed is None:
+            from embedding_service import get_embeddings
+            self._embed = get_embeddings().embed_query
+        vector = np.asarray(self._embed(question.strip()), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, version: str, embedding: np.ndarray) -> Optional[Dict[str, Any]]:
+        """Return the closest cached answer for this index version, if it is similar enough."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry["expires_at"] < now]
+            for key in expired:
+                del self._entries[key]
+            candidates = [key for key, entry in self._entries.items() if entry["version"] == version]
+            if candidates:
+                matrix = np.stack([self._entries[key]["embedding"] for key in candidates])
+                scores = matrix @ embedding
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    key = candidates[best]
+                    self._entries.move_to_end(key)
+                    entry = self._entries[key]
+                    self.hits += 1
+                    self.seconds_saved += entry["seconds"]
+                    return {
+                        "question": entry["question"],
+                        "answer": entry["answer"],
+                        "context": entry["context"],
+                        "similarity": float(scores[best])
+                    }
+            self.misses += 1
+            return None
+
+    def store(
+        self,
+        version: str,
+        question: str,
+        embedding: np.ndarray,
+        answer: str,
+        seconds: float,
+        context: Optional[Dict[str, Any]] = None
+    ):
+        """Remember an answer and how long it took to produce (reported as time saved on hits)."""
+        with self._lock:
+            self._entries[self._next_id] = {
+                "version": version,
+                "question": question,
+                "embedding": embedding,
+                "answer": answer,
+                "context": context,
+                "seconds": seconds,
+                "expires_at": time.monotonic() + self.ttl
+            }
+            self._next_id += 1
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, version: Optional[str] = None):
+        """Drop the answers for one index version, or all of them."""
+        with self._lock:
+            stale = [
+                key for key, entry in self._entries.items()
+                if version is None or entry["version"] == version
+            ]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            logger.info(f"Invalidated {len(stale)} cached answers for {version or 'all versions'}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "seconds_saved": round(self.seconds_saved, 3),
+                "threshold": self.threshold
+            }
+
+answer_cache = SemanticAnswerCache()
+register_cache("answers", answer_cache.stats)
@@ -0,0 +1,375 @@
+import os
+import pandas as pd
+import numpy as np
+from typing import Dict, Any, Iterable, Iterator
+from logger import logger
+from .profiler import QUANTILES, DEFAULT_BINS, DEFAULT_TOP_K, to_python
+from .ml_analyzer import analysis_from_profile
+
+# Files larger than this are analysed chunk by chunk instead of loaded whole
+CHUNKED_ANALYSIS_THRESHOLD_BYTES = int(os.getenv("CHUNKED_ANALYSIS_THRESHOLD_BYTES", str(256 * 1024 ** 2)))
+CHUNK_ROWS = int(os.getenv("CHUNKED_ANALYSIS_ROWS", "200000"))
+CHUNK_BLOCK_BYTES = int(os.getenv("CHUNKED_ANALYSIS_BLOCK_BYTES", str(4 * 1024 ** 2)))
+DISTINCT_SKETCH_SIZE = 4096
+QUANTILE_SKETCH_SIZE = 4096
+TOP_VALUES_CAPACITY = 1000
+
+class DistinctSketch:
+    """
+    K-minimum-values sketch: keeps the k smallest 64-bit hashes seen.
+    Exact below k distinct values, otherwise estimates (k - 1) / kth-smallest-hash.
+    """
+
+    def __init__(self, k: int = DISTINCT_SKETCH_SIZE):
+        self.k = k
+        self.hashes = np.empty(0, dtype=np.uint64)
+
+    def _add_hashes(self, hashes: np.ndarray):
+        if len(self.hashes) >= self.k:
+            hashes = hashes[hashes <= self.hashes[-1]]
+        self.hashes = np.unique(np.concatenate([self.hashes, hashes]))[:self.k]
+
+    def update(self, values: np.ndarray):
+        if len(values):
+            self._add_hashes(pd.util.hash_array(values))
+
+    def merge(self, other: "DistinctSketch"):
+        self._add_hashes(other.hashes)
+
+    @property
+    def saturated(self) -> bool:
+        return len(self.hashes) >= self.k
+
+    def estimate(self) -> int:
+        if not self.saturated:
+            return len(self.hashes)
+        kth = float(self.hashes[-1]) / 2.0 ** 64
+        return int(round((self.k - 1) / kth))
+
+class QuantileSketch:
+    """
+    Mergeable KLL-style quantile sketch. Each level holds at most k items; a full
+    level is sorted and every other item is promoted with twice the weight.
+    """
+
+    def __init__(self, k: int = QUANTILE_SKETCH_SIZE, seed: int = 0):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _compact(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.k:
+                items = np.sort(items)
+                # An odd item out stays behind so total weight is preserved
+                keep = items[len(items) - len(items) % 2:]
+                promoted = items[self._rng.integers(2):len(items) - len(items) % 2:2]
+                self.levels[level] = keep
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def update(self, values: np.ndarray):
+        if len(values):
+            self.levels[0] = np.concatenate([self.levels[0], values])
+            self._compact()
+
+    def merge(self, other: "QuantileSketch"):
+        for level, items in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(np.empty(0))
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self._compact()
+
+    def weighted_items(self):
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        return values, weights
+
+    def quantiles(self, qs) -> np.ndarray:
+        values, weights = self.weighted_items()
+        if not len(values):
+            return np.full(len(qs), np.nan)
+        order = np.argsort(values)
+        values, cumulative = values[order], np.cumsum(weights[order])
+        ranks = np.asarray(qs) * cumulative[-1]
+        idx = np.minimum(np.searchsorted(cumulative, ranks, side="left"), len(values) - 1)
+        return values[idx]
+
+class TopValues:
+    """
+    Bounded value counter: merges per-chunk value counts and keeps the most frequent
+    `capacity` values, so counts are exact until the capacity is exceeded.
+    """
+
+    def __init__(self, capacity: int = TOP_VALUES_CAPACITY):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype=np.int64)
+        self.truncated = False
+
+    def update(self, values: pd.Series):
+        counts = values.value_counts(dropna=True)
+        # Categorical columns also report categories absent from this chunk
+        counts = counts[counts > 0]
+        if isinstance(counts.index, pd.CategoricalIndex):
+            counts.index = counts.index.astype(object)
+        self.counts = self.counts.add(counts, fill_value=0)
+        if len(self.counts) > self.capacity:
+            self.counts = self.counts.nlargest(self.capacity)
+            self.truncated = True
+
+    def top(self, k: int):
+        return self.counts.nlargest(k)
+
+class ColumnAggregate:
+    """
+    Mergeable statistics for one column: counts, running mean/M2 (Chan et al.),
+    min/max and sketches for distinct values, quantiles and frequent values
+    """
+
+    def __init__(self):
+        self.dtype = None
+        self.null_count = 0
+        self.infinite_count = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.nan
+        self.max = np.nan
+        self.distinct = DistinctSketch()
+        self.quantiles = QuantileSketch()
+        self.top_values = TopValues()
+
+    def merge_dtype(self, dtype):
+        if self.dtype is None or self.dtype == dtype:
+            self.dtype = dtype
+        elif _is_numeric(self.dtype) and _is_numeric(dtype):
+            self.dtype = np.promote_types(self.dtype, dtype)
+        else:
+            self.dtype = np.dtype(object)
+
+    def merge_moments(self, count: int, mean: float, m2: float, lo: float, hi: float):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = np.fmin(self.min, lo)
+        self.max = np.fmax(self.max, hi)
+
+def _is_numeric(dtype) -> bool:
+    return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+
+def _iter_chunks_pyarrow(file_path: str, block_size: int) -> Iterator[pd.DataFrame]:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+
+    # Threaded readahead buffers many blocks at once; reading serially keeps memory bounded
+    read_options = pacsv.ReadOptions(block_size=block_size, use_threads=False)
+    # Empty cells are missing values in pandas, not empty strings
+    reader = pacsv.open_csv(
+        file_path,
+        read_options=read_options,
+        convert_options=pacsv.ConvertOptions(strings_can_be_null=True)
+    )
+    # pandas.read_csv leaves dates as strings; do the same so dtypes match the in-memory path
+    temporal = {
+        field.name: pa.string() for field in reader.schema
+        if pa.types.is_temporal(field.type)
+    }
+    if temporal:
+        reader = pacsv.open_csv(
+            file_path,
+            read_options=read_options,
+            convert_options=pacsv.ConvertOptions(column_types=temporal, strings_can_be_null=True)
+        )
+    for batch in reader:
+        yield batch.to_pandas()
+
+def iter_csv_chunks(
+    file_path: str,
+    engine: str = "auto",
+    chunk_rows: int = CHUNK_ROWS,
+    block_size: int = CHUNK_BLOCK_BYTES
+) -> Iterator[pd.DataFrame]:
+    """
+    Yield a CSV as DataFrame chunks, using pyarrow's streaming reader when available
+    """
+    if engine in ("auto", "pyarrow"):
+        try:
+            import pyarrow.csv  # noqa: F401
+        except ImportError:
+            if engine == "pyarrow":
+                raise
+            engine = "c"
+        else:
+            engine = "pyarrow"
+    if engine == "pyarrow":
+        yield from _iter_chunks_pyarrow(file_path, block_size)
+    else:
+        yield from pd.read_csv(file_path, chunksize=chunk_rows)
+
+def _update_aggregates(aggregates: Dict[str, ColumnAggregate], chunk: pd.DataFrame):
+    null_counts = chunk.isna().sum()
+    numeric_cols = []
+    for col, dtype in chunk.dtypes.items():
+        agg = aggregates.setdefault(col, ColumnAggregate())
+        agg.merge_dtype(dtype)
+        agg.null_count += int(null_counts[col])
+        if _is_numeric(dtype):
+            numeric_cols.append(col)
+        else:
+            values = chunk[col]
+            agg.top_values.update(values)
+            agg.distinct.update(values.dropna().to_numpy())
+
+    if not numeric_cols:
+        return
+
+    # Moments for every numeric column of the chunk in one block operation.
+    # Infinite values are counted, then left out like missing ones
+    arr = chunk[numeric_cols].to_numpy(dtype=np.float64, na_value=np.nan)
+    infinite = np.isinf(arr)
+    infinite_counts = infinite.sum(axis=0)
+    if infinite_counts.any():
+        # A new array: to_numpy may return a view of the chunk
+        arr = np.where(infinite, np.nan, arr)
+    valid = ~np.isnan(arr)
+    counts = valid.sum(axis=0)
+    with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        means = np.where(valid, arr, 0.0).sum(axis=0) / np.maximum(counts, 1)
+        m2s = np.where(valid, (arr - means) ** 2, 0.0).sum(axis=0)
+    mins = np.fmin.reduce(arr, axis=0) if len(arr) else np.full(len(numeric_cols), np.nan)
+    maxs = np.fmax.reduce(arr, axis=0) if len(arr) else np.full(len(numeric_cols), np.nan)
+
+    for i, col in enumerate(numeric_cols):
+        agg = aggregates[col]
+        agg.infinite_count += int(infinite_counts[i])
+        agg.merge_moments(int(counts[i]), means[i], m2s[i], mins[i], maxs[i])
+        values = arr[valid[:, i], i]
+        agg.distinct.update(values)
+        agg.quantiles.update(values)
+
+def _column_profile(agg: ColumnAggregate, top_k: int, bins: int) -> Dict[str, Any]:
+    stats = {
+        "dtype": str(agg.dtype),
+        "null_count": agg.null_count,
+        "distinct_count": agg.distinct.estimate(),
+        "distinct_approx": agg.distinct.saturated
+    }
+    if _is_numeric(agg.dtype):
+        values, weights = agg.quantiles.weighted_items()
+        lo, hi = agg.min, agg.max
+        if agg.count == 0:
+            edges, hist = [], [0] * bins
+        elif hi > lo:
+            with np.errstate(over="ignore"):
+                overflows = np.isinf(hi - lo)
+            if overflows:
+                # The span is past the float range, so build the edges at half scale
+                edge_array = np.linspace(lo / 2, hi / 2, bins + 1) * 2
+            else:
+                edge_array = np.linspace(lo, hi, bins + 1)
+            hist = np.histogram(values, bins=edge_array, weights=weights)[0]
+            edges, hist = edge_array.tolist(), [int(round(c)) for c in hist]
+        else:
+            edges, hist = [float(lo), float(lo)], [agg.count] + [0] * (bins - 1)
+        std = np.sqrt(agg.m2 / (agg.count - 1)) if agg.count > 1 else np.nan
+        stats.update({
+            "infinite_count": agg.infinite_count,
+            "min": to_python(lo),
+            "max": to_python(hi),
+            "mean": to_python(agg.mean) if agg.count else None,
+            "std": to_python(std),
+            "quantiles": {
+                f"{int(q * 100)}%": to_python(v)
+                for q, v in zip(QUANTILES, agg.quantiles.quantiles(QUANTILES))
+            },
+            "quantiles_approx": agg.count > agg.quantiles.k,
+            "histogram": {"bin_edges": edges, "counts": hist}
+        })
+    else:
+        stats["top_values"] = [
+            {"value": to_python(value), "count": int(count)}
+            for value, count in agg.top_values.top(top_k).items()
+        ]
+        stats["top_values_approx"] = agg.top_values.truncated
+    return stats
+
+def profile_chunks(
+    chunks: Iterable[pd.DataFrame],
+    top_k: int = DEFAULT_TOP_K,
+    bins: int = DEFAULT_BINS,
+    source: str = "dataset"
+) -> tuple:
+    """
+    Profile a stream of DataFrame chunks: each chunk is reduced to mergeable aggregates
+    and sketches. Returns the profile (same layout as profile_dataframe) and the dtypes.
+    """
+    aggregates: Dict[str, ColumnAggregate] = {}
+    n_rows = 0
+    n_chunks = 0
+    for chunk in chunks:
+        _update_aggregates(aggregates, chunk)
+        n_rows += len(chunk)
+        n_chunks += 1
+
+    logger.info(f"Profiled {source} in {n_chunks} chunks ({n_rows} rows)")
+    dtypes = pd.Series({col: agg.dtype for col, agg in aggregates.items()}, dtype=object)
+    profile = {
+        "n_rows": n_rows,
+        "n_columns": len(aggregates),
+        "sampled": False,
+        "sample_size": n_rows,
+        "error_budget": None,
+        "chunked": True,
+        "columns": {str(col): _column_profile(agg, top_k, bins) for col, agg in aggregates.items()}
+    }
+    return profile, dtypes
+
+def profile_csv_chunked(
+    file_path: str,
+    engine: str = "auto",
+    chunk_rows: int = CHUNK_ROWS,
+    block_size: int = CHUNK_BLOCK_BYTES,
+    top_k: int = DEFAULT_TOP_K,
+    bins: int = DEFAULT_BINS
+) -> tuple:
+    """
+    Profile a CSV without loading it, streaming it through profile_chunks
+    """
+    chunks = iter_csv_chunks(file_path, engine, chunk_rows, block_size)
+    return profile_chunks(chunks, top_k, bins, source=file_path)
+
+def analyze_csv_chunked(file_path: str, engine: str = "auto", **kwargs) -> Dict[str, Any]:
+    """
+    Out-of-core equivalent of analyze_dataset(pd.read_csv(file_path)).
+    Falls back to the pandas parser if pyarrow's type inference breaks on a later chunk.
+    """
+    try:
+        import pyarrow
+        arrow_errors = (pyarrow.ArrowInvalid,)
+    except ImportError:
+        arrow_errors = ()
+
+    try:
+        profile, dtypes = profile_csv_chunked(file_path, engine=engine, **kwargs)
+    except arrow_errors as e:
+        if engine == "c":
+            raise
+        logger.warning(f"pyarrow could not parse {file_path} ({e}), retrying with the pandas parser")
+        profile, dtypes = profile_csv_chunked(file_path, engine="c", **kwargs)
+    return analysis_from_profile(profile, dtypes)
+
+def analyze_chunks(chunks: Iterable[pd.DataFrame], source: str = "dataset") -> Dict[str, Any]:
+    """Out-of-core analysis of an already-parsed stream of chunks (e.g. a registered dataset)."""
+    profile, dtypes = profile_chunks(chunks, source=source)
+    return analysis_from_profile(profile, dtypes)
+
+def should_analyze_chunked(file_path: str) -> bool:
+    return os.path.getsize(file_path) > CHUNKED_ANALYSIS_THRESHOLD_BYTES
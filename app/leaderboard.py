@@ -0,0 +1,316 @@
+import os
+import math
+import time
+import threading
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Dict, List, Optional, Set
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from sklearn.base import clone
+from sklearn.preprocessing import LabelEncoder
+from sklearn.model_selection import train_test_split
+import dataset_registry
+from logger import logger
+from metrics import stage
+from .ml_analyzer import evaluate_model
+from .utils import preprocess_data, split_data
+
+# Rows drawn from the dataset (stratified by class) for training and evaluation
+LEADERBOARD_SAMPLE_ROWS = int(os.getenv("LEADERBOARD_SAMPLE_ROWS", "20000"))
+# Seconds each candidate may spend training before it is cut off
+LEADERBOARD_TIME_BUDGET = float(os.getenv("LEADERBOARD_TIME_BUDGET", "20"))
+LEADERBOARD_WORKERS = int(os.getenv("LEADERBOARD_WORKERS", str(os.cpu_count() or 1)))
+# Seconds past the budget (e.g. for evaluation) before a candidate is reported as timed out
+LEADERBOARD_TIMEOUT_SLACK = float(os.getenv("LEADERBOARD_TIMEOUT_SLACK", "10"))
+# Rows in the first training round; each further round trains on GROWTH times more
+LEADERBOARD_START_ROWS = int(os.getenv("LEADERBOARD_START_ROWS", "1000"))
+LEADERBOARD_GROWTH = 4
+TEST_SIZE = 0.2
+
+# Served by /api/models; the leaderboard trains the algorithms listed for the detected model type
+MODEL_CATALOG = [
+    {
+        "name": "Classification",
+        "algorithms": ["Random Forest", "XGBoost", "SVM", "Logistic Regression"]
+    },
+    {
+        "name": "Regression",
+        "algorithms": ["Linear Regression", "Random Forest", "XGBoost", "SVR"]
+    },
+    {
+        "name": "Clustering",
+        "algorithms": ["K-Means", "DBSCAN", "Hierarchical Clustering"]
+    }
+]
+
+# Metric each model type is ranked by, and whether higher is better
+RANKING_METRICS = {"classification": ("accuracy", True), "regression": ("rmse", False)}
+
+def candidate_algorithms(model_type: str) -> List[str]:
+    for entry in MODEL_CATALOG:
+        if entry["name"].lower() == model_type:
+            return list(entry["algorithms"])
+    return []
+
+def make_estimator(algorithm: str, model_type: str):
+    """
+    Untrained estimator for a catalog algorithm. Each uses a single core, since
+    candidates already train in parallel. XGBoost is optional; without it this
+    raises ImportError.
+    """
+    classification = model_type == "classification"
+    if algorithm == "Random Forest":
+        from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+        estimator = RandomForestClassifier if classification else RandomForestRegressor
+        return estimator(n_estimators=100, n_jobs=1, random_state=42)
+    if algorithm == "XGBoost":
+        import xgboost
+        estimator = xgboost.XGBClassifier if classification else xgboost.XGBRegressor
+        return estimator(n_estimators=200, n_jobs=1, random_state=42)
+    if algorithm == "SVM":
+        from sklearn.svm import SVC
+        return SVC()
+    if algorithm == "SVR":
+        from sklearn.svm import SVR
+        return SVR()
+    if algorithm == "Logistic Regression":
+        from sklearn.linear_model import LogisticRegression
+        return LogisticRegression(max_iter=1000)
+    if algorithm == "Linear Regression":
+        from sklearn.linear_model import LinearRegression
+        return LinearRegression()
+    raise Exception(f"No leaderboard support for {algorithm}")
+
+def train_candidate(
+    algorithm: str, model_type: str, X_train, y_train, X_test, y_test, budget: float = LEADERBOARD_TIME_BUDGET
+) -> Dict[str, Any]:
+    """
+    Train one candidate on growing prefixes of the shuffled training sample and
+    evaluate the last model trained. Each round trains on LEADERBOARD_GROWTH times
+    more rows; the next round is skipped (`cut_off`) when its fit time, extrapolated
+    from the rounds so far, would not fit in what is left of `budget`.
+    """
+    started = time.perf_counter()
+    try:
+        estimator = make_estimator(algorithm, model_type)
+    except ImportError as e:
+        return {"algorithm": algorithm, "status": "unavailable", "error": str(e)}
+
+    model, rows, fit_seconds, cut_off = None, 0, 0.0, False
+    next_rows = min(LEADERBOARD_START_ROWS, len(X_train))
+    try:
+        while True:
+            candidate = clone(estimator)
+            fit_started = time.perf_counter()
+            try:
+                candidate.fit(X_train[:next_rows], y_train[:next_rows])
+            except Exception:
+                # A larger round failing still leaves the previous model to report
+                if model is None:
+                    raise
+                break
+            previous_rows, previous_seconds = rows, fit_seconds
+            model, rows, fit_seconds = candidate, next_rows, time.perf_counter() - fit_started
+            if rows >= len(X_train):
+                break
+            next_rows = min(rows * LEADERBOARD_GROWTH, len(X_train))
+            # Fit time grows at least linearly; superlinear learners (e.g. SVMs) show it between rounds
+            exponent = 1.0
+            if previous_rows and previous_seconds > 0 and fit_seconds > 0:
+                exponent = min(max(math.log(fit_seconds / previous_seconds) / math.log(rows / previous_rows), 1.0), 3.0)
+            predicted = fit_seconds * (next_rows / rows) ** exponent
+            if time.perf_counter() - started + predicted > budget:
+                cut_off = True
+                break
+        metrics = evaluate_model(model, X_test, y_test, model_type)
+    except Exception as e:
+        return {"algorithm": algorithm, "status": "failed", "error": str(e)}
+    return {
+        "algorithm": algorithm,
+        "status": "ok",
+        "metrics": {name: float(value) for name, value in metrics.items()},
+        "train_rows": rows,
+        "fit_seconds": fit_seconds,
+        "seconds": time.perf_counter() - started,
+        "cut_off": cut_off
+    }
+
+# Pools of the leaderboards being built; each request has its own, so stopping one
+# request's overrunning candidates never touches another request's
+_pools: Set[ProcessPoolExecutor] = set()
+_pools_lock = threading.Lock()
+
+def _worker_ready() -> int:
+    return os.getpid()
+
+def _start_pool(workers: int) -> ProcessPoolExecutor:
+    # Spawned, not forked: the API process runs threads and holds model weights
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"))
+    with _pools_lock:
+        _pools.add(pool)
+    # Start the workers (and their imports) before any candidate's time limit runs
+    wait([pool.submit(_worker_ready) for _ in range(workers)])
+    return pool
+
+def _stop_pool(pool: ProcessPoolExecutor, kill: bool = False):
+    """
+    Shut a leaderboard's pool down. With `kill`, its workers are terminated too,
+    e.g. ones still training past their budget.
+    """
+    with _pools_lock:
+        _pools.discard(pool)
+    # ProcessPoolExecutor has no public way to stop a running task before Python 3.14;
+    # shutdown() forgets the worker processes, so collect them first
+    processes = list((getattr(pool, "_processes", None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    if kill:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+def shutdown_pool():
+    """Stop every leaderboard still training, e.g. when the app shuts down."""
+    with _pools_lock:
+        pools = list(_pools)
+    for pool in pools:
+        _stop_pool(pool, kill=True)
+
+def _can_stratify(y: pd.Series) -> bool:
+    counts = y.value_counts()
+    return len(counts) > 1 and counts.min() >= 2
+
+def _sample_indices(y: pd.Series, n_rows: int, model_type: str) -> np.ndarray:
+    """Row positions of an `n_rows` sample, keeping class proportions for classification."""
+    positions = np.arange(len(y))
+    labels = y.astype(str)
+    if model_type == "classification" and _can_stratify(labels):
+        try:
+            sample, _ = train_test_split(positions, train_size=n_rows, stratify=labels, random_state=42)
+            return np.sort(sample)
+        except ValueError:
+            # Classes too small for the requested split; fall back to a plain sample
+            pass
+    return np.sort(np.random.default_rng(42).choice(positions, size=n_rows, replace=False))
+
+def load_sample(
+    file_path: str, target: str, model_type: str,
+    n_rows: int = LEADERBOARD_SAMPLE_ROWS, file_hash: Optional[str] = None
+) -> pd.DataFrame:
+    """
+    Up to `n_rows` rows of a dataset. From the registered columnar copy only the target
+    column is read in full; the sampled rows are then taken from the memory map.
+    """
+    record = dataset_registry.register_csv(file_path, file_hash)
+    if record is None:
+        frame = pd.read_csv(file_path)
+        if len(frame) <= n_rows:
+            return frame
+        return frame.iloc[_sample_indices(frame[target], n_rows, model_type)].reset_index(drop=True)
+    if record["n_rows"] <= n_rows:
+        return dataset_registry.load_frame(record)
+    y = dataset_registry.load_frame(record, [target])[target]
+    indices = _sample_indices(y, n_rows, model_type)
+    return dataset_registry.open_table(record).take(pa.array(indices)).to_pandas()
+
+def prepare_training_data(frame: pd.DataFrame, analysis: Dict[str, Any]):
+    """
+    Split a sample into train and test sets (stratified for classification), fit the
+    preprocessing on the training rows only and return float32 matrices.
+    """
+    target, model_type = analysis["target"], analysis["model_type"]
+    frame = frame.dropna(subset=[target])
+    if model_type == "classification":
+        frame = frame.assign(**{target: LabelEncoder().fit_transform(frame[target].astype(str))})
+    categorical = [c for c in analysis["categorical_features"] if c != target and c in frame.columns]
+    numerical = [c for c in analysis["numerical_features"] if c != target and c in frame.columns]
+
+    stratify = model_type == "classification" and _can_stratify(frame[target])
+    X_train, X_test, y_train, y_test = split_data(frame, target, test_size=TEST_SIZE, stratify=stratify)
+    X_train, pipeline = preprocess_data(X_train, categorical, numerical, fill_missing=True)
+    X_test = pipeline.transform(X_test)
+    columns = categorical + numerical
+    return (
+        X_train[columns].to_numpy(dtype=np.float32), X_test[columns].to_numpy(dtype=np.float32),
+        y_train.to_numpy(), y_test.to_numpy()
+    )
+
+def build_leaderboard(
+    file_path: str,
+    analysis: Dict[str, Any],
+    file_hash: Optional[str] = None,
+    sample_rows: int = LEADERBOARD_SAMPLE_ROWS,
+    budget: float = LEADERBOARD_TIME_BUDGET
+) -> Dict[str, Any]:
+    """
+    Train every catalog algorithm for the dataset's model type on a shared sample,
+    in parallel across a process pool, and rank them by their held-out metrics from
+    evaluate_model. Candidates that could not run are listed after the ranked ones;
+    those still training once the budget and LEADERBOARD_TIMEOUT_SLACK have passed
+    are listed as timed out and their workers killed.
+    """
+    model_type = analysis["model_type"]
+    algorithms = candidate_algorithms(model_type)
+    if model_type not in RANKING_METRICS or not algorithms:
+        raise Exception(f"No leaderboard for {model_type} models")
+    started = time.perf_counter()
+
+    with stage("leaderboard_sample"):
+        frame = load_sample(file_path, analysis["target"], model_type, sample_rows, file_hash)
+        X_train, X_test, y_train, y_test = prepare_training_data(frame, analysis)
+
+    with stage("leaderboard_train"):
+        workers = max(1, min(LEADERBOARD_WORKERS, len(algorithms)))
+        pool = _start_pool(workers)
+        futures = [
+            pool.submit(train_candidate, algorithm, model_type, X_train, y_train, X_test, y_test, budget)
+            for algorithm in algorithms
+        ]
+        # The budget is only checked between growth rounds, so a round that overruns is cut
+        # off here; candidates beyond the worker count wait for a free worker first
+        waves = math.ceil(len(futures) / workers)
+        _, not_done = wait(futures, timeout=waves * budget + LEADERBOARD_TIMEOUT_SLACK)
+        results, broken = [], False
+        for algorithm, future in zip(algorithms, futures):
+            if future in not_done:
+                results.append({"algorithm": algorithm, "status": "timed_out", "error": f"No result within {budget:.0f}s"})
+            elif future.cancelled():
+                # The pool was stopped from outside, e.g. by shutdown_pool
+                results.append({"algorithm": algorithm, "status": "failed", "error": "Training was cancelled"})
+            elif isinstance(future.exception(), BrokenProcessPool):
+                # A worker died (e.g. out of memory), taking the pool with it
+                broken = True
+                results.append({"algorithm": algorithm, "status": "failed", "error": "The training worker exited unexpectedly"})
+            else:
+                results.append(future.result())
+        if not_done or broken:
+            logger.warning(
+                f"Killing the leaderboard workers: {len(not_done)} candidates timed out"
+                + (", a worker exited" if broken else "")
+            )
+        _stop_pool(pool, kill=bool(not_done or broken))
+
+    metric, higher_is_better = RANKING_METRICS[model_type]
+    ranked = sorted(
+        (r for r in results if r["status"] == "ok"),
+        key=lambda r: r["metrics"][metric], reverse=higher_is_better
+    )
+    for rank, result in enumerate(ranked, start=1):
+        result["rank"] = rank
+    others = [r for r in results if r["status"] != "ok"]
+    seconds = time.perf_counter() - started
+    logger.info(
+        f"Leaderboard of {len(ranked)}/{len(results)} {model_type} candidates on "
+        f"{len(X_train)} training rows in {seconds:.1f}s"
+    )
+    return {
+        "model_type": model_type,
+        "metric": metric,
+        "higher_is_better": higher_is_better,
+        "train_rows": len(X_train),
+        "test_rows": len(X_test),
+        "seconds": seconds,
+        "candidates": ranked + others
+    }
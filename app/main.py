@@ -1,11 +1,24 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, Body
+from fastapi import FastAPI, UploadFile, File, HTTPException, Body, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 import pandas as pd
+import os
 import json
-from typing import Dict, Any
-import requests
+from typing import Dict, Any, Optional
+from ollama_client import (
+    ollama_client, OllamaError, OllamaBusy, ollama_busy_handler, sse_events, SSE_HEADERS, INTERACTIVE, BULK
+)
+import dataset_registry
+from metrics import instrument_app, register_cache, stage
+from ttl_cache import TTLCache
 from .ml_analyzer import analyze_dataset, generate_model_suggestion
+from .chunked_analysis import (
+    analyze_csv_chunked, analyze_chunks, should_analyze_chunked,
+    CHUNKED_ANALYSIS_THRESHOLD_BYTES, CHUNK_ROWS
+)
 from .utils import save_uploaded_file
+from .leaderboard import MODEL_CATALOG, build_leaderboard, shutdown_pool
 
 app = FastAPI(title="DataMatic Bot API")
 
@@ -17,28 +30,86 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+instrument_app(app, "api")
+app.add_exception_handler(OllamaBusy, ollama_busy_handler)
+
+# Analyses of uploaded files, keyed by content hash
+analysis_cache = TTLCache(
+    maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "64")),
+    ttl=float(os.getenv("ANALYSIS_CACHE_TTL", "3600"))
+)
+register_cache("analyses", analysis_cache.stats)
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    await ollama_client.close()
+    shutdown_pool()
+
+def analyze_file(
+    file_path: str, error_budget: Optional[float] = None, file_hash: Optional[str] = None
+) -> Dict[str, Any]:
+    """
+    Analyze a CSV through its registered columnar copy, so repeat uploads of the same
+    file skip CSV parsing. Large datasets are analysed chunk by chunk instead of loaded whole.
+    """
+    record = dataset_registry.register_csv(file_path, file_hash)
+    if record is None:
+        with stage("analyze"):
+            if should_analyze_chunked(file_path):
+                return analyze_csv_chunked(file_path)
+            return analyze_dataset(pd.read_csv(file_path), error_budget=error_budget)
+
+    with stage("analyze"):
+        if record["source_size_bytes"] > CHUNKED_ANALYSIS_THRESHOLD_BYTES:
+            frames = dataset_registry.iter_frames(record, batch_rows=CHUNK_ROWS)
+            return analyze_chunks(frames, source=record["source"])
+        return analyze_dataset(dataset_registry.load_frame(record), error_budget=error_budget)
 
 @app.post("/api/analyze")
-async def analyze_data(file: UploadFile = File(...)) -> Dict[str, Any]:
+async def analyze_data(
+    file: UploadFile = File(...),
+    error_budget: Optional[float] = Query(None, gt=0, lt=1),
+    leaderboard: bool = Query(False)
+) -> Dict[str, Any]:
     """
-    Analyze uploaded dataset and suggest appropriate ML model
+    Analyze uploaded dataset and suggest appropriate ML model.
+    Set `error_budget` to profile a row sample sized for that error instead of every row.
+    Set `leaderboard` to train the candidate algorithms for the detected model type and
+    rank them by measured metrics instead of asking LLaMA for a suggestion.
     """
     try:
-        # Save uploaded file temporarily
-        file_path = await save_uploaded_file(file)
-        
-        # Read and analyze dataset
-        df = pd.read_csv(file_path)
-        analysis = analyze_dataset(df)
+        # Stream the upload to disk under its content hash
+        stored = await save_uploaded_file(file)
+
+        # Identical bytes analysed with the same settings give the same analysis
+        cache_key = (stored.sha256, error_budget)
+        analysis = analysis_cache.get(cache_key)
+        if analysis is None:
+            analysis = await run_in_threadpool(analyze_file, str(stored.path), error_budget, stored.sha256)
+            analysis_cache.set(cache_key, analysis)
+
+        if leaderboard:
+            board_key = (stored.sha256, "leaderboard")
+            board = analysis_cache.get(board_key)
+            if board is None:
+                board = await run_in_threadpool(build_leaderboard, str(stored.path), analysis, stored.sha256)
+                analysis_cache.set(board_key, board)
+            return {
+                "status": "success",
+                "analysis": analysis,
+                "leaderboard": board
+            }
         
         # Generate model suggestion using LLaMA
-        model_suggestion = generate_model_suggestion(analysis)
+        model_suggestion = await generate_model_suggestion(analysis)
         
         return {
             "status": "success",
             "analysis": analysis,
             "model_suggestion": model_suggestion
         }
+    except OllamaBusy:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -47,31 +118,13 @@ async def get_available_models() -> Dict[str, Any]:
     """
     Get list of available ML models
     """
-    return {
-        "models": [
-            {
-                "name": "Classification",
-                "algorithms": ["Random Forest", "XGBoost", "SVM", "Logistic Regression"]
-            },
-            {
-                "name": "Regression",
-                "algorithms": ["Linear Regression", "Random Forest", "XGBoost", "SVR"]
-            },
-            {
-                "name": "Clustering",
-                "algorithms": ["K-Means", "DBSCAN", "Hierarchical Clustering"]
-            }
-        ]
-    }
+    return {"models": MODEL_CATALOG}
 
-@app.post("/api/generate-code")
-async def generate_code(analysis: Dict[str, Any]) -> Dict[str, Any]:
+def build_code_prompt(analysis: Dict[str, Any]) -> str:
     """
-    Generate implementation code for the suggested model
+    Prompt asking LLaMA for implementation code for the suggested model
     """
-    try:
-        # Prepare prompt for LLaMA
-        prompt = f"""
+    return f"""
         Generate Python code for implementing a {analysis['model_type']} model using {analysis['algorithm']}.
         Dataset characteristics:
         - Features: {analysis['features']}
@@ -81,29 +134,55 @@ async def generate_code(analysis: Dict[str, Any]) -> Dict[str, Any]:
         
         Include necessary imports, data preprocessing, model training, and evaluation code.
         """
+
+def build_chat_prompt(message: str, analysis: dict) -> str:
+    """
+    Prompt for a chat turn about the dataset
+    """
+    return (
+        f"You are a professional machine learning assistant. Here is the dataset summary:\n"
+        f"{analysis}\n\n"
+        f"User: {message}\n"
+        f"Assistant:"
+    )
+
+@app.post("/api/generate-code")
+async def generate_code(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Generate implementation code for the suggested model
+    """
+    try:
+        # Prepare prompt for LLaMA
+        prompt = build_code_prompt(analysis)
         
         # Call LLaMA via Ollama
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "llama3.2:latest",
-                "prompt": prompt,
-                "stream": False
-            }
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=500, detail="Failed to generate code")
-        
-        generated_code = response.json()["response"]
+        generated_code = await ollama_client.generate(prompt, priority=BULK)
         
         return {
             "status": "success",
             "code": generated_code
         }
+    except OllamaBusy:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/generate-code/stream")
+async def generate_code_stream(analysis: Dict[str, Any]) -> StreamingResponse:
+    """
+    Stream implementation code for the suggested model as Server-Sent Events
+    """
+    try:
+        prompt = build_code_prompt(analysis)
+    except KeyError as e:
+        raise HTTPException(status_code=422, detail=f"Missing analysis field: {e}")
+    tokens = await ollama_client.open_stream(prompt, priority=BULK)
+    return StreamingResponse(
+        sse_events(tokens),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 @app.post("/api/chat")
 async def chat_with_llama(
     message: str = Body(...),
@@ -112,23 +191,28 @@ async def chat_with_llama(
     """
     Chat with LLaMA 3.2:latest about the dataset.
     """
-    prompt = (
-        f"You are a professional machine learning assistant. Here is the dataset summary:\n"
-        f"{analysis}\n\n"
-        f"User: {message}\n"
-        f"Assistant:"
-    )
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "model": "llama3.2:latest",
-            "prompt": prompt,
-            "stream": False
-        }
+    prompt = build_chat_prompt(message, analysis)
+    try:
+        response = await ollama_client.generate(prompt, priority=INTERACTIVE)
+    except OllamaError as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get response from LLaMA: {e}")
+    return {"response": response}
+
+@app.post("/api/chat/stream")
+async def chat_with_llama_stream(
+    message: str = Body(...),
+    analysis: dict = Body(...)
+) -> StreamingResponse:
+    """
+    Chat with LLaMA 3.2:latest about the dataset, streaming tokens as Server-Sent Events.
+    """
+    prompt = build_chat_prompt(message, analysis)
+    tokens = await ollama_client.open_stream(prompt, priority=INTERACTIVE)
+    return StreamingResponse(
+        sse_events(tokens),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
     )
-    if response.status_code != 200:
-        raise HTTPException(status_code=500, detail="Failed to get response from LLaMA")
-    return {"response": response.json()["response"]}
 
 if __name__ == "__main__":
     import uvicorn
@@ -1,51 +1,112 @@
+import os
+import json
+import copy
+import asyncio
+import hashlib
 import pandas as pd
 import numpy as np
-from typing import Dict, Any, List, Tuple
-import requests
+from typing import Dict, Any, List, Optional, Tuple
+from ollama_client import ollama_client, OllamaError, DEFAULT, BULK
+from ttl_cache import TTLCache
+from metrics import register_cache
+from .profiler import profile_dataframe, summarize_profile
 from sklearn.preprocessing import LabelEncoder
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import accuracy_score, mean_squared_error, silhouette_score
 
-def analyze_dataset(df: pd.DataFrame) -> Dict[str, Any]:
+# Suggestions depend only on the dataset schema, so repeat analyses can reuse them
+suggestion_cache = TTLCache(
+    maxsize=int(os.getenv("SUGGESTION_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("SUGGESTION_CACHE_TTL", "3600"))
+)
+register_cache("model_suggestions", suggestion_cache.stats)
+
+def analyze_dataset(
+    df: pd.DataFrame,
+    sample_rows: Optional[int] = None,
+    error_budget: Optional[float] = None
+) -> Dict[str, Any]:
+    """
+    Analyze dataset characteristics and determine the type of ML problem.
+    Column statistics come from a single vectorized profiling pass; pass
+    `sample_rows` or `error_budget` to profile a row sample of very large frames.
+    """
+    profile = profile_dataframe(df, sample_rows=sample_rows, error_budget=error_budget)
+    return analysis_from_profile(profile, df.dtypes)
+
+def analysis_from_profile(profile: Dict[str, Any], dtypes: pd.Series) -> Dict[str, Any]:
     """
-    Analyze dataset characteristics and determine the type of ML problem
+    Build the analysis dict from a column profile and the dataset's column dtypes
     """
+    columns = profile["columns"]
+    features = list(dtypes.index)
+
+    # Identify categorical and numerical features
+    is_categorical = [dtype == 'object' or dtype.name == 'category' for dtype in dtypes]
+
     analysis = {
-        "n_samples": len(df),
-        "n_features": len(df.columns),
-        "features": list(df.columns),
-        "dtypes": df.dtypes.astype(str).to_dict(),
-        "missing_values": df.isnull().sum().to_dict(),
-        "categorical_features": [],
-        "numerical_features": [],
+        "n_samples": profile["n_rows"],
+        "n_features": len(features),
+        "features": features,
+        "dtypes": dtypes.astype(str).to_dict(),
+        "missing_values": {col: columns[str(col)]["null_count"] for col in features},
+        "categorical_features": [col for col, cat in zip(features, is_categorical) if cat],
+        "numerical_features": [col for col, cat in zip(features, is_categorical) if not cat],
         "target": None,
-        "model_type": None
+        "model_type": None,
+        "profile": profile
     }
     
-    # Identify categorical and numerical features
-    for col in df.columns:
-        if df[col].dtype == 'object' or df[col].dtype.name == 'category':
-            analysis["categorical_features"].append(col)
-        else:
-            analysis["numerical_features"].append(col)
-    
     # Determine target variable (assuming last column is target)
-    analysis["target"] = df.columns[-1]
+    analysis["target"] = features[-1]
     
     # Determine model type based on target variable
-    if df[analysis["target"]].dtype == 'object' or df[analysis["target"]].dtype.name == 'category':
+    target_stats = columns[str(analysis["target"])]
+    # unique() counts a missing value as one more distinct value
+    n_unique = target_stats["distinct_count"] + (1 if target_stats["null_count"] else 0)
+    if is_categorical[-1]:
         analysis["model_type"] = "classification"
-    elif len(df[analysis["target"]].unique()) < 10:
+    elif n_unique < 10:
         analysis["model_type"] = "classification"
     else:
         analysis["model_type"] = "regression"
     
     return analysis
 
-def generate_model_suggestion(analysis: Dict[str, Any]) -> Dict[str, Any]:
+def analysis_fingerprint(analysis: Dict[str, Any], model: str) -> str:
     """
-    Generate ML model suggestion using LLaMA
+    Stable hash of the dataset schema the suggestion depends on, plus the model name
+    """
+    schema = {
+        "features": [str(f) for f in analysis["features"]],
+        "dtypes": {str(k): str(v) for k, v in analysis["dtypes"].items()},
+        "target": str(analysis["target"]),
+        "model_type": analysis["model_type"],
+        "model": model
+    }
+    return hashlib.sha256(json.dumps(schema, sort_keys=True).encode("utf-8")).hexdigest()
+
+async def _generate(prompt: str, what: str, priority: int = DEFAULT) -> str:
+    try:
+        return await ollama_client.generate(prompt, priority=priority)
+    except OllamaError as e:
+        raise Exception(f"Failed to generate {what}: {e}")
+
+async def generate_model_suggestion(analysis: Dict[str, Any]) -> Dict[str, Any]:
     """
+    Generate ML model suggestion using LLaMA.
+    The suggestion and code prompts are independent, so both run concurrently;
+    results are cached per schema fingerprint.
+    """
+    cache_key = analysis_fingerprint(analysis, ollama_client.model)
+    cached = suggestion_cache.get(cache_key)
+    if cached is not None:
+        return copy.deepcopy(cached)
+
+    column_profile = "\n".join(
+        f"      - {line}" for line in summarize_profile(analysis["profile"])
+    ) if analysis.get("profile") else "      - not available"
+
     prompt = f"""
     You are a professional machine learning expert. Based on the following dataset description, analyze it and provide a model suggestion in the following format:
 
@@ -58,25 +119,12 @@ def generate_model_suggestion(analysis: Dict[str, Any]) -> Dict[str, Any]:
     - Features: {analysis['features']}
     - Target Column: {analysis['target']}
     - Column Types: {analysis['dtypes']}
+    - Column Profile:
+{column_profile}
 
     Provide a clear and concise response following the exact format above, with the description on a new line after the model suggestion.
     """
     
-    # Call LLaMA via Ollama
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "model": "llama3.2:latest",
-            "prompt": prompt,
-            "stream": False
-        }
-    )
-    
-    if response.status_code != 200:
-        raise Exception("Failed to generate model suggestion")
-    
-    suggestion = response.json()["response"]
-    
     # Generate implementation code
     code_prompt = f"""
     Based on the previous analysis, generate complete Python code for implementing the suggested model.
@@ -94,25 +142,20 @@ def generate_model_suggestion(analysis: Dict[str, Any]) -> Dict[str, Any]:
     - Numerical features: {analysis['numerical_features']}
     """
     
-    code_response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={
-            "model": "llama3.2:latest",
-            "prompt": code_prompt,
-            "stream": False
-        }
+    # Call LLaMA via Ollama
+    suggestion, implementation_code = await asyncio.gather(
+        _generate(prompt, "model suggestion"),
+        # The code is the larger, less urgent answer; it yields to interactive requests
+        _generate(code_prompt, "implementation code", BULK)
     )
     
-    if code_response.status_code != 200:
-        raise Exception("Failed to generate implementation code")
-    
-    implementation_code = code_response.json()["response"]
-    
-    return {
+    result = {
         "suggestion": suggestion,
         "model_type": analysis["model_type"],
         "code": implementation_code
     }
+    suggestion_cache.set(cache_key, copy.deepcopy(result))
+    return result
 
 def evaluate_model(model, X_test, y_test, model_type: str) -> Dict[str, float]:
     """
@@ -0,0 +1,252 @@
+import math
+import pandas as pd
+import numpy as np
+from typing import Dict, Any, List, Optional
+
+QUANTILES = (0.25, 0.5, 0.75)
+DEFAULT_TOP_K = 5
+DEFAULT_BINS = 10
+# Failure probability used when turning an error budget into a sample size
+SAMPLING_CONFIDENCE_DELTA = 0.05
+
+def sample_size_for_error(error_budget: float, delta: float = SAMPLING_CONFIDENCE_DELTA) -> int:
+    """
+    Rows needed so sampled proportions and quantile ranks are within `error_budget`
+    of the true value with probability 1 - delta (DKW inequality)
+    """
+    return int(math.ceil(math.log(2 / delta) / (2 * error_budget ** 2)))
+
+def to_python(value: Any) -> Any:
+    """
+    Convert numpy scalars to JSON-friendly Python values, mapping NaN and ±inf to None
+    """
+    if isinstance(value, np.integer):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return float(value) if np.isfinite(value) else None
+    if isinstance(value, np.bool_):
+        return bool(value)
+    if isinstance(value, (pd.Timestamp, np.datetime64)):
+        return str(value)
+    return value
+
+def _profile_numeric_block(block: pd.DataFrame, bins: int) -> Dict[str, np.ndarray]:
+    """
+    Profile all numeric columns at once from a single sorted float matrix.
+    Infinite values are counted, then left out like missing ones
+    """
+    arr = block.to_numpy(dtype=np.float64, na_value=np.nan)
+    infinite = np.isinf(arr)
+    infinite_counts = infinite.sum(axis=0)
+    if infinite_counts.any():
+        # A new array: to_numpy may return a view of the frame
+        arr = np.where(infinite, np.nan, arr)
+    n_rows, n_cols = arr.shape
+    valid = ~np.isnan(arr)
+    counts = valid.sum(axis=0)
+
+    # One sort per column gives min, max, quantiles and distinct counts; NaNs sort last
+    ordered = np.sort(arr, axis=0)
+    last = np.maximum(counts - 1, 0)
+    cols = np.arange(n_cols)
+    has_values = counts > 0
+    mins = np.where(has_values, ordered[0, cols] if n_rows else np.nan, np.nan)
+    maxs = np.where(has_values, ordered[last, cols] if n_rows else np.nan, np.nan)
+
+    quantiles = {}
+    for q in QUANTILES:
+        pos = q * last
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, last)
+        frac = pos - lo
+        if n_rows:
+            values = ordered[lo, cols] * (1 - frac) + ordered[hi, cols] * frac
+        else:
+            values = np.full(n_cols, np.nan)
+        quantiles[q] = np.where(has_values, values, np.nan)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sums = np.where(valid, arr, 0.0).sum(axis=0)
+        means = np.where(has_values, sums / np.maximum(counts, 1), np.nan)
+        sq = np.where(valid, (arr - means) ** 2, 0.0).sum(axis=0)
+        stds = np.where(counts > 1, np.sqrt(sq / np.maximum(counts - 1, 1)), np.nan)
+
+    # Run boundaries in the sorted matrix: a new distinct value starts where it differs from the previous row
+    if n_rows:
+        in_range = np.arange(n_rows)[:, None] < counts[None, :]
+        starts = np.ones_like(ordered, dtype=bool)
+        starts[1:] = ordered[1:] != ordered[:-1]
+        ends = np.ones_like(ordered, dtype=bool)
+        ends[:-1] = ordered[1:] != ordered[:-1]
+        starts &= in_range
+        ends &= in_range
+        distinct = starts.sum(axis=0)
+        # A value seen exactly once both starts and ends a run
+        singletons = (starts & ends).sum(axis=0)
+    else:
+        distinct = np.zeros(n_cols, dtype=np.int64)
+        singletons = np.zeros(n_cols, dtype=np.int64)
+
+    # Equal-width histograms for every column via one bincount over offset bin ids
+    span = np.where(maxs > mins, maxs - mins, 1.0)
+    with np.errstate(invalid="ignore"):
+        bin_ids = np.floor((arr - np.nan_to_num(mins)) / span * bins)
+    bin_ids = np.clip(np.nan_to_num(bin_ids, nan=0), 0, bins - 1).astype(np.int64)
+    offsets = (bin_ids + cols * bins)[valid]
+    hist = np.bincount(offsets, minlength=n_cols * bins).reshape(n_cols, bins)
+
+    return {
+        "counts": counts, "infinite": infinite_counts, "min": mins, "max": maxs, "mean": means, "std": stds,
+        "quantiles": quantiles, "distinct": distinct, "singletons": singletons, "histogram": hist
+    }
+
+def _profile_other_block(block: pd.DataFrame, top_k: int) -> List[Dict[str, Any]]:
+    """
+    Value counts for all non-numeric columns with one bincount over offset codes.
+    Each column is still factorized on its own, since columns do not share values
+    """
+    n_rows, n_cols = block.shape
+    codes = np.empty((n_cols, n_rows), dtype=np.int64)
+    uniques = []
+    offsets = np.zeros(n_cols + 1, dtype=np.int64)
+    for i, col in enumerate(block.columns):
+        codes[i], values = pd.factorize(block[col])
+        uniques.append(values)
+        offsets[i + 1] = offsets[i] + len(values)
+    # Missing values have code -1 and are not counted
+    valid = codes >= 0
+    counts = np.bincount((codes + offsets[:-1, None])[valid], minlength=offsets[-1])
+
+    results = []
+    for i in range(n_cols):
+        col_counts = counts[offsets[i]:offsets[i + 1]]
+        # Most frequent first; ties keep order of first appearance
+        top = np.argsort(-col_counts, kind="stable")[:top_k]
+        results.append({
+            "distinct": len(col_counts),
+            "singletons": int((col_counts == 1).sum()),
+            "top": [(uniques[i][j], col_counts[j]) for j in top]
+        })
+    return results
+
+def _estimate_distinct(distinct: int, singletons: int, sample_size: int, population: int) -> int:
+    """
+    GEE estimator (Charikar et al.) scaling up distinct counts seen in a uniform sample
+    """
+    if sample_size >= population or sample_size == 0:
+        return int(distinct)
+    estimate = math.sqrt(population / sample_size) * singletons + (distinct - singletons)
+    return int(min(round(estimate), population))
+
+def profile_dataframe(
+    df: pd.DataFrame,
+    sample_rows: Optional[int] = None,
+    error_budget: Optional[float] = None,
+    top_k: int = DEFAULT_TOP_K,
+    bins: int = DEFAULT_BINS,
+    random_state: int = 42
+) -> Dict[str, Any]:
+    """
+    Build a per-column profile in one vectorized pass: null counts, min/max/mean/std,
+    quantiles, distinct counts, top-k values and histograms.
+
+    Numeric columns are profiled together as one matrix, over their finite values;
+    other columns get value counts (which also give top-k values) from one shared
+    bincount. If `sample_rows` or `error_budget` is set
+    and the frame is larger, statistics other than null counts are computed on a
+    uniform row sample and distinct counts are estimated.
+    """
+    n_rows = len(df)
+    if sample_rows is None and error_budget is not None:
+        sample_rows = sample_size_for_error(error_budget)
+
+    sampled = sample_rows is not None and n_rows > sample_rows
+    frame = df.sample(n=sample_rows, random_state=random_state) if sampled else df
+    sample_size = len(frame)
+    scale = n_rows / sample_size if sample_size else 1.0
+
+    # Null counts are cheap and always exact
+    null_counts = df.isna().sum()
+
+    columns: Dict[str, Dict[str, Any]] = {}
+    for col, dtype in df.dtypes.items():
+        columns[str(col)] = {
+            "dtype": str(dtype),
+            "null_count": int(null_counts[col]),
+            "distinct_approx": sampled
+        }
+
+    numeric_cols = [
+        col for col, dtype in frame.dtypes.items()
+        if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+    ]
+    if numeric_cols:
+        stats = _profile_numeric_block(frame[numeric_cols], bins)
+        for i, col in enumerate(numeric_cols):
+            lo, hi = stats["min"][i], stats["max"][i]
+            if np.isnan(lo):
+                edges = []
+            elif hi > lo:
+                # Finite values only; a span past the float range still yields None, not inf
+                edges = [to_python(edge) for edge in np.linspace(lo, hi, bins + 1)]
+            else:
+                edges = [float(lo), float(lo)]
+            columns[str(col)].update({
+                "distinct_count": _estimate_distinct(
+                    stats["distinct"][i], stats["singletons"][i], sample_size, n_rows
+                ),
+                "infinite_count": int(round(stats["infinite"][i] * scale)),
+                "min": to_python(lo),
+                "max": to_python(hi),
+                "mean": to_python(stats["mean"][i]),
+                "std": to_python(stats["std"][i]),
+                "quantiles": {
+                    f"{int(q * 100)}%": to_python(stats["quantiles"][q][i]) for q in QUANTILES
+                },
+                "histogram": {
+                    "bin_edges": edges,
+                    "counts": [int(round(c * scale)) for c in stats["histogram"][i]]
+                }
+            })
+
+    numeric_set = set(numeric_cols)
+    other_cols = [col for col in frame.columns if col not in numeric_set]
+    if other_cols:
+        for col, stats in zip(other_cols, _profile_other_block(frame[other_cols], top_k)):
+            columns[str(col)].update({
+                "distinct_count": _estimate_distinct(stats["distinct"], stats["singletons"], sample_size, n_rows),
+                "top_values": [
+                    {"value": to_python(value), "count": int(round(count * scale))}
+                    for value, count in stats["top"]
+                ]
+            })
+
+    return {
+        "n_rows": n_rows,
+        "n_columns": len(df.columns),
+        "sampled": sampled,
+        "sample_size": sample_size,
+        "error_budget": error_budget,
+        "columns": columns
+    }
+
+def summarize_profile(profile: Dict[str, Any], max_columns: int = 50) -> List[str]:
+    """
+    One compact line per column for use in LLM prompts
+    """
+    lines = []
+    for name, stats in list(profile["columns"].items())[:max_columns]:
+        parts = [f"{name} ({stats['dtype']})", f"nulls={stats['null_count']}"]
+        if "distinct_count" in stats:
+            parts.append(f"distinct={stats['distinct_count']}")
+        if stats.get("mean") is not None:
+            parts.append(
+                f"min={stats['min']:.4g} max={stats['max']:.4g} mean={stats['mean']:.4g}"
+            )
+        if stats.get("top_values"):
+            parts.append("top=" + ", ".join(str(v["value"]) for v in stats["top_values"][:3]))
+        lines.append("; ".join(parts))
+    hidden = len(profile["columns"]) - max_columns
+    if hidden > 0:
+        lines.append(f"... and {hidden} more columns")
+    return lines
@@ -1,70 +1,211 @@
 import os
+import json
+import warnings
 import tempfile
 from fastapi import UploadFile
-from typing import Optional
+from typing import Any, Dict, List, Optional
 import pandas as pd
 import numpy as np
-from sklearn.preprocessing import LabelEncoder, StandardScaler
+from sklearn.model_selection import train_test_split
+from upload_store import StoredUpload, store_upload
 
-async def save_uploaded_file(file: UploadFile) -> str:
+async def save_uploaded_file(file: UploadFile) -> StoredUpload:
     """
-    Save uploaded file to temporary directory and return the file path
+    Stream an upload into the temporary upload directory under its content hash.
+    Re-uploading the same bytes returns the stored copy with `duplicate` set.
     """
-    # Create temporary directory if it doesn't exist
-    temp_dir = os.path.join(tempfile.gettempdir(), "datamatic")
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Save file
-    file_path = os.path.join(temp_dir, file.filename)
-    with open(file_path, "wb") as buffer:
-        content = await file.read()
-        buffer.write(content)
-    
-    return file_path
+    return await store_upload(file, os.path.join(tempfile.gettempdir(), "datamatic", "uploads"))
 
-def preprocess_data(df: pd.DataFrame, categorical_features: list, numerical_features: list) -> tuple:
+def split_data(df: pd.DataFrame, target_column: str, test_size: float = 0.2, stratify: bool = False) -> tuple:
     """
-    Preprocess data for ML model training
+    Split data into training and testing sets, keeping class proportions with `stratify`
     """
-    # Handle categorical features
-    label_encoders = {}
-    for feature in categorical_features:
-        label_encoders[feature] = LabelEncoder()
-        df[feature] = label_encoders[feature].fit_transform(df[feature])
-    
-    # Handle numerical features
-    scaler = StandardScaler()
-    df[numerical_features] = scaler.fit_transform(df[numerical_features])
+    X = df.drop(columns=[target_column])
+    y = df[target_column]
     
-    return df, label_encoders, scaler
+    return train_test_split(X, y, test_size=test_size, random_state=42, stratify=y if stratify else None)
 
-def split_data(df: pd.DataFrame, target_column: str, test_size: float = 0.2) -> tuple:
+class PreprocessingPipeline:
     """
-    Split data into training and testing sets
+    Fitted cleaning and encoding for model training and scoring.
+
+    fit() learns, for all numeric columns at once, the fill values (means), IQR clipping
+    bounds and scaling parameters, plus the modes and category lists of categorical
+    columns. transform() applies them to any frame with the same columns, so large
+    batches can be scored without refitting. Categoricals become pandas category codes
+    (unseen values map to -1) and numeric outputs are downcast to float32.
+    transform() returns a new frame unless `copy=False`, in which case `df` is updated
+    in place and returned.
     """
-    X = df.drop(columns=[target_column])
-    y = df[target_column]
-    
-    return train_test_split(X, y, test_size=test_size, random_state=42)
 
-def clean_data(df: pd.DataFrame) -> pd.DataFrame:
+    def __init__(
+        self,
+        categorical_features: Optional[List[str]] = None,
+        numerical_features: Optional[List[str]] = None,
+        fill_missing: bool = True,
+        clip_outliers: bool = True,
+        iqr_factor: float = 1.5,
+        encode_categoricals: bool = True,
+        scale: bool = True,
+        downcast: bool = True
+    ):
+        self.categorical_features = categorical_features
+        self.numerical_features = numerical_features
+        self.fill_missing = fill_missing
+        self.clip_outliers = clip_outliers
+        self.iqr_factor = iqr_factor
+        self.encode_categoricals = encode_categoricals
+        self.scale = scale
+        self.downcast = downcast
+        self.params: Optional[Dict[str, Any]] = None
+
+    def _resolve_features(self, df: pd.DataFrame):
+        numerical = self.numerical_features
+        if numerical is None:
+            numerical = [
+                col for col, dtype in df.dtypes.items()
+                if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+            ]
+        categorical = self.categorical_features
+        if categorical is None:
+            categorical = [col for col in df.columns if col not in set(numerical)]
+        return list(numerical), list(categorical)
+
+    def fit(self, df: pd.DataFrame) -> "PreprocessingPipeline":
+        numerical, categorical = self._resolve_features(df)
+        params: Dict[str, Any] = {"numerical": numerical, "categorical": categorical}
+
+        # All numeric statistics come from one float matrix
+        values = df[numerical].to_numpy(dtype=np.float64, na_value=np.nan)
+        # All-missing columns produce NaN statistics, which are replaced below
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return self._fit(df, values, numerical, categorical, params)
+
+    def _fit(self, df, values, numerical, categorical, params) -> "PreprocessingPipeline":
+        means = np.nanmean(values, axis=0) if len(values) else np.full(len(numerical), np.nan)
+        means = np.nan_to_num(means)
+        if self.fill_missing:
+            values = np.where(np.isnan(values), means, values)
+        params["fill_values"] = means.tolist()
+
+        lower = np.full(len(numerical), -np.inf)
+        upper = np.full(len(numerical), np.inf)
+        if self.clip_outliers and len(values):
+            q1, q3 = np.nanquantile(values, [0.25, 0.75], axis=0)
+            iqr = q3 - q1
+            lower = np.where(np.isnan(iqr), lower, q1 - self.iqr_factor * iqr)
+            upper = np.where(np.isnan(iqr), upper, q3 + self.iqr_factor * iqr)
+            values = np.clip(values, lower, upper)
+        params["lower"] = lower.tolist()
+        params["upper"] = upper.tolist()
+
+        center = np.zeros(len(numerical))
+        scale = np.ones(len(numerical))
+        if self.scale and len(values):
+            center = np.nan_to_num(np.nanmean(values, axis=0))
+            std = np.nanstd(values, axis=0)
+            # Constant columns are centred but not scaled, as StandardScaler does
+            scale = np.where((std > 0) & ~np.isnan(std), std, 1.0)
+        params["center"] = center.tolist()
+        params["scale"] = scale.tolist()
+
+        modes = df[categorical].mode(dropna=True) if categorical else pd.DataFrame()
+        params["modes"] = {
+            col: (modes[col].iloc[0] if len(modes) and pd.notna(modes[col].iloc[0]) else None)
+            for col in categorical
+        }
+        params["categories"] = {
+            col: sorted(df[col].dropna().astype(str).unique().tolist()) for col in categorical
+        }
+        self.params = params
+        return self
+
+    def transform(self, df: pd.DataFrame, copy: bool = True) -> pd.DataFrame:
+        if self.params is None:
+            raise Exception("PreprocessingPipeline must be fitted before transform")
+        params = self.params
+        out = df.copy() if copy else df
+        numerical, categorical = params["numerical"], params["categorical"]
+
+        if numerical:
+            values = out[numerical].to_numpy(dtype=np.float64, na_value=np.nan)
+            if self.fill_missing:
+                values = np.where(np.isnan(values), np.asarray(params["fill_values"]), values)
+            if self.clip_outliers:
+                values = np.clip(values, np.asarray(params["lower"]), np.asarray(params["upper"]))
+            if self.scale:
+                values = (values - np.asarray(params["center"])) / np.asarray(params["scale"])
+            if self.downcast:
+                values = values.astype(np.float32)
+            out[numerical] = pd.DataFrame(values, index=out.index, columns=numerical)
+
+        for col in categorical:
+            series = out[col]
+            if self.fill_missing and params["modes"][col] is not None:
+                series = series.fillna(params["modes"][col])
+            if self.encode_categoricals:
+                codes = pd.Categorical(series.astype(str).where(series.notna()), categories=params["categories"][col]).codes
+                out[col] = codes if self.downcast else codes.astype(np.int64)
+            else:
+                out[col] = series
+        return out
+
+    def fit_transform(self, df: pd.DataFrame, copy: bool = True) -> pd.DataFrame:
+        return self.fit(df).transform(df, copy=copy)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "settings": {
+                "categorical_features": self.categorical_features,
+                "numerical_features": self.numerical_features,
+                "fill_missing": self.fill_missing,
+                "clip_outliers": self.clip_outliers,
+                "iqr_factor": self.iqr_factor,
+                "encode_categoricals": self.encode_categoricals,
+                "scale": self.scale,
+                "downcast": self.downcast
+            },
+            "params": self.params
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "PreprocessingPipeline":
+        pipeline = cls(**data["settings"])
+        pipeline.params = data["params"]
+        return pipeline
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, default=_json_default)
+
+    @classmethod
+    def load(cls, path: str) -> "PreprocessingPipeline":
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+def _json_default(value):
+    # Modes can be numpy scalars
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+def preprocess_data(
+    df: pd.DataFrame, categorical_features: list, numerical_features: list, fill_missing: bool = False
+) -> tuple:
+    """
+    Encode categorical features and scale numerical ones for ML model training.
+    Returns a new frame and the fitted pipeline for transforming later data.
+    With `fill_missing`, gaps are filled with the training means and modes first.
+    """
+    pipeline = PreprocessingPipeline(
+        categorical_features, numerical_features, fill_missing=fill_missing, clip_outliers=False
+    )
+    return pipeline.fit_transform(df), pipeline
+
+def clean_data(df: pd.DataFrame, inplace: bool = False) -> pd.DataFrame:
     """
     Clean dataset by handling missing values and outliers
     """
-    # Handle missing values
-    for col in df.columns:
-        if df[col].dtype in ['int64', 'float64']:
-            df[col].fillna(df[col].mean(), inplace=True)
-        else:
-            df[col].fillna(df[col].mode()[0], inplace=True)
-    
-    # Handle outliers in numerical columns
-    for col in df.select_dtypes(include=[np.number]).columns:
-        Q1 = df[col].quantile(0.25)
-        Q3 = df[col].quantile(0.75)
-        IQR = Q3 - Q1
-        lower_bound = Q1 - 1.5 * IQR
-        upper_bound = Q3 + 1.5 * IQR
-        df[col] = df[col].clip(lower_bound, upper_bound)
-    
-    return df 
\ No newline at end of file
+    pipeline = PreprocessingPipeline(encode_categoricals=False, scale=False, downcast=False)
+    return pipeline.fit_transform(df, copy=not inplace)
@@ -0,0 +1,67 @@
+"""
+Peak memory of /api/analyze's two analysis paths as the CSV grows.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_chunked_analysis --rows 100000 1000000 5000000
+
+Each measurement runs in a fresh process so peak RSS reflects only that run.
+The chunked path should stay flat while the in-memory path grows with the file.
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+
+import pandas as pd
+
+from .harness import peak_rss_mb, run_isolated
+from .synthetic import write_csv
+
+def _run(mode, path):
+    from app.ml_analyzer import analyze_dataset
+    from app.chunked_analysis import analyze_csv_chunked
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "chunked":
+        analyze_csv_chunked(path)
+    else:
+        analyze_dataset(pd.read_csv(path))
+    return {
+        "seconds": time.perf_counter() - start,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+def measure(mode, path):
+    return run_isolated(_run, mode, path)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000, 3_000_000])
+    parser.add_argument("--cols", type=int, default=20)
+    parser.add_argument("--modes", nargs="+", default=["chunked", "in_memory"])
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_rows in args.rows:
+            path = os.path.join(tmp, f"bench_{n_rows}.csv")
+            write_csv(path, n_rows, args.cols)
+            size_mb = os.path.getsize(path) / 1024 ** 2
+            for mode in args.modes:
+                result = {"mode": mode, "rows": n_rows, "cols": args.cols, "file_mb": size_mb}
+                result.update(measure(mode, path))
+                results.append(result)
+                print(json.dumps(result), flush=True)
+            os.remove(path)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
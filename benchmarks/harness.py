@@ -0,0 +1,110 @@
+"""Shared measurement helpers for the benchmarks."""
+import sys
+import time
+import queue as queue_module
+import hashlib
+import resource
+import multiprocessing as mp
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+def peak_rss_mb() -> float:
+    # On Linux ru_maxrss survives exec and would include the parent's peak; VmHWM does not
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def _call(func, args, queue):
+    try:
+        queue.put(func(*args))
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+
+# How often run_isolated checks that the measuring process is still alive
+POLL_SECONDS = 1.0
+
+def run_isolated(func: Callable[..., Dict[str, Any]], *args, timeout: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Run `func(*args)` in a fresh spawned process and return its result dict, so peak
+    memory and imports reflect only that measurement. `func` must be importable.
+    Raises if the process dies without a result (e.g. OOM-killed) or runs past `timeout`.
+    """
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_call, args=(func, args, queue))
+    proc.start()
+    started = time.monotonic()
+    try:
+        while True:
+            try:
+                result = queue.get(timeout=POLL_SECONDS)
+                break
+            except queue_module.Empty:
+                pass
+            if not proc.is_alive():
+                # The result may have been flushed just before the process exited
+                try:
+                    result = queue.get(timeout=POLL_SECONDS)
+                    break
+                except queue_module.Empty:
+                    raise Exception(f"{func.__name__} exited with code {proc.exitcode} without a result")
+            if timeout is not None and time.monotonic() - started > timeout:
+                raise Exception(f"{func.__name__} did not finish within {timeout:.0f}s")
+    except BaseException:
+        if proc.is_alive():
+            proc.kill()
+        proc.join()
+        raise
+    proc.join()
+    return result
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    """Latency percentiles in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ms = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max())
+    }
+
+class HashEmbeddings:
+    """
+    Deterministic stand-in for the BGE model so ingestion can be benchmarked offline:
+    hashed bag-of-words vectors, normalized like the real embeddings.
+    """
+
+    def __init__(self, size: int = 768):
+        self.size = size
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for token in text.lower().split():
+            digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+            vector[int.from_bytes(digest, "little") % self.size] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+def use_hash_embeddings(cache_path: str):
+    """Install HashEmbeddings as the process-wide embedding service, behind the real disk cache."""
+    import embedding_service
+    embedding_service._embeddings = embedding_service.CachedEmbeddings(
+        HashEmbeddings(), "hash-benchmark", embedding_service.EmbeddingCache(cache_path)
+    )
@@ -0,0 +1,97 @@
+"""
+Minimal stand-in for the Ollama HTTP API so the benchmarks run offline.
+
+Serves /api/generate (streaming and not) and /api/tags. Each completion waits
+`prefill_ms`, then emits `response_tokens` tokens at `tokens_per_second`, which
+makes end-to-end latencies comparable between runs without a GPU.
+
+    python -m benchmarks.ollama_stub --port 11435 --tokens-per-second 50
+"""
+import json
+import asyncio
+import argparse
+import threading
+
+from aiohttp import web
+
+class OllamaStub:
+    def __init__(self, tokens_per_second: float = 50.0, response_tokens: int = 32, prefill_ms: float = 50.0):
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.prefill_ms = prefill_ms
+        self.requests = 0
+
+    def _tokens(self, body):
+        if body.get("format") == "json":
+            # The structured-query path asks for a JSON spec; an empty object makes it fall back to RAG
+            return ["{}"]
+        return [f" token{i}" for i in range(self.response_tokens)]
+
+    async def generate(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests += 1
+        tokens = self._tokens(body)
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        await asyncio.sleep(self.prefill_ms / 1000)
+
+        # Timing fields as Ollama reports them, in nanoseconds
+        stats = {
+            "prompt_eval_duration": int(self.prefill_ms * 1e6),
+            "eval_count": len(tokens),
+            "eval_duration": int(delay * len(tokens) * 1e9)
+        }
+        if not body.get("stream", True):
+            await asyncio.sleep(delay * len(tokens))
+            return web.json_response({"model": body.get("model"), "response": "".join(tokens), "done": True, **stats})
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for token in tokens:
+            await asyncio.sleep(delay)
+            await response.write((json.dumps({"response": token, "done": False}) + "\n").encode())
+        await response.write((json.dumps({"response": "", "done": True, **stats}) + "\n").encode())
+        return response
+
+    async def tags(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": "llama3.2:latest"}]})
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/generate", self.generate)
+        app.router.add_post("/api/generate/", self.generate)
+        app.router.add_get("/api/tags", self.tags)
+        return app
+
+def start_stub(port: int, host: str = "127.0.0.1", **settings) -> OllamaStub:
+    """Serve a stub on a daemon thread of this process and return it once it is listening."""
+    stub = OllamaStub(**settings)
+    ready = threading.Event()
+
+    def serve():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(stub.make_app())
+        loop.run_until_complete(runner.setup())
+        loop.run_until_complete(web.TCPSite(runner, host, port).start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name="ollama-stub", daemon=True).start()
+    if not ready.wait(10):
+        raise Exception(f"Ollama stub did not start on port {port}")
+    return stub
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--response-tokens", type=int, default=32)
+    parser.add_argument("--prefill-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    stub = OllamaStub(args.tokens_per_second, args.response_tokens, args.prefill_ms)
+    web.run_app(stub.make_app(), host=args.host, port=args.port)
+
+if __name__ == "__main__":
+    main()
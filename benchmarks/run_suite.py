@@ -0,0 +1,349 @@
+"""
+Offline performance suite. Ollama is replaced by a local stub with a fixed token rate
+and embeddings by a deterministic hash embedder (pass --real-embeddings for BGE), so
+results are comparable between runs on the same machine.
+
+Run from the repository root, with benchmarks/requirements.txt installed:
+
+    python -m benchmarks.run_suite --rows 1000 100000 1000000 --output results.json
+
+Stages:
+  analysis   analyze_dataset and /api/analyze latency and peak memory per dataset size
+  ingest     setup_qa_chain throughput (rows/s, embeddings/s), embeddings per row, store
+             size, retrieval latency and recall, per document format (row blocks vs rows)
+             and vector store (Chroma vs the NumPy index), plus the search latency and
+             memory of a freshly opened index
+  serving    end-to-end /ollama/ask and /api/chat latency under concurrent load
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+from .harness import latency_summary, peak_rss_mb, run_isolated, use_hash_embeddings
+from .ollama_stub import start_stub
+from .synthetic import write_csv
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ("analysis", "ingest", "serving")
+
+def _questions(n):
+    # Non-aggregate questions, so the structured fast path does not short-circuit retrieval
+    topics = ["category", "target", "note", "num_0", "num_1"]
+    return [f"Describe rows where {topics[i % len(topics)]} looks unusual, case {i}" for i in range(n)]
+
+def _row_questions(path, n, seed=0):
+    """Questions naming one row's exact values, with the row each one is about."""
+    import numpy as np
+    import pandas as pd
+    frame = pd.read_csv(path, dtype=str, keep_default_na=False)
+    rows = np.random.default_rng(seed).choice(len(frame), size=min(n, len(frame)), replace=False)
+    questions = []
+    for row in rows:
+        values = " ".join(f"{column} = {value}" for column, value in frame.iloc[row].items() if column != "note")
+        questions.append((f"Which row has {values} ?", int(row)))
+    return questions
+
+def _dir_mb(path):
+    return sum(
+        os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names
+    ) / 1024 ** 2
+
+def _enter_workdir(workdir):
+    os.chdir(workdir)
+    os.environ["DATASET_REGISTRY_DIR"] = os.path.join(workdir, "dataset_store")
+    os.environ["EMBEDDING_CACHE_PATH"] = os.path.join(workdir, "embedding_cache", "embeddings.sqlite3")
+
+def _analyze_dataset(path, workdir):
+    _enter_workdir(workdir)
+    import pandas as pd
+    from app.ml_analyzer import analyze_dataset
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    analyze_dataset(pd.read_csv(path))
+    return {"seconds": time.perf_counter() - start, "baseline_rss_mb": baseline, "peak_rss_mb": peak_rss_mb()}
+
+def _analyze_endpoint(path, workdir):
+    _enter_workdir(workdir)
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    client = TestClient(app)
+    baseline = peak_rss_mb()
+    result = {"baseline_rss_mb": baseline}
+    # The first upload registers the dataset; the repeat reuses the columnar copy
+    for run in ("cold", "warm"):
+        with open(path, "rb") as f:
+            start = time.perf_counter()
+            response = client.post("/api/analyze", files={"file": (os.path.basename(path), f, "text/csv")})
+        result[f"{run}_seconds"] = time.perf_counter() - start
+        result["status"] = response.status_code
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+def _ingest(path, workdir, n_rows, real_embeddings, n_questions, document_format, vector_store):
+    _enter_workdir(workdir)
+    import embedding_service
+    if not real_embeddings:
+        use_hash_embeddings(os.environ["EMBEDDING_CACHE_PATH"])
+    embeddings = embedding_service.get_embeddings()
+    import ollama_utils
+
+    progress = {}
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    qa_chain = ollama_utils.setup_qa_chain(
+        force_reload=True, dataset_path=path, document_format=document_format, vector_store=vector_store,
+        progress=lambda **fields: progress.update(fields)
+    )
+    seconds = time.perf_counter() - start
+    embedded = embeddings.stats()["misses"]
+
+    # Recall: the row a question is about is among the documents packed into the prompt
+    latencies, hits = [], 0
+    for question, row in _row_questions(path, n_questions):
+        start = time.perf_counter()
+        docs, _ = qa_chain.retriever.assemble(question)
+        latencies.append(time.perf_counter() - start)
+        hits += any(doc.metadata["row"] <= row <= doc.metadata.get("row_end", doc.metadata["row"]) for doc in docs)
+
+    return {
+        "document_format": document_format,
+        "vector_store": vector_store,
+        "seconds": seconds,
+        "chunks": progress.get("chunks"),
+        "rows_per_second": n_rows / seconds,
+        "embeddings_per_second": embedded / seconds,
+        "embeddings_per_row": progress.get("chunks", 0) / n_rows,
+        "embedded": embedded,
+        "store_mb": _dir_mb(ollama_utils.PERSIST_DIRECTORY),
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb(),
+        "retrieval": latency_summary(latencies),
+        "recall": hits / len(latencies) if latencies else None
+    }
+
+def _search(path, workdir, real_embeddings, n_questions, vector_store):
+    """Open the index built by _ingest in a fresh process and time the candidate search alone."""
+    _enter_workdir(workdir)
+    import embedding_service
+    if not real_embeddings:
+        use_hash_embeddings(os.environ["EMBEDDING_CACHE_PATH"])
+    embeddings = embedding_service.get_embeddings()
+    import ollama_utils
+    from context_assembly import CONTEXT_FETCH_K, CONTEXT_MMR_K, CONTEXT_MMR_LAMBDA
+
+    questions = [question for question, _ in _row_questions(path, n_questions)]
+    vectors = [embeddings.embed_query(question) for question in questions]
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    collection_name = ollama_utils.collection_name_for(ollama_utils.file_sha256(Path(path)))
+    vectordb = ollama_utils.open_vector_store(collection_name, vector_store)
+    open_seconds = time.perf_counter() - start
+    latencies = []
+    for vector in vectors:
+        start = time.perf_counter()
+        vectordb.max_marginal_relevance_search_by_vector(
+            vector, k=CONTEXT_MMR_K, fetch_k=CONTEXT_FETCH_K, lambda_mult=CONTEXT_MMR_LAMBDA
+        )
+        latencies.append(time.perf_counter() - start)
+    return {
+        "vector_store": vector_store,
+        "open_seconds": open_seconds,
+        "search": latency_summary(latencies),
+        "index_rss_mb": peak_rss_mb() - baseline
+    }
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _launch(app, workdir, port, real_embeddings):
+    command = [sys.executable, "-m", "benchmarks.serve", app, "--port", str(port)]
+    if real_embeddings:
+        command.append("--real-embeddings")
+    env = {
+        **os.environ,
+        "PYTHONPATH": os.pathsep.join(filter(None, [REPO_ROOT, os.getenv("PYTHONPATH")])),
+        "DATASET_REGISTRY_DIR": os.path.join(workdir, "dataset_store"),
+        "EMBEDDING_CACHE_PATH": os.path.join(workdir, "embedding_cache", "embeddings.sqlite3"),
+        # Every request should do the full work, not hit the semantic answer cache
+        "ANSWER_CACHE_THRESHOLD": "1.01"
+    }
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def _wait_until(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise Exception(f"{url} did not become ready within {timeout}s")
+
+async def _load(url, payloads, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+    async with httpx.AsyncClient(timeout=300) as client:
+        async def one(payload):
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                    ok = response.status_code == 200
+                except httpx.HTTPError:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(payload) for payload in payloads))
+        wall = time.perf_counter() - start
+    return {**latency_summary(latencies), "errors": errors, "throughput_rps": len(latencies) / wall}
+
+def run_serving(args, workdir):
+    os.makedirs(os.path.join(workdir, "datasets"), exist_ok=True)
+    write_csv(os.path.join(workdir, "datasets", "bench.csv"), args.serve_rows, args.cols[0], args.text_width)
+    ask_port, chat_port = _free_port(), _free_port()
+    servers = [
+        _launch("ollama_api:app", workdir, ask_port, args.real_embeddings),
+        _launch("app.main:app", workdir, chat_port, args.real_embeddings)
+    ]
+    results = []
+    try:
+        _wait_until(f"http://127.0.0.1:{ask_port}/ollama/ready", args.startup_timeout)
+        _wait_until(f"http://127.0.0.1:{chat_port}/docs", args.startup_timeout)
+        analysis = {"n_rows": args.serve_rows, "columns": ["category", "target"]}
+        endpoints = {
+            "/ollama/ask": (
+                f"http://127.0.0.1:{ask_port}/ollama/ask",
+                [{"question": q} for q in _questions(args.requests)]
+            ),
+            "/api/chat": (
+                f"http://127.0.0.1:{chat_port}/api/chat",
+                [{"message": q, "analysis": analysis} for q in _questions(args.requests)]
+            )
+        }
+        for endpoint, (url, payloads) in endpoints.items():
+            for concurrency in args.concurrency:
+                result = {"stage": "serving", "endpoint": endpoint, "rows": args.serve_rows, "concurrency": concurrency}
+                result.update(asyncio.run(_load(url, payloads, concurrency)))
+                results.append(result)
+                print(json.dumps(result), flush=True)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+    return results
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--cols", type=int, nargs="+", default=[10])
+    parser.add_argument("--text-width", type=int, default=0, help="characters of free text per row")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=list(STAGES))
+    parser.add_argument("--max-ingest-rows", type=int, default=100_000,
+                        help="skip the ingest stage for larger datasets")
+    parser.add_argument("--retrieval-queries", type=int, default=20)
+    parser.add_argument("--document-formats", nargs="+", choices=("rows", "blocks"), default=["rows", "blocks"],
+                        help="how rows become documents in the ingest stage")
+    parser.add_argument("--vector-stores", nargs="+", choices=("chroma", "numpy"), default=["chroma", "numpy"],
+                        help="vector store backends compared in the ingest stage")
+    parser.add_argument("--serve-rows", type=int, default=10_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=64, help="requests per endpoint and concurrency level")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--response-tokens", type=int, default=32)
+    parser.add_argument("--prefill-ms", type=float, default=50.0)
+    parser.add_argument("--real-embeddings", action="store_true", help="use the BGE model instead of hash embeddings")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    stub_port = _free_port()
+    start_stub(
+        stub_port, tokens_per_second=args.tokens_per_second,
+        response_tokens=args.response_tokens, prefill_ms=args.prefill_ms
+    )
+    # Inherited by the measurement processes and servers
+    os.environ["OLLAMA_BASE_URL"] = f"http://127.0.0.1:{stub_port}"
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_cols in args.cols:
+            for n_rows in args.rows:
+                if not {"analysis", "ingest"} & set(args.stages):
+                    break
+                workdir = tempfile.mkdtemp(dir=tmp)
+                path = os.path.join(workdir, f"bench_{n_rows}x{n_cols}.csv")
+                write_csv(path, n_rows, n_cols, args.text_width)
+                base = {"rows": n_rows, "cols": n_cols, "text_width": args.text_width,
+                        "file_mb": os.path.getsize(path) / 1024 ** 2}
+
+                measurements = []
+                if "analysis" in args.stages:
+                    measurements.append(("analyze_dataset", run_isolated(_analyze_dataset, path, workdir)))
+                    measurements.append(("/api/analyze", run_isolated(_analyze_endpoint, path, workdir)))
+                if "ingest" in args.stages and n_rows <= args.max_ingest_rows:
+                    for document_format in args.document_formats:
+                        for vector_store in args.vector_stores:
+                            # A fresh store per combination, so each one is a full build
+                            store_dir = tempfile.mkdtemp(dir=workdir)
+                            ingest = run_isolated(
+                                _ingest, path, store_dir, n_rows, args.real_embeddings,
+                                args.retrieval_queries, document_format, vector_store
+                            )
+                            measurements.append(("setup_qa_chain", ingest))
+                            if "error" not in ingest:
+                                search = run_isolated(
+                                    _search, path, store_dir, args.real_embeddings, args.retrieval_queries, vector_store
+                                )
+                                measurements.append(("vector_search", {"document_format": document_format, **search}))
+                for target, measurement in measurements:
+                    stage = "ingest" if target in ("setup_qa_chain", "vector_search") else "analysis"
+                    result = {"stage": stage, "target": target, **base, **measurement}
+                    results.append(result)
+                    print(json.dumps(result), flush=True)
+
+        if "serving" in args.stages:
+            results.extend(run_serving(args, tempfile.mkdtemp(dir=tmp)))
+
+    report = {"environment": _environment(), "settings": vars(args), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
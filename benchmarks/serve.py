@@ -0,0 +1,27 @@
+"""
+Run one of the API apps under uvicorn for the benchmarks, with the offline hash
+embeddings installed unless --real-embeddings is given.
+
+    python -m benchmarks.serve ollama_api:app --port 8100
+"""
+import os
+import argparse
+
+import uvicorn
+
+from .harness import use_hash_embeddings
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("app", help="import string, e.g. ollama_api:app or app.main:app")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--real-embeddings", action="store_true")
+    args = parser.parse_args()
+
+    if not args.real_embeddings:
+        use_hash_embeddings(os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache/embeddings.sqlite3"))
+    uvicorn.run(args.app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
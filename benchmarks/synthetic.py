@@ -0,0 +1,25 @@
+"""Synthetic datasets for the benchmarks."""
+import numpy as np
+import pandas as pd
+
+WORDS = np.array(["alpha", "beta", "gamma", "delta", "omega", "sigma", "kappa", "theta", "lambda", "zeta"])
+
+def write_csv(path, n_rows, n_cols, text_width=0, seed=0, block_rows=500_000):
+    """
+    Write a synthetic mixed-type CSV block by block so generation itself stays small:
+    `n_cols` numeric columns, a low-cardinality category, an integer target and, if
+    `text_width` is set, a free-text column of roughly that many characters.
+    """
+    rng = np.random.default_rng(seed)
+    header = True
+    for start in range(0, n_rows, block_rows):
+        rows = min(block_rows, n_rows - start)
+        block = {f"num_{i}": rng.normal(size=rows).round(4) for i in range(n_cols)}
+        block["category"] = rng.choice(["a", "b", "c", "d"], size=rows)
+        if text_width:
+            n_words = max(1, text_width // 6)
+            words = WORDS[rng.integers(0, len(WORDS), size=(rows, n_words))]
+            block["note"] = [" ".join(row) for row in words]
+        block["target"] = rng.integers(0, 3, size=rows)
+        pd.DataFrame(block).to_csv(path, mode="w" if header else "a", header=header, index=False)
+        header = False
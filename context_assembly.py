@@ -0,0 +1,123 @@
+import os
+import math
+import threading
+from typing import Any, Dict, List, Tuple
+
+from langchain.schema import BaseRetriever, Document
+from langchain.schema.vectorstore import VectorStore
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from logger import logger
+from metrics import stage
+
+# Candidates fetched by similarity, and how many of them MMR keeps
+CONTEXT_FETCH_K = int(os.getenv("CONTEXT_FETCH_K", "200"))
+CONTEXT_MMR_K = int(os.getenv("CONTEXT_MMR_K", "100"))
+# 1 = pure relevance, 0 = maximal diversity
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.5"))
+# Tokens left free for the model's answer
+ANSWER_TOKEN_RESERVE = int(os.getenv("ANSWER_TOKEN_RESERVE", "512"))
+# Rough tokenizer: CSV rows are dense in numbers and punctuation, so err on the high side
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "3"))
+# Optional cross-encoder (sentence-transformers) used to rerank candidates; empty disables it
+CONTEXT_RERANK_MODEL = os.getenv("CONTEXT_RERANK_MODEL", "")
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate, good enough for budgeting without the model's tokenizer."""
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+def pack_documents(
+    docs: List[Document],
+    budget: int,
+    separator_tokens: int = 1
+) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    Greedily take documents in rank order while they fit in `budget` tokens.
+    A document that does not fit is skipped, but smaller later ones can still be packed.
+    """
+    packed = []
+    used = 0
+    dropped_tokens = 0
+    for doc in docs:
+        cost = estimate_tokens(doc.page_content) + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(doc)
+            used += cost
+        else:
+            dropped_tokens += cost
+    return packed, {
+        "budget_tokens": budget,
+        "packed_docs": len(packed),
+        "packed_tokens": used,
+        "dropped_docs": len(docs) - len(packed),
+        "dropped_tokens": dropped_tokens
+    }
+
+_reranker = None
+_reranker_lock = threading.Lock()
+
+def get_reranker():
+    """Load the configured cross-encoder once, or return None if reranking is off."""
+    global _reranker
+    if not CONTEXT_RERANK_MODEL:
+        return None
+    with _reranker_lock:
+        if _reranker is None:
+            from sentence_transformers import CrossEncoder
+            _reranker = CrossEncoder(CONTEXT_RERANK_MODEL, device="cpu")
+            logger.info(f"Loaded rerank model {CONTEXT_RERANK_MODEL}")
+        return _reranker
+
+def rerank_documents(question: str, docs: List[Document]) -> List[Document]:
+    reranker = get_reranker()
+    if reranker is None or not docs:
+        return docs
+    scores = reranker.predict([(question, doc.page_content) for doc in docs])
+    order = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+    return [docs[i] for i in order]
+
+class PackedContextRetriever(BaseRetriever):
+    """
+    Retriever that assembles a context sized for the prompt instead of returning a
+    fixed k: fetch candidates, drop near-duplicates with MMR, optionally rerank, then
+    pack as many chunks as fit in `token_budget` (minus the question itself).
+    """
+
+    vectorstore: VectorStore
+    token_budget: int
+    fetch_k: int = CONTEXT_FETCH_K
+    mmr_k: int = CONTEXT_MMR_K
+    lambda_mult: float = CONTEXT_MMR_LAMBDA
+    rerank: bool = True
+    # Identifies the indexed dataset contents, e.g. for caching answers per version
+    index_version: str = ""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def assemble(self, question: str) -> Tuple[List[Document], Dict[str, Any]]:
+        """Return the packed documents and how many tokens were packed and dropped."""
+        with stage("retrieve"):
+            candidates = self.vectorstore.max_marginal_relevance_search(
+                question, k=self.mmr_k, fetch_k=self.fetch_k, lambda_mult=self.lambda_mult
+            )
+        if self.rerank and get_reranker() is not None:
+            with stage("rerank"):
+                candidates = rerank_documents(question, candidates)
+        budget = max(self.token_budget - estimate_tokens(question), 0)
+        with stage("pack_context"):
+            docs, stats = pack_documents(candidates, budget)
+        stats["candidates"] = len(candidates)
+        logger.info(
+            f"Packed {stats['packed_docs']}/{len(candidates)} chunks "
+            f"({stats['packed_tokens']}/{budget} tokens, {stats['dropped_tokens']} dropped)"
+        )
+        return docs, stats
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return self.assemble(query)[0]
+
+def context_token_budget(num_ctx: int, prompt_template: str, reserve: int = ANSWER_TOKEN_RESERVE) -> int:
+    """Tokens available for retrieved chunks once the template and answer are accounted for."""
+    return max(num_ctx - reserve - estimate_tokens(prompt_template), 0)
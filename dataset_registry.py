@@ -0,0 +1,260 @@
+import os
+import json
+import uuid
+import hashlib
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from logger import logger
+from metrics import stage
+from ttl_cache import TTLCache
+
+# Columnar copies of uploaded CSVs, keyed by the CSV's content hash
+REGISTRY_DIR = Path(os.getenv("DATASET_REGISTRY_DIR", "dataset_store"))
+CSV_BLOCK_BYTES = int(os.getenv("DATASET_REGISTRY_BLOCK_BYTES", str(4 * 1024 ** 2)))
+# String columns with at most this share of distinct values are dictionary-encoded
+DICTIONARY_MAX_DISTINCT_RATIO = 0.5
+
+_INT_TYPES = [pa.int8(), pa.int16(), pa.int32(), pa.int64()]
+
+# File hashes keyed by (path, size, mtime), so an unchanged file is only read once
+_hashes = TTLCache(maxsize=1024, ttl=86400)
+
+# One conversion per dataset id at a time in this process; other processes write
+# their own scratch files and the last atomic rename wins with identical content
+_register_locks: Dict[str, threading.Lock] = {}
+_register_locks_lock = threading.Lock()
+
+def _register_lock(dataset_id: str) -> threading.Lock:
+    with _register_locks_lock:
+        return _register_locks.setdefault(dataset_id, threading.Lock())
+
+def _hash_key(path) -> tuple:
+    stat = os.stat(path)
+    return str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns
+
+def file_sha256(path, block_size=1 << 20) -> str:
+    """Hash a file's bytes without reading it into memory at once."""
+    key = _hash_key(path)
+    cached = _hashes.get(key)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    _hashes.set(key, digest.hexdigest())
+    return digest.hexdigest()
+
+def remember_sha256(path, sha256: str):
+    """Record a hash computed while the file was written (e.g. during an upload)."""
+    _hashes.set(_hash_key(path), sha256)
+
+def _record_path(dataset_id: str) -> Path:
+    return REGISTRY_DIR / f"{dataset_id}.json"
+
+def _data_path(dataset_id: str) -> Path:
+    return REGISTRY_DIR / f"{dataset_id}.arrow"
+
+def get_record(dataset_id: str) -> Optional[Dict[str, Any]]:
+    """Return the registry record for a dataset id, or None if it is not registered."""
+    path = _record_path(dataset_id)
+    if not path.exists() or not _data_path(dataset_id).exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def _open_csv(csv_path, column_types=None):
+    # Serial reading keeps memory to a few blocks regardless of file size
+    return pacsv.open_csv(
+        str(csv_path),
+        read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_BYTES, use_threads=False),
+        # Empty cells are missing values in pandas, not empty strings
+        convert_options=pacsv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True)
+    )
+
+def _narrowest_int(lo, hi) -> pa.DataType:
+    # Signed types only, so pandas dtypes stay familiar (int8/16/32/64)
+    for dtype in _INT_TYPES:
+        bits = dtype.bit_width
+        if -(2 ** (bits - 1)) <= lo and hi < 2 ** (bits - 1):
+            return dtype
+    return pa.int64()
+
+def _plan_column(column: pa.ChunkedArray, n_rows: int) -> Dict[str, Any]:
+    """Pick the compact storage type for one column and collect its stats."""
+    dtype = column.type
+    stats: Dict[str, Any] = {"null_count": column.null_count}
+    target = dtype
+    dictionary = None
+
+    if pa.types.is_integer(dtype) and column.null_count < n_rows:
+        lo, hi = pc.min_max(column).values()
+        lo, hi = lo.as_py(), hi.as_py()
+        stats.update({"min": lo, "max": hi})
+        target = _narrowest_int(lo, hi)
+    elif pa.types.is_floating(dtype) and column.null_count < n_rows:
+        lo, hi = pc.min_max(column).values()
+        stats.update({"min": lo.as_py(), "max": hi.as_py()})
+        # Downcast only when every value round-trips through float32 unchanged
+        narrowed = pc.cast(pc.cast(column, pa.float32(), safe=False), pa.float64())
+        if pc.all(pc.or_kleene(pc.equal(narrowed, column), pc.is_nan(column))).as_py():
+            target = pa.float32()
+    elif pa.types.is_string(dtype) or pa.types.is_large_string(dtype):
+        distinct = pc.unique(column)
+        stats["distinct_count"] = len(distinct) - (1 if column.null_count else 0)
+        if n_rows and len(distinct) <= DICTIONARY_MAX_DISTINCT_RATIO * n_rows:
+            dictionary = pc.drop_null(distinct)
+            target = pa.dictionary(pa.int32(), dtype)
+    return {"type": target, "dictionary": dictionary, "stats": stats}
+
+def _convert_batch(batch: pa.RecordBatch, plans: Dict[str, Dict[str, Any]], schema: pa.Schema) -> pa.RecordBatch:
+    arrays = []
+    for name, field in zip(batch.schema.names, schema):
+        column = batch.column(name)
+        plan = plans[name]
+        if plan["dictionary"] is not None:
+            indices = pc.index_in(column, value_set=plan["dictionary"]).cast(pa.int32())
+            arrays.append(pa.DictionaryArray.from_arrays(indices, plan["dictionary"]))
+        elif column.type != field.type:
+            arrays.append(pc.cast(column, field.type))
+        else:
+            arrays.append(column)
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def register_csv(csv_path, file_hash: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Register a CSV: parse it once into a compact, memory-mappable Arrow IPC file and
+    record its schema and column stats. Returns the record, or None if the file cannot
+    be converted (callers then fall back to reading the CSV).
+
+    Byte-identical files share one entry, so re-registering is just a hash lookup.
+    """
+    csv_path = Path(csv_path)
+    dataset_id = file_hash or file_sha256(csv_path)
+    record = get_record(dataset_id)
+    if record is not None:
+        return record
+    with _register_lock(dataset_id):
+        # Another thread may have registered it while this one waited
+        record = get_record(dataset_id)
+        if record is not None:
+            return record
+        return _convert_csv(csv_path, dataset_id)
+
+def _convert_csv(csv_path: Path, dataset_id: str) -> Optional[Dict[str, Any]]:
+    REGISTRY_DIR.mkdir(parents=True, exist_ok=True)
+    # Scratch files are private to this call, so concurrent conversions never share one
+    scratch = f"{os.getpid()}.{uuid.uuid4().hex[:8]}"
+    raw_path = REGISTRY_DIR / f"{dataset_id}.{scratch}.raw.arrow"
+    tmp_path = REGISTRY_DIR / f"{dataset_id}.{scratch}.arrow.tmp"
+    try:
+        # Pass 1: stream-parse the CSV into an uncompressed Arrow file.
+        # pandas.read_csv leaves dates as strings, so do the same here.
+        with stage("csv_parse"):
+            reader = _open_csv(csv_path)
+            temporal = {f.name: pa.string() for f in reader.schema if pa.types.is_temporal(f.type)}
+            if temporal:
+                reader = _open_csv(csv_path, temporal)
+            with pa.OSFile(str(raw_path), "wb") as sink:
+                with pa.ipc.new_file(sink, reader.schema) as writer:
+                    for batch in reader:
+                        writer.write_batch(batch)
+
+        # Pass 2: compute stats on the memory-mapped copy and rewrite with compact types
+        with stage("columnar_compact"), pa.memory_map(str(raw_path), "r") as source:
+            raw = pa.ipc.open_file(source).read_all()
+            n_rows = raw.num_rows
+            plans = {name: _plan_column(raw.column(name), n_rows) for name in raw.schema.names}
+            schema = pa.schema([pa.field(name, plans[name]["type"]) for name in raw.schema.names])
+            with pa.OSFile(str(tmp_path), "wb") as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    for batch in raw.to_batches():
+                        writer.write_batch(_convert_batch(batch, plans, schema))
+            source_types = {field.name: str(field.type) for field in raw.schema}
+            del raw
+        os.replace(tmp_path, _data_path(dataset_id))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        logger.warning(f"Could not convert {csv_path.name} to Arrow, using the CSV directly: {e}")
+        return None
+    finally:
+        for path in (raw_path, tmp_path):
+            if path.exists():
+                path.unlink()
+
+    record = {
+        "id": dataset_id,
+        "source": csv_path.name,
+        "path": str(_data_path(dataset_id)),
+        "n_rows": n_rows,
+        "size_bytes": os.path.getsize(_data_path(dataset_id)),
+        "source_size_bytes": os.path.getsize(csv_path),
+        "created": datetime.now().isoformat(),
+        "columns": [
+            {
+                "name": name,
+                "source_type": source_types[name],
+                "type": str(plans[name]["type"]),
+                **plans[name]["stats"]
+            }
+            for name in schema.names
+        ]
+    }
+    tmp_record = _record_path(dataset_id).with_suffix(f".json.{scratch}.tmp")
+    with open(tmp_record, "w", encoding="utf-8") as f:
+        json.dump(record, f, default=str)
+    os.replace(tmp_record, _record_path(dataset_id))
+    logger.info(
+        f"Registered {csv_path.name} as {dataset_id[:12]}: {n_rows} rows, "
+        f"{record['source_size_bytes']} -> {record['size_bytes']} bytes"
+    )
+    return record
+
+def open_source_text(csv_path, record: Dict[str, Any]) -> pacsv.CSVStreamingReader:
+    """
+    Stream a registered CSV with every column read as its source text ("2.0" or "007"
+    as written, not as the stored number). Empty cells are "", not missing.
+    """
+    column_types = {column["name"]: pa.string() for column in record["columns"]}
+    return pacsv.open_csv(
+        str(csv_path),
+        read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_BYTES, use_threads=False),
+        convert_options=pacsv.ConvertOptions(column_types=column_types, strings_can_be_null=False)
+    )
+
+def open_table(record: Dict[str, Any], columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    Memory-map a registered dataset. Only the selected columns are ever paged in,
+    and the returned table references the mapped file without copying.
+    """
+    source = pa.memory_map(record["path"], "r")
+    table = pa.ipc.open_file(source).read_all()
+    return table.select(columns) if columns is not None else table
+
+def load_frame(record: Dict[str, Any], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Load (a subset of the columns of) a registered dataset as a DataFrame."""
+    return open_table(record, columns).to_pandas()
+
+def iter_batches(
+    record: Dict[str, Any],
+    columns: Optional[List[str]] = None,
+    batch_rows: int = 100_000
+) -> Iterator[pa.RecordBatch]:
+    """Yield a registered dataset in record batches of at most `batch_rows` rows."""
+    for batch in open_table(record, columns).to_batches(max_chunksize=batch_rows):
+        yield batch
+
+def iter_frames(
+    record: Dict[str, Any],
+    columns: Optional[List[str]] = None,
+    batch_rows: int = 100_000
+) -> Iterator[pd.DataFrame]:
+    """Like iter_batches, but yields pandas DataFrames."""
+    for batch in iter_batches(record, columns, batch_rows):
+        yield batch.to_pandas()
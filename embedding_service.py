@@ -0,0 +1,210 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from logger import logger
+from metrics import register_cache, stage
+
+EMBEDDING_MODEL_NAME = "BAAI/bge-base-en"
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+class EmbeddingCache:
+    """
+    On-disk map from text hash to vector, stored in SQLite.
+    Entries are evicted least-recently-used first once the stored vectors exceed `max_bytes`.
+    The stored size is summed once at open and then kept as a running total.
+    """
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, max_bytes=EMBEDDING_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self._conn.commit()
+        self.evictions = 0
+        self._total_bytes = self._stored_bytes()
+
+    def _stored_bytes(self) -> int:
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys present in the cache and refresh their access time."""
+        found = {}
+        if not keys:
+            return found
+        now = time.time()
+        with self._lock:
+            # Stay well below SQLite's bound-parameter limit
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key, _ in rows]
+                )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        """Store {key: vector} pairs, then evict old entries if the cache is over budget."""
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            # Replaced entries give back their old size
+            replaced = 0
+            keys = [row[0] for row in rows]
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                replaced += self._conn.execute(
+                    f"SELECT COALESCE(SUM(size), 0) FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, last_access) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+            self._total_bytes += sum(row[2] for row in rows) - replaced
+            self._evict()
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Other processes may share the file, so settle the real size before evicting
+        self._total_bytes = self._stored_bytes()
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Trim to 90% of the budget so we don't evict on every insert
+        excess = self._total_bytes - int(self.max_bytes * 0.9)
+        freed = 0
+        victims = []
+        for key, size in self._conn.execute("SELECT key, size FROM embeddings ORDER BY last_access"):
+            victims.append((key,))
+            freed += size
+            if freed >= excess:
+                break
+        self._conn.executemany("DELETE FROM embeddings WHERE key = ?", victims)
+        self._conn.commit()
+        self._total_bytes -= freed
+        self.evictions += len(victims)
+        logger.info(f"Evicted {len(victims)} cached embeddings ({freed} bytes)")
+
+    def size_bytes(self):
+        return self._total_bytes
+
+class CachedEmbeddings(Embeddings):
+    """
+    LangChain Embeddings wrapper around a single shared model.
+    Document vectors are looked up in the disk cache first; misses are encoded in
+    batches spread over a thread pool and written back to the cache.
+    """
+
+    def __init__(self, model, model_name, cache, batch_size=EMBEDDING_BATCH_SIZE, workers=EMBEDDING_WORKERS):
+        self.model = model
+        self.model_name = model_name
+        self.cache = cache
+        self.batch_size = batch_size
+        self.workers = max(1, workers)
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _encode(self, texts):
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1 or self.workers == 1:
+            return [vector for batch in batches for vector in self.model.embed_documents(batch)]
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(self.model.embed_documents, batches)
+            return [vector for batch in results for vector in batch]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with stage("embed"):
+            return self._embed_documents(texts)
+
+    def _embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = self.cache.get_many(list(set(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+
+        if missing:
+            vectors = self._encode(list(missing.values()))
+            encoded = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(encoded)
+            cached.update(encoded)
+
+        with self._stats_lock:
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        with stage("embed_query"):
+            return self.model.embed_query(text)
+
+    def stats(self):
+        """Cache hit/miss counters for this process."""
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "model": self.model_name,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.cache.evictions,
+                "cache_bytes": self.cache.size_bytes()
+            }
+
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
+def get_embeddings():
+    """Return the process-wide embedding service, loading the BGE model on first use."""
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                logger.info(f"Loading embedding model {EMBEDDING_MODEL_NAME}")
+                model = HuggingFaceEmbeddings(
+                    model_name=EMBEDDING_MODEL_NAME,
+                    model_kwargs={'device': 'cpu'},
+                    encode_kwargs={'normalize_embeddings': True}
+                )
+                _embeddings = CachedEmbeddings(model, EMBEDDING_MODEL_NAME, EmbeddingCache())
+    return _embeddings
+
+# Exported only once the model has been loaded; scraping must not trigger loading it
+register_cache("embeddings", lambda: _embeddings.stats() if _embeddings is not None else {})
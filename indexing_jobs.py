@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+from logger import logger, request_id
+from metrics import Gauge, QUEUE_WAIT_SECONDS
+
+# Finished jobs kept around for the status endpoint
+INDEXING_JOB_HISTORY = int(os.getenv("INDEXING_JOB_HISTORY", "100"))
+# Job snapshots shared by all worker processes, so any worker can report on or cancel a job
+INDEXING_JOB_STATE_DIR = os.getenv("INDEXING_JOB_STATE_DIR", os.path.join("chroma_db", "jobs"))
+# Progress is written out at most this often; status changes are written immediately
+PROGRESS_SAVE_INTERVAL = 1.0
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (SUCCEEDED, FAILED, CANCELLED)
+
+INDEXING_JOBS_ACTIVE = Gauge("indexing_jobs", "Indexing jobs queued or running.", ["status"])
+
+class IndexingCancelled(Exception):
+    """Raised inside an index build when its cancel event is set."""
+
+class IndexingJob:
+    """
+    One background index build. `progress` is filled in by the build itself through
+    update_progress; `cancel_event` is checked by the build between batches.
+    """
+
+    def __init__(self, description: str, key: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.description = description
+        self.key = key
+        self.status = QUEUED
+        self.progress: Dict[str, Any] = {}
+        self.error: Optional[str] = None
+        self.created_at = datetime.now()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.cancel_event = threading.Event()
+        self.on_change: Optional[Callable[["IndexingJob"], None]] = None
+
+    def update_progress(self, **fields):
+        self.progress = {**self.progress, **fields}
+        if self.on_change is not None:
+            self.on_change(self)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in FINISHED_STATES
+
+    def to_dict(self) -> Dict[str, Any]:
+        progress = dict(self.progress)
+        if progress.get("total_rows"):
+            progress["fraction"] = min(progress.get("rows", 0) / progress["total_rows"], 1.0)
+        return {
+            "job_id": self.id,
+            "description": self.description,
+            "key": self.key,
+            "status": self.status,
+            "progress": progress,
+            "error": self.error,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "worker_pid": os.getpid()
+        }
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class IndexingJobManager:
+    """
+    Runs index builds one at a time on a background thread.
+
+    A build only takes effect through its `on_success` callback once it has fully
+    completed, so whatever is currently served keeps serving until then; a build that
+    fails or is cancelled once running calls `on_failure` with the reason. Submitting a
+    job cancels queued builds with the same `key`, since the newest one supersedes them.
+
+    With a `state_dir`, every job is also written there as a JSON snapshot, so other
+    worker processes can report its status and request its cancellation.
+    """
+
+    def __init__(self, max_history: int = INDEXING_JOB_HISTORY, state_dir: Optional[str] = None):
+        self.max_history = max_history
+        self.state_dir = state_dir
+        self._jobs: "OrderedDict[str, IndexingJob]" = OrderedDict()
+        self._saved_at: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="indexer")
+
+    def submit(
+        self,
+        build: Callable[[IndexingJob], Any],
+        description: str,
+        on_success: Optional[Callable[[Any], None]] = None,
+        key: Optional[str] = None,
+        on_failure: Optional[Callable[[str], None]] = None
+    ) -> IndexingJob:
+        job = IndexingJob(description, key)
+        job.on_change = lambda changed: self._save(changed, force=False)
+        with self._lock:
+            for queued in self._jobs.values():
+                if queued.status == QUEUED and queued.key == key:
+                    self._finish(queued, CANCELLED, "Superseded by a newer indexing job")
+            self._jobs[job.id] = job
+            self._trim()
+            INDEXING_JOBS_ACTIVE.inc(status=QUEUED)
+        self._save(job)
+        self._executor.submit(self._run, job, build, on_success, on_failure)
+        logger.info(f"Queued indexing job {job.id}: {description}")
+        return job
+
+    def _run(self, job: IndexingJob, build, on_success, on_failure):
+        with self._lock:
+            if job.status != QUEUED:
+                return
+            job.status = RUNNING
+            job.started_at = datetime.now()
+            INDEXING_JOBS_ACTIVE.dec(status=QUEUED)
+            INDEXING_JOBS_ACTIVE.inc(status=RUNNING)
+        self._save(job)
+        QUEUE_WAIT_SECONDS.observe((job.started_at - job.created_at).total_seconds(), queue="indexing")
+        # Log lines from the build carry the job id
+        token = request_id.set(f"job-{job.id}")
+        try:
+            result = build(job)
+            if on_success is not None:
+                on_success(result)
+            self._finish(job, SUCCEEDED)
+            logger.info(f"Indexing job {job.id} succeeded")
+        except IndexingCancelled:
+            self._finish(job, CANCELLED, "Cancelled")
+            logger.info(f"Indexing job {job.id} cancelled")
+            self._notify_failure(job, on_failure)
+        except Exception as e:
+            self._finish(job, FAILED, str(e))
+            logger.error(f"Indexing job {job.id} failed: {e}")
+            self._notify_failure(job, on_failure)
+        finally:
+            request_id.reset(token)
+
+    def _notify_failure(self, job: IndexingJob, on_failure):
+        if on_failure is None:
+            return
+        try:
+            on_failure(job.error)
+        except Exception as e:
+            logger.error(f"Failure callback of indexing job {job.id} raised: {e}")
+
+    def _finish(self, job: IndexingJob, status: str, error: Optional[str] = None):
+        if job.status in (QUEUED, RUNNING):
+            INDEXING_JOBS_ACTIVE.dec(status=job.status)
+        job.status = status
+        job.error = error
+        job.finished_at = datetime.now()
+        self._save(job)
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(len(self._jobs) - self.max_history, 0)]:
+            del self._jobs[job_id]
+            self._saved_at.pop(job_id, None)
+            if self.state_dir is not None:
+                for path in (self._snapshot_path(job_id), self._cancel_path(job_id)):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+    def _snapshot_path(self, job_id: str) -> str:
+        return os.path.join(self.state_dir, f"{job_id}.json")
+
+    def _cancel_path(self, job_id: str) -> str:
+        return os.path.join(self.state_dir, f"{job_id}.cancel")
+
+    def _save(self, job: IndexingJob, force: bool = True):
+        if self.state_dir is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._saved_at.get(job.id, 0.0) < PROGRESS_SAVE_INTERVAL:
+            return
+        self._saved_at[job.id] = now
+        try:
+            os.makedirs(self.state_dir, exist_ok=True)
+            path = self._snapshot_path(job.id)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not save indexing job {job.id}: {e}")
+
+    def _load(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Snapshot of a job run by another worker; jobs of exited workers count as failed."""
+        if self.state_dir is None or not all(c in "0123456789abcdef" for c in job_id):
+            return None
+        try:
+            with open(self._snapshot_path(job_id), "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if info["status"] not in FINISHED_STATES and not _pid_alive(info.get("worker_pid", 0)):
+            info.update(status=FAILED, error="The worker running this job exited")
+        return info
+
+    def describe(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Status of a job run by this or any other worker, or None if it is unknown."""
+        job = self.get(job_id)
+        return job.to_dict() if job is not None else self._load(job_id)
+
+    def describe_all(self) -> List[Dict[str, Any]]:
+        """Recent jobs of all workers, newest first."""
+        jobs = {job.id: job.to_dict() for job in self.list()}
+        if self.state_dir is not None and os.path.isdir(self.state_dir):
+            for name in os.listdir(self.state_dir):
+                job_id, ext = os.path.splitext(name)
+                if ext == ".json" and job_id not in jobs:
+                    info = self._load(job_id)
+                    if info is not None:
+                        jobs[job_id] = info
+        return sorted(jobs.values(), key=lambda info: info["created_at"], reverse=True)[:self.max_history]
+
+    def get(self, job_id: str) -> Optional[IndexingJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> List[IndexingJob]:
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def cancel(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Cancel a job. Queued jobs stop immediately; running ones stop at their next
+        batch boundary. Jobs of other workers are asked to stop through a marker file
+        that their worker picks up in poll_cancellations. Returns the job's status,
+        or None if it is unknown.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                if not job.finished:
+                    job.cancel_event.set()
+                    if job.status == QUEUED:
+                        self._finish(job, CANCELLED, "Cancelled")
+                return job.to_dict()
+        info = self._load(job_id)
+        if info is not None and info["status"] not in FINISHED_STATES:
+            with open(self._cancel_path(job_id), "w"):
+                pass
+            info["cancel_requested"] = True
+        return info
+
+    def poll_cancellations(self):
+        """Cancel this worker's jobs that another worker was asked to cancel."""
+        if self.state_dir is None:
+            return
+        for job in self.list():
+            path = self._cancel_path(job.id)
+            if not job.finished and os.path.exists(path):
+                logger.info(f"Cancelling indexing job {job.id} on request of another worker")
+                self.cancel(job.id)
+                os.remove(path)
+
+    def shutdown(self):
+        with self._lock:
+            for job in self._jobs.values():
+                job.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+indexing_jobs = IndexingJobManager(state_dir=INDEXING_JOB_STATE_DIR)
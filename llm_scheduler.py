@@ -0,0 +1,111 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from typing import List, Optional, Tuple
+from metrics import Counter, Gauge, QUEUE_WAIT_SECONDS
+
+# Generations sent to Ollama at once by this process; match Ollama's OLLAMA_NUM_PARALLEL
+# divided by the number of API worker processes
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", "2"))
+# Generations allowed to wait for a slot; further requests are rejected with a 429
+OLLAMA_MAX_QUEUE = int(os.getenv("OLLAMA_MAX_QUEUE", "32"))
+# Starting estimate of one generation's duration, used for Retry-After until real ones are measured
+OLLAMA_EXPECTED_SECONDS = float(os.getenv("OLLAMA_EXPECTED_SECONDS", "10"))
+
+# Priority classes; lower values are admitted first
+INTERACTIVE = 0
+DEFAULT = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", DEFAULT: "default", BULK: "bulk"}
+
+LLM_QUEUED = Gauge("llm_requests_queued", "Ollama generations waiting for a slot.", ["priority"])
+LLM_REJECTED = Counter("llm_requests_rejected_total", "Ollama generations rejected because the queue was full.", ["priority"])
+
+class OllamaBusy(Exception):
+    """Raised when the Ollama queue is full; `retry_after` is a suggested wait in seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Ollama is busy, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+class AdmissionScheduler:
+    """
+    Limits concurrent Ollama generations. Callers beyond the limit wait in a priority
+    queue (first come, first served within a class); once the queue is full, acquire
+    raises OllamaBusy instead of letting every request slow down together.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = OLLAMA_MAX_CONCURRENCY,
+        max_queue: int = OLLAMA_MAX_QUEUE,
+        expected_seconds: float = OLLAMA_EXPECTED_SECONDS
+    ):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._queued = 0
+        self._seq = itertools.count()
+        # Moving average of generation time, for Retry-After estimates
+        self._service_seconds = expected_seconds
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free for a request arriving now."""
+        rounds = self._queued / self.max_concurrency + 1
+        return max(1, math.ceil(rounds * self._service_seconds))
+
+    async def acquire(self, priority: int = DEFAULT):
+        """Wait for a generation slot; every successful acquire must be paired with release."""
+        if self.active < self.max_concurrency and not self._queued:
+            self.active += 1
+            QUEUE_WAIT_SECONDS.observe(0.0, queue="ollama")
+            return
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        if self._queued >= self.max_queue:
+            LLM_REJECTED.inc(priority=name)
+            raise OllamaBusy(self.retry_after())
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._queued += 1
+        LLM_QUEUED.inc(priority=name)
+        submitted = time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the caller went away; pass it on
+                self.release()
+            else:
+                # Cancelled while waiting: the heap entry is skipped when it comes up
+                self._queued -= 1
+            raise
+        finally:
+            LLM_QUEUED.dec(priority=name)
+        QUEUE_WAIT_SECONDS.observe(time.perf_counter() - submitted, queue="ollama")
+
+    def release(self, seconds: Optional[float] = None):
+        """Free a slot; `seconds` is how long the generation took."""
+        if seconds is not None:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * seconds
+        self.active -= 1
+        while self._waiters and self.active < self.max_concurrency:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.cancelled():
+                continue
+            self._queued -= 1
+            self.active += 1
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "queued": self._queued,
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "expected_seconds": round(self._service_seconds, 3)
+        }
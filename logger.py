@@ -1,13 +1,49 @@
-import logging
+import os
 import sys
+import json
+import logging
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+# "json" for one JSON object per line, "text" for the plain format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+
+# Set per HTTP request (and per indexing job) so every log line can be correlated
+request_id = ContextVar("request_id", default=None)
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record; fields passed as `extra={"fields": {...}}` are merged in."""
+
+    def format(self, record):
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None)
+        }
+        entry.update(getattr(record, "fields", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+handler = logging.StreamHandler(sys.stdout)
+handler.addFilter(RequestIdFilter())
+if LOG_FORMAT == "json":
+    handler.setFormatter(JsonFormatter())
+else:
+    handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'))
 
 # Configure logging
 logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
+    level=LOG_LEVEL,
+    handlers=[handler]
 )
 
 # Create logger
@@ -16,4 +52,4 @@ logger = logging.getLogger(__name__)
 # Set log levels for specific modules
 logging.getLogger("langchain").setLevel(logging.ERROR)
 logging.getLogger("transformers").setLevel(logging.ERROR)
-logging.getLogger("chromadb").setLevel(logging.ERROR) 
\ No newline at end of file
+logging.getLogger("chromadb").setLevel(logging.ERROR)
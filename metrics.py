@@ -0,0 +1,351 @@
+import os
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from logger import logger, request_id
+
+# Requests slower than this are logged as slow (and have their profile kept, if enabled)
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "5"))
+# Profile every request with pyinstrument (optional dependency) and keep reports of slow ones
+PROFILE_SLOW_REQUESTS = os.getenv("PROFILE_SLOW_REQUESTS", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+
+METRICS_PREFIX = "datamatic"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+Sample = Tuple[str, Dict[str, str], float]
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def _format_value(value: float) -> str:
+    value = float(value)
+    if value == float("inf"):
+        return "+Inf"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Registry:
+    """The process's metrics, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: List["Metric"] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: "Metric"):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def register_collector(self, collector: Callable[[], Iterable[Tuple[str, str, str, Dict[str, str], float]]]):
+        """`collector()` is called at scrape time and yields (name, type, help, labels, value)."""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        families = [(metric.name, metric.kind, metric.help, metric.samples()) for metric in metrics]
+        # Several collectors may report the same metric (one cache each), so group them by name
+        collected: Dict[str, Tuple[str, str, List[Sample]]] = {}
+        for collector in collectors:
+            try:
+                for name, kind, help, labels, value in collector():
+                    name = f"{METRICS_PREFIX}_{name}"
+                    collected.setdefault(name, (kind, help, []))[2].append((name, labels, value))
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        families.extend((name, kind, help, samples) for name, (kind, help, samples) in collected.items())
+
+        lines = []
+        for name, kind, help, samples in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = f"{METRICS_PREFIX}_{name}"
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[tuple, Any] = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels: Dict[str, Any]) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> Dict[str, str]:
+        return dict(zip(self.labelnames, key))
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [(self.name, self._labels(key), value) for key, value in self._values.items()]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            # One count per bucket plus an overflow slot, accumulated at render time
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self) -> List[Sample]:
+        samples = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                labels = self._labels(key)
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+                samples.append((f"{self.name}_sum", labels, total))
+                samples.append((f"{self.name}_count", labels, cumulative))
+        return samples
+
+def register_cache(name: str, stats: Callable[[], Dict[str, Any]]):
+    """Export a cache's stats() (hits, misses, hit_ratio, size, evictions) under cache=`name`."""
+    def collect():
+        current = stats()
+        labels = {"cache": name}
+        yield "cache_hits_total", "counter", "Cache lookups that found an entry.", labels, current.get("hits", 0)
+        yield "cache_misses_total", "counter", "Cache lookups that found nothing.", labels, current.get("misses", 0)
+        yield "cache_hit_ratio", "gauge", "Hits over lookups since the process started.", labels, current.get("hit_ratio", 0.0)
+        if "size" in current:
+            yield "cache_entries", "gauge", "Entries currently held.", labels, current["size"]
+        if "evictions" in current:
+            yield "cache_evictions_total", "counter", "Entries evicted to stay within size.", labels, current["evictions"]
+    REGISTRY.register_collector(collect)
+
+STAGE_SECONDS = Histogram(
+    "stage_seconds", "Time spent in each pipeline stage, excluding nested stages.", ["stage"]
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "queue_wait_seconds", "Time work waited for a worker before it started.", ["queue"]
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests served.", ["app", "method", "route", "status"]
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency, including streamed bodies.", ["app", "method", "route"]
+)
+HTTP_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served.", ["app"]
+)
+
+class _Span:
+    __slots__ = ("name", "child_seconds")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.child_seconds = 0.0
+
+_current_span: ContextVar[Optional[_Span]] = ContextVar("current_span", default=None)
+# Per-request {stage: seconds}, filled in by stage() and logged when the request finishes
+_request_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_stages", default=None)
+
+def record_stage(name: str, seconds: float):
+    """Record time spent in a stage that was measured by hand (e.g. across a stream)."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a pipeline stage. Time spent in stages nested inside it is attributed to those
+    stages only, so sequential stages of one request add up to at most its wall time
+    (concurrent ones, like the two model-suggestion prompts, can overlap).
+    Must not span a `yield` of a generator.
+    """
+    parent = _current_span.get()
+    span = _Span(name)
+    token = _current_span.set(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        elapsed = time.perf_counter() - start
+        _current_span.reset(token)
+        if parent is not None:
+            parent.child_seconds += elapsed
+        record_stage(name, max(elapsed - span.child_seconds, 0.0))
+
+@contextmanager
+def collect_stages():
+    """
+    Collect the {stage: seconds} breakdown of the enclosed work, e.g. one index build.
+    The totals are also added to the enclosing collection (such as the request's).
+    """
+    outer = _request_stages.get()
+    stages: Dict[str, float] = {}
+    token = _request_stages.set(stages)
+    try:
+        yield stages
+    finally:
+        _request_stages.reset(token)
+        if outer is not None:
+            for name, seconds in stages.items():
+                outer[name] = outer.get(name, 0.0) + seconds
+
+def stages_ms(stages: Dict[str, float]) -> Dict[str, float]:
+    return {name: round(seconds * 1000, 1) for name, seconds in stages.items()}
+
+_profiler_missing_logged = False
+
+def _start_profiler():
+    global _profiler_missing_logged
+    try:
+        from pyinstrument import Profiler
+    except ImportError:
+        if not _profiler_missing_logged:
+            logger.warning("PROFILE_SLOW_REQUESTS is set but pyinstrument is not installed")
+            _profiler_missing_logged = True
+        return None
+    # Only samples the request's own task; work handed to thread pools shows up as waiting
+    profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+    profiler.start()
+    return profiler
+
+def _save_profile(profiler, rid: str) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{rid}.html")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(profiler.output_html())
+    return path
+
+class MetricsMiddleware:
+    """
+    ASGI middleware giving each request an id (taken from X-Request-ID if the client
+    sent one, and echoed back), counting in-flight requests and recording latency per
+    route template once the response body has been fully sent.
+    """
+
+    def __init__(self, app, app_name: str, routes):
+        self.app = app
+        self.app_name = app_name
+        self.routes = routes
+
+    def _route(self, scope) -> str:
+        from starlette.routing import Match
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", "unmatched")
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope.get("headers") or [])
+        rid = headers.get(b"x-request-id", b"").decode("latin-1")[:128] or uuid.uuid4().hex
+        rid_token = request_id.set(rid)
+        status = 500
+
+        async def send_with_request_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", rid.encode("latin-1"))]
+            await send(message)
+
+        profiler = _start_profiler() if PROFILE_SLOW_REQUESTS else None
+        route = self._route(scope)
+        method = scope.get("method", "")
+        HTTP_IN_FLIGHT.inc(app=self.app_name)
+        start = time.perf_counter()
+        try:
+            with collect_stages() as stages:
+                await self.app(scope, receive, send_with_request_id)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec(app=self.app_name)
+            HTTP_REQUESTS.inc(app=self.app_name, method=method, route=route, status=status)
+            HTTP_REQUEST_SECONDS.observe(elapsed, app=self.app_name, method=method, route=route)
+
+            fields = {
+                "method": method,
+                "route": route,
+                "status": status,
+                "duration_ms": round(elapsed * 1000, 1),
+                "stages_ms": stages_ms(stages)
+            }
+            if profiler is not None:
+                profiler.stop()
+                if elapsed >= SLOW_REQUEST_SECONDS:
+                    fields["profile"] = _save_profile(profiler, rid)
+            if elapsed >= SLOW_REQUEST_SECONDS:
+                logger.warning(f"Slow request {method} {scope.get('path')} took {elapsed:.2f}s", extra={"fields": fields})
+            elif route != "/metrics":
+                logger.info(f"{method} {scope.get('path')} {status} in {elapsed * 1000:.0f}ms", extra={"fields": fields})
+            request_id.reset(rid_token)
+
+def instrument_app(app, app_name: str):
+    """Add request ids, request metrics and a Prometheus /metrics endpoint to a FastAPI app."""
+    from fastapi.responses import PlainTextResponse
+
+    async def metrics_endpoint():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    app.add_api_route("/metrics", metrics_endpoint, methods=["GET"], include_in_schema=False)
+    app.add_middleware(MetricsMiddleware, app_name=app_name, routes=app.router.routes)
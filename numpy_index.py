@@ -0,0 +1,362 @@
+import os
+import json
+import uuid
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+from langchain.schema.embeddings import Embeddings
+from langchain.schema.vectorstore import VectorStore
+from logger import logger
+
+# "float16" halves Chroma's float32 vectors; "int8" quarters them with a per-vector scale
+NUMPY_INDEX_DTYPE = os.getenv("NUMPY_INDEX_DTYPE", "float16")
+# Coarse partitions are built for collections with at least this many vectors
+NUMPY_INDEX_IVF_MIN_ROWS = int(os.getenv("NUMPY_INDEX_IVF_MIN_ROWS", "200000"))
+# Partitions searched per query; more is slower and closer to exact
+NUMPY_INDEX_NPROBE = int(os.getenv("NUMPY_INDEX_NPROBE", "8"))
+# Vectors scored per matrix multiplication, bounding the float32 copy held at once
+NUMPY_INDEX_SCAN_ROWS = int(os.getenv("NUMPY_INDEX_SCAN_ROWS", "8192"))
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_PARTITION = 64
+
+DTYPES = {"float16": np.float16, "int8": np.int8}
+
+def _write_json(path: Path, data):
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+def _mmr(query: np.ndarray, candidates: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    Maximal marginal relevance over normalized vectors, picking the same documents as
+    LangChain's maximal_marginal_relevance but keeping each candidate's highest
+    similarity to the picks so far instead of recomputing it every round.
+    """
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+    selected = [int(np.argmax(relevance))]
+    redundancy = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, len(candidates)):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, similarity[best], out=redundancy)
+    return selected
+
+class NumpyVectorStore(VectorStore):
+    """
+    In-process vector store: normalized embeddings in a memory-mapped float16 or int8
+    matrix, searched exactly by batched matrix multiplication, so queries skip any
+    client or database layer. `build_partitions` adds an IVF-style coarse partitioning
+    for large collections; queries then only score the `nprobe` closest partitions.
+
+    Files in `directory`, all append-only while the collection is built:
+      vectors.bin, scales.bin  the matrix (and int8 scales), one row per document
+      docs.jsonl, offsets.bin  id, text and metadata per row, and each line's offset
+      deleted.json             rows removed by delete()
+      meta.json, ivf_*.npy     dtype and dimension, and the partitioning
+
+    Collections are written by one process at a time (the index writer lock) and only
+    read once published, so readers can keep their memory maps for the collection's life.
+    """
+
+    def __init__(self, directory, embedding_function: Embeddings, dtype: str = NUMPY_INDEX_DTYPE):
+        self.directory = Path(directory)
+        self._embedding = embedding_function
+        self._lock = threading.Lock()
+        meta_path = self.directory / "meta.json"
+        if meta_path.exists():
+            with open(meta_path, "r", encoding="utf-8") as f:
+                self._meta = json.load(f)
+        else:
+            if dtype not in DTYPES:
+                raise Exception(f"Unknown vector dtype {dtype!r}, expected one of {tuple(DTYPES)}")
+            self._meta = {"dtype": dtype, "dim": None, "partitioned_rows": 0}
+        self._ids: Optional[Dict[str, int]] = None
+        self._load()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    @property
+    def dtype(self):
+        return DTYPES[self._meta["dtype"]]
+
+    def _path(self, name: str) -> Path:
+        return self.directory / name
+
+    def _load(self):
+        """(Re)open the memory maps over the rows that were completely written."""
+        dim = self._meta["dim"]
+        n_rows = 0
+        if dim:
+            sizes = [
+                os.path.getsize(self._path("vectors.bin")) // (dim * np.dtype(self.dtype).itemsize),
+                os.path.getsize(self._path("offsets.bin")) // 8
+            ]
+            if self.dtype == np.int8:
+                sizes.append(os.path.getsize(self._path("scales.bin")) // 4)
+            n_rows = min(sizes)
+        self.n_rows = n_rows
+        if n_rows:
+            self._vectors = np.memmap(self._path("vectors.bin"), dtype=self.dtype, mode="r", shape=(n_rows, dim))
+            self._offsets = np.memmap(self._path("offsets.bin"), dtype=np.int64, mode="r", shape=(n_rows,))
+            self._scales = (
+                np.memmap(self._path("scales.bin"), dtype=np.float32, mode="r", shape=(n_rows,))
+                if self.dtype == np.int8 else None
+            )
+        else:
+            self._vectors = self._offsets = self._scales = None
+
+        deleted_path = self._path("deleted.json")
+        if deleted_path.exists():
+            with open(deleted_path, "r", encoding="utf-8") as f:
+                self._deleted = np.array(json.load(f), dtype=np.int64)
+        else:
+            self._deleted = np.empty(0, dtype=np.int64)
+
+        if self._meta["partitioned_rows"]:
+            self._centroids = np.load(self._path("ivf_centroids.npy"))
+            self._order = np.load(self._path("ivf_order.npy"), mmap_mode="r")
+            self._starts = np.load(self._path("ivf_starts.npy"))
+        else:
+            self._centroids = self._order = self._starts = None
+
+    def _encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        if self.dtype == np.int8:
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+        return vectors.astype(np.float16), None
+
+    def _decode(self, rows) -> np.ndarray:
+        vectors = np.asarray(self._vectors[rows], dtype=np.float32)
+        if self._scales is not None:
+            vectors *= np.asarray(self._scales[rows])[:, None]
+        return vectors
+
+    def add_texts(
+        self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+        ids: Optional[List[str]] = None, **kwargs: Any
+    ) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        ids = list(ids) if ids is not None else [uuid.uuid4().hex for _ in texts]
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = _normalize(np.asarray(self._embedding.embed_documents(texts), dtype=np.float32))
+
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            if not self._meta["dim"]:
+                self._meta["dim"] = int(vectors.shape[1])
+                for name in ("vectors.bin", "offsets.bin", "docs.jsonl", "scales.bin"):
+                    self._path(name).touch()
+                _write_json(self._path("meta.json"), self._meta)
+            # Drop whatever an interrupted write left beyond the last complete row
+            docs_end = 0
+            if self.n_rows:
+                with open(self._path("docs.jsonl"), "rb") as f:
+                    f.seek(int(self._offsets[-1]))
+                    docs_end = int(self._offsets[-1]) + len(f.readline())
+            row_bytes = self._meta["dim"] * np.dtype(self.dtype).itemsize
+            for name, size in (
+                ("docs.jsonl", docs_end), ("offsets.bin", self.n_rows * 8),
+                ("vectors.bin", self.n_rows * row_bytes), ("scales.bin", self.n_rows * 4 if self._scales is not None else 0)
+            ):
+                os.truncate(self._path(name), size)
+
+            lines = [
+                (json.dumps({"id": i, "text": t, "metadata": m}) + "\n").encode("utf-8")
+                for i, t, m in zip(ids, texts, metadatas)
+            ]
+            new_offsets = docs_end + np.cumsum([0] + [len(line) for line in lines[:-1]], dtype=np.int64)
+            encoded, scales = self._encode(vectors)
+            with open(self._path("docs.jsonl"), "ab") as f:
+                f.write(b"".join(lines))
+            with open(self._path("offsets.bin"), "ab") as f:
+                f.write(new_offsets.tobytes())
+            if scales is not None:
+                with open(self._path("scales.bin"), "ab") as f:
+                    f.write(scales.tobytes())
+            with open(self._path("vectors.bin"), "ab") as f:
+                f.write(encoded.tobytes())
+
+            if self._ids is not None:
+                self._ids.update((doc_id, self.n_rows + i) for i, doc_id in enumerate(ids))
+            self._load()
+        return ids
+
+    def _read_records(self, rows) -> List[Dict[str, Any]]:
+        # A collection that never received a row has no files yet
+        if not len(rows) or not self.n_rows:
+            return []
+        records = []
+        with open(self._path("docs.jsonl"), "rb") as f:
+            for row in rows:
+                f.seek(int(self._offsets[row]))
+                records.append(json.loads(f.readline()))
+        return records
+
+    def _documents(self, rows) -> List[Document]:
+        return [Document(page_content=r["text"], metadata=r["metadata"]) for r in self._read_records(rows)]
+
+    def _id_rows(self) -> Dict[str, int]:
+        """Map of id to row; built on first use, only the writer needs it."""
+        if self._ids is None:
+            self._ids = {}
+            if self.n_rows:
+                with open(self._path("docs.jsonl"), "rb") as f:
+                    for row in range(self.n_rows):
+                        self._ids[json.loads(f.readline())["id"]] = row
+        return self._ids
+
+    def get(self, include: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """The ids of all stored documents, like Chroma's get(include=[])."""
+        with self._lock:
+            deleted = set(self._deleted.tolist())
+            return {"ids": [doc_id for doc_id, row in self._id_rows().items() if row not in deleted]}
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        """Mark documents as deleted; their rows stay in the files but are never returned."""
+        if not ids:
+            return True
+        with self._lock:
+            id_rows = self._id_rows()
+            rows = [id_rows.pop(doc_id) for doc_id in ids if doc_id in id_rows]
+            if rows:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                _write_json(self._path("deleted.json"), sorted(set(self._deleted.tolist()) | set(rows)))
+                self._load()
+        return True
+
+    def _candidate_rows(self, query: np.ndarray, nprobe: int) -> Optional[np.ndarray]:
+        """Rows in the `nprobe` partitions closest to the query plus unpartitioned ones, or None for all."""
+        if self._centroids is None or nprobe >= len(self._centroids):
+            return None
+        probes = np.argpartition(-(self._centroids @ query), nprobe)[:nprobe]
+        rows = [np.asarray(self._order[self._starts[p]:self._starts[p + 1]]) for p in probes]
+        rows.append(np.arange(self._meta["partitioned_rows"], self.n_rows))
+        # Sorted, so the memory-mapped matrix is read front to back
+        return np.sort(np.concatenate(rows))
+
+    def _search(self, query: List[float], k: int, nprobe: int = NUMPY_INDEX_NPROBE) -> Tuple[np.ndarray, np.ndarray]:
+        """Rows of the `k` most similar live vectors and their cosine similarities, best first."""
+        if not self.n_rows or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        query = _normalize(np.asarray(query, dtype=np.float32))
+        candidates = self._candidate_rows(query, nprobe)
+        n = self.n_rows if candidates is None else len(candidates)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, NUMPY_INDEX_SCAN_ROWS):
+            end = min(start + NUMPY_INDEX_SCAN_ROWS, n)
+            rows = slice(start, end) if candidates is None else candidates[start:end]
+            scores[start:end] = self._decode(rows) @ query
+        rows = np.arange(self.n_rows) if candidates is None else candidates
+        if len(self._deleted):
+            scores[np.isin(rows, self._deleted)] = -np.inf
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[np.isfinite(scores[top])]
+        return rows[top], scores[top]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[Tuple[Document, float]]:
+        rows, scores = self._search(embedding, k)
+        return list(zip(self._documents(rows), scores.tolist()))
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    def max_marginal_relevance_search_by_vector(
+        self, embedding: List[float], k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any
+    ) -> List[Document]:
+        rows, _ = self._search(embedding, fetch_k)
+        if not len(rows):
+            return []
+        selected = _mmr(
+            _normalize(np.asarray(embedding, dtype=np.float32)), _normalize(self._decode(rows)), k, lambda_mult
+        )
+        return self._documents(rows[selected])
+
+    def max_marginal_relevance_search(
+        self, query: str, k: int = 4, fetch_k: int = 20, lambda_mult: float = 0.5, **kwargs: Any
+    ) -> List[Document]:
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding.embed_query(query), k, fetch_k, lambda_mult, **kwargs
+        )
+
+    def build_partitions(self, min_rows: int = NUMPY_INDEX_IVF_MIN_ROWS, n_partitions: Optional[int] = None, seed: int = 0):
+        """
+        Cluster the vectors with k-means on a sample (about sqrt(n) partitions) and store
+        the rows grouped by nearest centroid. Rows added afterwards are always scanned.
+        Smaller collections are left unpartitioned, since an exact scan is cheap enough.
+        """
+        with self._lock:
+            if self.n_rows < min_rows:
+                return
+            n_partitions = n_partitions or max(int(np.sqrt(self.n_rows)), 1)
+            rng = np.random.default_rng(seed)
+            sample_rows = np.sort(rng.choice(
+                self.n_rows, size=min(self.n_rows, n_partitions * KMEANS_SAMPLE_PER_PARTITION), replace=False
+            ))
+            sample = _normalize(self._decode(sample_rows))
+            centroids = sample[rng.choice(len(sample), size=n_partitions, replace=False)]
+            for _ in range(KMEANS_ITERATIONS):
+                assignment = np.argmax(sample @ centroids.T, axis=1)
+                for p in range(n_partitions):
+                    members = sample[assignment == p]
+                    # Empty partitions keep their previous centroid
+                    if len(members):
+                        centroids[p] = members.mean(axis=0)
+                centroids = _normalize(centroids)
+
+            assignment = np.empty(self.n_rows, dtype=np.int32)
+            for start in range(0, self.n_rows, NUMPY_INDEX_SCAN_ROWS):
+                end = min(start + NUMPY_INDEX_SCAN_ROWS, self.n_rows)
+                assignment[start:end] = np.argmax(self._decode(slice(start, end)) @ centroids.T, axis=1)
+            order = np.argsort(assignment, kind="stable")
+            starts = np.searchsorted(assignment[order], np.arange(n_partitions + 1))
+
+            np.save(self._path("ivf_centroids.npy"), centroids.astype(np.float32))
+            np.save(self._path("ivf_order.npy"), order.astype(np.int64))
+            np.save(self._path("ivf_starts.npy"), starts.astype(np.int64))
+            self._meta["partitioned_rows"] = self.n_rows
+            _write_json(self._path("meta.json"), self._meta)
+            self._load()
+        logger.info(f"Partitioned {self.n_rows} vectors in {self.directory.name} into {n_partitions} lists")
+
+    @classmethod
+    def from_texts(
+        cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+        directory=None, **kwargs: Any
+    ) -> "NumpyVectorStore":
+        if directory is None:
+            raise Exception("NumpyVectorStore needs a directory to store its files in")
+        store = cls(directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
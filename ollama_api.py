@@ -1,15 +1,21 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File
 from pydantic import BaseModel, HttpUrl
-from ollama_utils import setup_qa_chain
+from ollama_client import ollama_client, run_blocking, sse_events, SSE_HEADERS, OllamaBusy, ollama_busy_handler, INTERACTIVE
+from indexing_jobs import indexing_jobs
+from ttl_cache import TTLCache
+from answer_cache import answer_cache
+from metrics import instrument_app, register_cache
+from upload_store import store_upload
+import dataset_registry
+import time
+import threading
 import os
 from pathlib import Path
 from datetime import datetime
-import aiohttp
-import aiofiles
 from typing import Optional, List
-import shutil
 from logger import logger
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 
 app = FastAPI(title="DATAmat Ollama API")
 
@@ -21,16 +27,221 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+instrument_app(app, "ollama_api")
+app.add_exception_handler(OllamaBusy, ollama_busy_handler)
 
 # Configure download directory
 DOWNLOAD_DIR = Path("datasets")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
 
-# Initialize QA chain
-qa_chain = setup_qa_chain()
+# Loaded per-dataset chains; cold datasets are evicted and reopened from disk on demand
+QA_CHAIN_CACHE_SIZE = int(os.getenv("QA_CHAIN_CACHE_SIZE", "16"))
+QA_CHAIN_CACHE_TTL = float(os.getenv("QA_CHAIN_CACHE_TTL", "3600"))
+qa_chains = TTLCache(QA_CHAIN_CACHE_SIZE, QA_CHAIN_CACHE_TTL)
+register_cache("qa_chains", qa_chains.stats)
+
+# The default (latest) dataset's chain is loaded in the background after startup
+qa_chain = None
+# Run initialization before serving instead of in the background
+EAGER_STARTUP = os.getenv("EAGER_STARTUP", "0") == "1"
+readiness = {"index": "starting", "embeddings": "starting", "error": None}
+# How often each worker checks whether another one published a new default index
+INDEX_WATCH_INTERVAL = float(os.getenv("INDEX_WATCH_INTERVAL", "2"))
+# Generation of the published index this worker has caught up with
+active_generation = None
+
+def _rag():
+    """ollama_utils pulls in langchain, chromadb and the embedding model; import it on first use."""
+    import ollama_utils
+    return ollama_utils
+
+def initialize():
+    """
+    Load the default chain from the on-disk index if it is still valid (indexing it in
+    the background otherwise) and warm the embedding model. Failures are reported
+    through /ollama/ready instead of aborting startup.
+    """
+    global active_generation
+    readiness["index"] = "loading"
+    try:
+        rag = _rag()
+        # Only publications after this point need to be picked up by the watcher
+        active_generation = (rag.load_active_index(rag.PERSIST_DIRECTORY) or {}).get("generation")
+        datasets = rag.list_dataset_files()
+        if not datasets:
+            logger.warning("No CSV files found in datasets directory. QA chain will not be initialized.")
+            readiness["index"] = "no_dataset"
+        else:
+            index = rag.open_dataset_index(datasets[-1])
+            if index is not None:
+                _swap_qa_chain(rag.create_qa_chain(*index))
+                readiness["index"] = "ready"
+                logger.info(f"Reusing the existing index for {datasets[-1].name}")
+            else:
+                # Set before submitting: a build that finds its manifest current may finish first
+                readiness["index"] = "indexing"
+                start_reindex(f"startup {datasets[-1].name}")
+    except Exception as e:
+        logger.error(f"Error initializing QA chain: {e}", exc_info=True)
+        readiness.update({"index": "error", "error": str(e)})
+
+    readiness["embeddings"] = "loading"
+    try:
+        from embedding_service import get_embeddings
+        get_embeddings().embed_query("warm up")
+        readiness["embeddings"] = "ready"
+    except Exception as e:
+        logger.error(f"Error loading the embedding model: {e}", exc_info=True)
+        readiness.update({"embeddings": "error", "error": str(e)})
+
+def sync_active_index():
+    """
+    Switch the default chain to the index version another worker published, if the
+    generation counter moved. Indexes are only ever opened for reading here.
+    """
+    global active_generation
+    rag = _rag()
+    active = rag.load_active_index(rag.PERSIST_DIRECTORY) or {}
+    generation = active.get("generation")
+    if generation is None or generation == active_generation:
+        return
+    if qa_chain is not None and rag.index_version(qa_chain) == active.get("collection"):
+        # This worker built it (or already switched)
+        active_generation = generation
+        return
+    index = rag.open_active_index()
+    if index is None:
+        return
+    vectordb, collection_name, generation = index
+    _swap_qa_chain(rag.create_qa_chain(vectordb, collection_name))
+    active_generation = generation
+    readiness["index"] = "ready"
+    logger.info(f"Switched to index {collection_name} published by another worker (generation {generation})")
+
+def watch_active_index(started):
+    started.wait()
+    while True:
+        try:
+            sync_active_index()
+            indexing_jobs.poll_cancellations()
+        except Exception as e:
+            logger.error(f"Error checking for a new index version: {e}")
+        time.sleep(INDEX_WATCH_INTERVAL)
+
+@app.on_event("startup")
+async def start_initialization():
+    initialized = threading.Event()
+    threading.Thread(target=watch_active_index, args=(initialized,), name="index-watcher", daemon=True).start()
+    if EAGER_STARTUP:
+        await run_blocking(initialize)
+        initialized.set()
+    else:
+        def run():
+            initialize()
+            initialized.set()
+        threading.Thread(target=run, name="startup", daemon=True).start()
+
+@app.on_event("shutdown")
+async def close_ollama_client():
+    indexing_jobs.shutdown()
+    await ollama_client.close()
+
+def _swap_qa_chain(new_chain):
+    # A single reference assignment: in-flight requests keep the chain they already hold
+    global qa_chain
+    qa_chain = new_chain
+
+def start_reindex(description, dataset_path=None, publish=True):
+    """
+    Build the index for a dataset (the latest one by default) in the background and
+    cache its chain under its dataset id. With `publish` it is also swapped in as the
+    default chain; on-demand builds for a named dataset leave the default alone.
+    """
+    def on_success(new_chain):
+        global active_generation
+        # Answers cached for this version may predate the rebuild
+        rag = _rag()
+        version = rag.index_version(new_chain)
+        answer_cache.invalidate(version)
+        if dataset_path is not None:
+            qa_chains.set(dataset_path.name, new_chain)
+        if not publish:
+            # Not published, so other workers' watchers have nothing to switch to either
+            return
+        # Another worker may have published a newer version meanwhile; the watcher switches to that
+        active = rag.load_active_index(rag.PERSIST_DIRECTORY) or {}
+        if active.get("collection") == version:
+            _swap_qa_chain(new_chain)
+            active_generation = active.get("generation")
+        readiness["index"] = "ready"
+
+    def on_failure(error):
+        # Without a default chain, report why instead of "indexing" forever; a chain
+        # that is already being served keeps serving
+        if publish and qa_chain is None:
+            readiness.update({"index": "error", "error": error})
+
+    def build(job):
+        rag = _rag()
+        chain = rag.setup_qa_chain(
+            force_reload=True, progress=job.update_progress,
+            cancel_event=job.cancel_event, dataset_path=dataset_path, publish=publish
+        )
+        if chain is None:
+            # Only CSVs directly in the datasets directory are indexed (not e.g. datasets/kaggle);
+            # failing the job leaves a chain that is already being served in place
+            raise Exception(f"No datasets indexed: no CSV files in {rag.DATASETS_DIR}")
+        return chain
+
+    job = indexing_jobs.submit(
+        build,
+        description,
+        on_success=on_success,
+        on_failure=on_failure,
+        # A queued on-demand build must not supersede one that publishes the same dataset
+        key=(dataset_path.name if publish else f"{dataset_path.name} on demand") if dataset_path is not None else None
+    )
+    return {"job_id": job.id, "status": job.status, "status_url": f"/ollama/index-jobs/{job.id}"}
+
+async def get_qa_chain(dataset_id: Optional[str] = None):
+    """
+    The chain for `dataset_id`, or the default chain if none is given. Datasets that are
+    not loaded are reopened from their persisted index; unindexed ones start indexing.
+    """
+    if dataset_id is None:
+        if qa_chain is None and readiness["index"] in ("starting", "loading", "indexing"):
+            raise HTTPException(status_code=503, detail="The QA chain is still loading, retry shortly.")
+        if qa_chain is None and readiness["index"] == "error":
+            raise HTTPException(status_code=503, detail=f"The QA chain failed to load: {readiness['error']}")
+        if qa_chain is None:
+            logger.warning("QA chain is not initialized. No dataset available.")
+            raise HTTPException(status_code=400, detail="No dataset available. Please upload a CSV file first.")
+        return qa_chain
+
+    chain = qa_chains.get(dataset_id)
+    if chain is not None:
+        return chain
+
+    rag = await run_blocking(_rag)
+    dataset_path = rag.resolve_dataset(dataset_id)
+    if dataset_path is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dataset: {dataset_id}")
+    index = await run_blocking(rag.open_dataset_index, dataset_path)
+    if index is None:
+        # Only indexed for questions naming it; the default dataset stays as it is
+        job = start_reindex(f"index {dataset_id}", dataset_path, publish=False)
+        raise HTTPException(
+            status_code=409,
+            detail={"message": f"Dataset {dataset_id} is not indexed yet, indexing started", "indexing": job}
+        )
+    chain = rag.create_qa_chain(*index)
+    qa_chains.set(dataset_id, chain)
+    logger.info(f"Loaded QA chain for dataset {dataset_id}")
+    return chain
 
 class Query(BaseModel):
     question: str
+    dataset_id: Optional[str] = None  # file name from /ollama/list-datasets; latest if omitted
 
 class DatasetDownload(BaseModel):
     url: HttpUrl
@@ -40,39 +251,125 @@ class KaggleDatasetDownload(BaseModel):
     dataset_name: str  # Format: "username/dataset-name"
     filename: Optional[str] = None
 
+async def lookup_cached_answer(qa_chain, question):
+    """
+    Embed the question and look for an answer to a similar one on the same index version.
+    Returns (version, embedding, hit); version is None when the chain cannot be cached.
+    """
+    version = _rag().index_version(qa_chain)
+    if version is None:
+        return None, None, None
+    embedding = await run_blocking(answer_cache.embed, question)
+    return version, embedding, answer_cache.lookup(version, embedding)
+
+async def _stream_and_cache(tokens, version, question, embedding, context):
+    started = time.perf_counter()
+    parts = []
+    async for token in tokens:
+        parts.append(token)
+        yield token
+    answer_cache.store(version, question, embedding, "".join(parts), time.perf_counter() - started, context)
+
+async def _cached_tokens(answer):
+    yield answer
+
 @app.post("/ollama/ask")
 async def ask_question(query: Query):
     """Endpoint to ask questions using Ollama with Llama 3.2."""
-    if qa_chain is None:
-        logger.warning("QA chain is not initialized. No dataset available.")
-        raise HTTPException(status_code=400, detail="No dataset available. Please upload a CSV file first.")
+    qa_chain = await get_qa_chain(query.dataset_id)
     try:
-        result = qa_chain.invoke({"query": query.question})
-        return {"answer": result["result"]}
+        # Aggregations, filters and group-bys are computed exactly over the whole table.
+        # They bypass the semantic cache: "older than 15" and "older than 16" embed almost
+        # alike, and one must not be answered with the other's exact number
+        from structured_query import looks_structured, answer_structured
+        dataset_path = _rag().dataset_path_for_version(_rag().index_version(qa_chain))
+        if dataset_path is not None and looks_structured(query.question):
+            structured = await answer_structured(query.question, dataset_path)
+            if structured is not None:
+                return {**structured, "mode": "structured", "cached": False}
+            # The retrieval fallback is not cached either
+            version = embedding = None
+        else:
+            version, embedding, hit = await lookup_cached_answer(qa_chain, query.question)
+            if hit is not None:
+                return {"answer": hit["answer"], "context": hit["context"], "cached": True, "similarity": hit["similarity"]}
+
+        started = time.perf_counter()
+        # Retrieval and context packing are synchronous; keep them off the event loop
+        prompt, model, options, context = await run_blocking(_rag().build_qa_prompt, qa_chain, query.question)
+        answer = await ollama_client.generate(prompt, model=model, priority=INTERACTIVE, **options)
+        if version is not None:
+            answer_cache.store(version, query.question, embedding, answer, time.perf_counter() - started, context)
+        return {"answer": answer, "context": context, "mode": "retrieval", "cached": False}
+    except OllamaBusy:
+        raise
     except Exception as e:
         logger.error(f"Error processing question: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
 
+@app.post("/ollama/ask/stream")
+async def ask_question_stream(query: Query):
+    """Ask a question and stream the answer tokens as Server-Sent Events."""
+    qa_chain = await get_qa_chain(query.dataset_id)
+    try:
+        version, embedding, hit = await lookup_cached_answer(qa_chain, query.question)
+        if hit is not None:
+            headers = {**SSE_HEADERS, "X-Answer-Cache": "hit"}
+            return StreamingResponse(
+                sse_events(_cached_tokens(hit["answer"])), media_type="text/event-stream", headers=headers
+            )
+        # Retrieval is synchronous; only the generation is streamed
+        prompt, model, options, context = await run_blocking(_rag().build_qa_prompt, qa_chain, query.question)
+    except Exception as e:
+        logger.error(f"Error retrieving context: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing question: {str(e)}")
+    headers = {**SSE_HEADERS, "X-Answer-Cache": "miss"}
+    if context is not None:
+        headers["X-Context-Packed-Tokens"] = str(context["packed_tokens"])
+        headers["X-Context-Dropped-Tokens"] = str(context["dropped_tokens"])
+    tokens = await ollama_client.open_stream(prompt, model=model, priority=INTERACTIVE, **options)
+    if version is not None:
+        # Only answers that stream to completion are cached
+        tokens = _stream_and_cache(tokens, version, query.question, embedding, context)
+    return StreamingResponse(
+        sse_events(tokens),
+        media_type="text/event-stream",
+        headers=headers
+    )
+
+@app.get("/ollama/cache-stats")
+async def cache_stats():
+    """Hit rates and time saved by the semantic answer cache and the loaded-chain cache."""
+    return {"answer_cache": answer_cache.stats(), "qa_chains": qa_chains.stats()}
+
 @app.post("/ollama/upload-dataset")
 async def upload_dataset(file: UploadFile = File(...)):
-    """Upload a dataset and process it."""
+    """
+    Upload a dataset and index it. Files are stored under their content hash, so
+    re-uploading a dataset reuses the stored copy and its index instead of a new one.
+    """
     try:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{timestamp}_{file.filename}"
-        file_path = DOWNLOAD_DIR / safe_filename
-
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        stored = await store_upload(file, DOWNLOAD_DIR, keep_name=True)
+        dataset_id = stored.path.name
+        if stored.duplicate:
+            # Make the re-uploaded dataset the latest one again, i.e. the default
+            stored.path.touch()
+            dataset_registry.remember_sha256(stored.path, stored.sha256)
 
-        global qa_chain
-        qa_chain = setup_qa_chain(force_reload=True)
+        # Index in the background; the current chain keeps answering until the swap.
+        # An already indexed duplicate finishes as soon as its manifest is checked.
+        job = start_reindex(f"upload {dataset_id}", stored.path)
 
-        logger.info(f"Dataset uploaded successfully: {safe_filename}")
+        logger.info(f"Dataset uploaded successfully: {dataset_id}")
         return {
-            "message": "Dataset uploaded and processed successfully",
-            "filename": safe_filename,
-            "path": str(file_path),
-            "size_bytes": os.path.getsize(file_path)
+            "message": "Dataset already uploaded, reusing it" if stored.duplicate else "Dataset uploaded, indexing started",
+            "filename": dataset_id,
+            "path": str(stored.path),
+            "size_bytes": stored.size_bytes,
+            "sha256": stored.sha256,
+            "duplicate": stored.duplicate,
+            "dataset_id": dataset_id,
+            "indexing": job
         }
     except Exception as e:
         logger.error(f"Error uploading dataset: {str(e)}")
@@ -84,7 +381,12 @@ async def list_datasets():
     try:
         files = []
         for file_path in DOWNLOAD_DIR.glob('*'):
+            # Skip uploads still being written
+            if file_path.name.startswith("."):
+                continue
             files.append({
+                "dataset_id": file_path.name,
+                "loaded": file_path.name in qa_chains,
                 "filename": file_path.name,
                 "size_bytes": os.path.getsize(file_path),
                 "created": datetime.fromtimestamp(os.path.getctime(file_path)).isoformat()
@@ -94,15 +396,42 @@ async def list_datasets():
         logger.error(f"Error listing datasets: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error listing datasets: {str(e)}")
 
+@app.get("/ollama/index-jobs")
+async def list_index_jobs():
+    """List recent background indexing jobs of all workers, newest first."""
+    return {"jobs": indexing_jobs.describe_all()}
+
+@app.get("/ollama/index-jobs/{job_id}")
+async def get_index_job(job_id: str):
+    """Status and progress of one indexing job."""
+    job = indexing_jobs.describe(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown indexing job: {job_id}")
+    return job
+
+@app.post("/ollama/index-jobs/{job_id}/cancel")
+async def cancel_index_job(job_id: str):
+    """Cancel an indexing job; the chain currently being served is kept."""
+    job = indexing_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown indexing job: {job_id}")
+    return job
+
+@app.get("/ollama/ready")
+async def readiness_check():
+    """Readiness: 200 once the default chain and the embedding model are loaded, 503 before."""
+    ready = readiness["index"] in ("ready", "no_dataset") and readiness["embeddings"] == "ready"
+    body = {"ready": ready, **readiness}
+    if not ready:
+        raise HTTPException(status_code=503, detail=body)
+    return body
+
 @app.get("/ollama/health")
 async def health_check():
     """Health check endpoint."""
     try:
         # Check if Ollama server is running
-        async with aiohttp.ClientSession() as session:
-            async with session.get("http://localhost:11434/api/tags") as response:
-                if response.status != 200:
-                    raise Exception("Ollama server is not responding")
+        await ollama_client.tags()
         return {"status": "healthy", "backend": "ollama"}
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
@@ -130,7 +459,8 @@ async def download_kaggle_dataset(dataset: KaggleDatasetDownload):
         download_path = DOWNLOAD_DIR / "kaggle"
         download_path.mkdir(exist_ok=True)
 
-        kaggle.api.dataset_download_files(
+        await run_blocking(
+            kaggle.api.dataset_download_files,
             dataset.dataset_name,
             path=str(download_path),
             unzip=True
@@ -140,14 +470,14 @@ async def download_kaggle_dataset(dataset: KaggleDatasetDownload):
         if not downloaded_files:
             raise Exception("No files were downloaded")
 
-        global qa_chain
-        qa_chain = setup_qa_chain(force_reload=True)
+        job = start_reindex(f"kaggle {dataset.dataset_name}")
 
         logger.info(f"Kaggle dataset downloaded successfully: {dataset.dataset_name}")
         return {
-            "message": "Kaggle dataset downloaded successfully",
+            "message": "Kaggle dataset downloaded successfully, indexing started",
             "files": [str(f.name) for f in downloaded_files],
-            "download_path": str(download_path)
+            "download_path": str(download_path),
+            "indexing": job
         }
 
     except Exception as e:
@@ -156,4 +486,6 @@ async def download_kaggle_dataset(dataset: KaggleDatasetDownload):
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001) 
\ No newline at end of file
+    # Workers share the index on disk: one builds at a time and the others hot-swap to it
+    workers = int(os.getenv("API_WORKERS", "1"))
+    uvicorn.run("ollama_api:app" if workers > 1 else app, host="0.0.0.0", port=8001, workers=workers)
\ No newline at end of file
@@ -0,0 +1,428 @@
+import os
+import json
+import time
+import asyncio
+import hashlib
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+import aiohttp
+import dotenv
+from fastapi.responses import JSONResponse
+from logger import logger
+from metrics import Counter, Gauge, Histogram, QUEUE_WAIT_SECONDS, record_stage, stage
+from llm_scheduler import AdmissionScheduler, OllamaBusy, INTERACTIVE, DEFAULT, BULK
+
+dotenv.load_dotenv()
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "llama3.2:latest")
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "300"))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_MAX_RETRIES = int(os.getenv("OLLAMA_MAX_RETRIES", "2"))
+OLLAMA_RETRY_BACKOFF = float(os.getenv("OLLAMA_RETRY_BACKOFF", "0.5"))
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "32"))
+LLM_THREADPOOL_WORKERS = int(os.getenv("LLM_THREADPOOL_WORKERS", "8"))
+
+LLM_IN_FLIGHT = Gauge("llm_requests_in_flight", "Ollama generations currently running.")
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds", "Time until the first generated token.", ["mode"]
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "llm_tokens_per_second", "Generation speed after the first token.", ["mode"],
+    buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500)
+)
+LLM_TOKENS = Counter("llm_generated_tokens_total", "Tokens generated by Ollama.", ["mode"])
+LLM_COALESCED = Counter(
+    "llm_requests_coalesced_total", "Requests that joined an identical generation already in flight.", ["mode"]
+)
+
+def record_generation(mode: str, data: Dict[str, Any], first_token_seconds: Optional[float] = None):
+    """
+    Record speed metrics from Ollama's final response. Ollama reports eval_count and
+    durations in nanoseconds; a measured time to first token takes precedence.
+    """
+    if first_token_seconds is None and "prompt_eval_duration" in data:
+        first_token_seconds = (data.get("load_duration", 0) + data["prompt_eval_duration"]) / 1e9
+    if first_token_seconds is not None:
+        LLM_TIME_TO_FIRST_TOKEN.observe(first_token_seconds, mode=mode)
+    if data.get("eval_count") and data.get("eval_duration"):
+        LLM_TOKENS.inc(data["eval_count"], mode=mode)
+        LLM_TOKENS_PER_SECOND.observe(data["eval_count"] / (data["eval_duration"] / 1e9), mode=mode)
+
+class OllamaError(Exception):
+    """Raised when Ollama cannot be reached or returns an error response."""
+
+def _flight_key(payload: Dict[str, Any]) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class _Flight:
+    """
+    One generation shared by every caller that asked for the same payload. Streaming
+    flights keep the tokens produced so far, so late subscribers get them replayed.
+    """
+
+    def __init__(self):
+        self.task: Optional[asyncio.Task] = None
+        self.callers = 0
+        # Resolved once the generation has a slot, or fails with OllamaBusy
+        self.admitted = asyncio.get_running_loop().create_future()
+        self.tokens: List[str] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, token: str):
+        self.tokens.append(token)
+        self._notify()
+
+    def finish(self, error: Optional[Exception] = None):
+        self.error = error
+        self.done = True
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def replay(self) -> AsyncIterator[str]:
+        index = 0
+        while True:
+            while index < len(self.tokens):
+                yield self.tokens[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise OllamaError(str(self.error))
+                return
+            await self._changed.wait()
+
+class _Subscription:
+    """
+    One caller's iterator over a streaming flight. The caller leaves the flight exactly
+    once: when the tokens run out or fail, on aclose(), or when the iterator is dropped,
+    even if it was never iterated (an unstarted async generator skips its finally).
+    """
+
+    def __init__(self, client: "OllamaClient", key: str, flight: _Flight):
+        self._client = client
+        self._key = key
+        self._flight = flight
+        self._tokens = flight.replay()
+        self._left = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        try:
+            return await self._tokens.__anext__()
+        except BaseException:
+            self._leave()
+            raise
+
+    async def aclose(self):
+        try:
+            await self._tokens.aclose()
+        finally:
+            self._leave()
+
+    def _leave(self):
+        if not self._left:
+            self._left = True
+            self._client._leave(self._key, self._flight)
+
+    def __del__(self):
+        try:
+            self._leave()
+        except RuntimeError:
+            # The event loop is already closed; the flight went with it
+            pass
+
+class OllamaClient:
+    """
+    Async Ollama client sharing one keep-alive connection pool per process.
+    The session is created lazily inside the running event loop.
+
+    Generations go through an AdmissionScheduler: at most `max_concurrency` run at
+    once, the rest queue by priority (INTERACTIVE before DEFAULT before BULK) and
+    OllamaBusy is raised once the queue is full. Identical requests in flight at the
+    same time (same model, prompt and options) share a single generation.
+    """
+
+    def __init__(
+        self,
+        base_url: str = OLLAMA_BASE_URL,
+        model: str = OLLAMA_MODEL,
+        timeout: float = OLLAMA_TIMEOUT,
+        connect_timeout: float = OLLAMA_CONNECT_TIMEOUT,
+        max_retries: int = OLLAMA_MAX_RETRIES,
+        retry_backoff: float = OLLAMA_RETRY_BACKOFF,
+        pool_size: int = OLLAMA_POOL_SIZE,
+        scheduler: Optional[AdmissionScheduler] = None
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.pool_size = pool_size
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.scheduler = scheduler or AdmissionScheduler()
+        self._flights: Dict[str, _Flight] = {}
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        # Sessions are bound to the loop they were created in
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    async def _request(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        url = f"{self.base_url}{path}"
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._get_session().request(method, url, **kwargs) as response:
+                    if response.status >= 500 and attempt < self.max_retries:
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status
+                        )
+                    if response.status != 200:
+                        detail = await response.text()
+                        raise OllamaError(f"Ollama returned {response.status}: {detail}")
+                    return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    raise OllamaError(f"Error connecting to Ollama at {url}: {e}") from e
+                delay = self.retry_backoff * (2 ** attempt)
+                logger.warning(f"Ollama request failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def _join(self, payload: Dict[str, Any], start: Callable[[_Flight], Awaitable[Any]], mode: str) -> _Flight:
+        key = _flight_key(payload)
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = self._flights[key] = _Flight()
+            flight.task = asyncio.ensure_future(self._run_flight(key, flight, start))
+        else:
+            LLM_COALESCED.inc(mode=mode)
+        flight.callers += 1
+        return flight
+
+    def _leave(self, key: str, flight: _Flight):
+        flight.callers -= 1
+        if flight.callers == 0 and not flight.task.done():
+            # Nobody is waiting for the result any more; free the slot or queue place
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.task.cancel()
+
+    async def _run_flight(self, key: str, flight: _Flight, start: Callable[[_Flight], Awaitable[Any]]):
+        try:
+            return await start(flight)
+        except Exception as e:
+            flight.finish(e)
+            raise
+        finally:
+            if not flight.admitted.done():
+                flight.admitted.cancel()
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    async def _admit(self, flight: _Flight, priority: int):
+        try:
+            await self.scheduler.acquire(priority)
+        except OllamaBusy as e:
+            flight.admitted.set_exception(e)
+            # Retrieved by the callers; mark it so for the case there are none left
+            flight.admitted.exception()
+            raise
+        flight.admitted.set_result(None)
+
+    async def generate(
+        self, prompt: str, model: Optional[str] = None, format: Optional[str] = None,
+        priority: int = DEFAULT, **options
+    ) -> str:
+        """
+        Run a non-streaming completion and return the generated text.
+        Pass format="json" to constrain the output to valid JSON.
+        Raises OllamaBusy when the generation queue is full.
+        """
+        payload = {"model": model or self.model, "prompt": prompt, "stream": False}
+        if format:
+            payload["format"] = format
+        if options:
+            payload["options"] = options
+
+        async def run(flight: _Flight) -> str:
+            await self._admit(flight, priority)
+            start = time.perf_counter()
+            try:
+                with LLM_IN_FLIGHT.track_inprogress(), stage("llm_generate"):
+                    data = await self._request("POST", "/api/generate", json=payload)
+            except BaseException:
+                self.scheduler.release()
+                raise
+            self.scheduler.release(time.perf_counter() - start)
+            record_generation("generate", data)
+            return data["response"]
+
+        flight = self._join(payload, run, "generate")
+        try:
+            # Shielded so one caller going away does not cancel the others' generation
+            return await asyncio.shield(flight.task)
+        finally:
+            self._leave(_flight_key(payload), flight)
+
+    async def open_stream(
+        self, prompt: str, model: Optional[str] = None, priority: int = DEFAULT, **options
+    ) -> AsyncIterator[str]:
+        """
+        Admit a streaming completion and return an iterator over its tokens.
+        Waits for a generation slot and raises OllamaBusy before anything is sent when
+        the queue is full, so endpoints can still answer with a 429. Callers asking for
+        an identical stream already in flight get its tokens so far, then the rest live.
+        """
+        payload = {"model": model or self.model, "prompt": prompt, "stream": True}
+        if options:
+            payload["options"] = options
+        key = _flight_key(payload)
+
+        async def run(flight: _Flight):
+            # Failures reach the subscribers through the flight, not the task
+            try:
+                await self._admit(flight, priority)
+            except OllamaBusy:
+                return
+            start = time.perf_counter()
+            try:
+                async for token in self._stream(payload):
+                    flight.publish(token)
+            except Exception as e:
+                self.scheduler.release()
+                flight.finish(e)
+                return
+            except BaseException:
+                self.scheduler.release()
+                raise
+            self.scheduler.release(time.perf_counter() - start)
+            flight.finish()
+
+        flight = self._join(payload, run, "stream")
+        try:
+            await asyncio.shield(flight.admitted)
+        except BaseException:
+            self._leave(key, flight)
+            raise
+
+        return _Subscription(self, key, flight)
+
+    async def generate_stream(
+        self, prompt: str, model: Optional[str] = None, priority: int = DEFAULT, **options
+    ) -> AsyncIterator[str]:
+        """
+        Run a streaming completion, yielding tokens as Ollama produces them.
+        Unlike open_stream, a full queue only surfaces once iteration starts.
+        """
+        tokens = await self.open_stream(prompt, model=model, priority=priority, **options)
+        async for token in tokens:
+            yield token
+
+    async def _stream(self, payload: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        Stream one generation from Ollama.
+        Connection failures are retried only until the first token has been yielded.
+        """
+        url = f"{self.base_url}/api/generate"
+        started = False
+        start = time.perf_counter()
+        first_token_seconds = None
+        LLM_IN_FLIGHT.inc()
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    async with self._get_session().post(url, json=payload) as response:
+                        if response.status != 200:
+                            detail = await response.text()
+                            raise OllamaError(f"Ollama returned {response.status}: {detail}")
+                        # Ollama streams one JSON object per line
+                        async for line in response.content:
+                            if not line.strip():
+                                continue
+                            data = json.loads(line)
+                            if data.get("error"):
+                                raise OllamaError(data["error"])
+                            if data.get("response"):
+                                if not started:
+                                    first_token_seconds = time.perf_counter() - start
+                                started = True
+                                yield data["response"]
+                            if data.get("done"):
+                                record_generation("stream", data, first_token_seconds)
+                                return
+                        return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if started or attempt >= self.max_retries:
+                        raise OllamaError(f"Error streaming from Ollama at {url}: {e}") from e
+                    delay = self.retry_backoff * (2 ** attempt)
+                    logger.warning(f"Ollama stream failed ({e}), retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay)
+        finally:
+            LLM_IN_FLIGHT.dec()
+            # Measured by hand: a stage() cannot span the yields
+            record_stage("llm_generate", time.perf_counter() - start)
+
+    async def tags(self) -> Dict[str, Any]:
+        """List the models available on the Ollama server."""
+        return await self._request("GET", "/api/tags")
+
+    async def close(self):
+        if self._session is not None and not self._session.closed and self._loop is asyncio.get_running_loop():
+            await self._session.close()
+        self._session = None
+        self._loop = None
+
+ollama_client = OllamaClient()
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def sse_events(tokens: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Format a token stream as Server-Sent Events: one `data` event per token,
+    then a final `done` event, or an `error` event if generation fails midway.
+    """
+    try:
+        async for token in tokens:
+            yield f"data: {json.dumps({'token': token})}\n\n"
+        yield "event: done\ndata: {}\n\n"
+    except OllamaError as e:
+        logger.error(f"Streaming generation failed: {e}")
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+
+async def ollama_busy_handler(request, exc: OllamaBusy) -> JSONResponse:
+    """Exception handler answering 429 with a Retry-After header when the Ollama queue is full."""
+    return JSONResponse(
+        status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)}
+    )
+
+_llm_executor = ThreadPoolExecutor(max_workers=LLM_THREADPOOL_WORKERS, thread_name_prefix="llm")
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking call (e.g. a LangChain chain) on the LLM thread pool, in a copy of
+    the caller's context so the request id and stage timings carry over.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    submitted = time.perf_counter()
+
+    def run():
+        QUEUE_WAIT_SECONDS.observe(time.perf_counter() - submitted, queue="llm_threadpool")
+        return context.run(functools.partial(func, *args, **kwargs))
+
+    return await loop.run_in_executor(_llm_executor, run)
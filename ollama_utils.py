@@ -1,21 +1,65 @@
 import os
+import csv
 import warnings
 import shutil
+import hashlib
+import time
+from contextlib import contextmanager
 from pathlib import Path
 import dotenv
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 import requests
 import json
 
+import chromadb
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.document_loaders import CSVLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.llms import Ollama
 from langchain.chains import RetrievalQA
+from langchain.chains.retrieval_qa.prompt import PROMPT as QA_PROMPT
+from langchain.schema import Document, format_document
+from embedding_service import get_embeddings
+from indexing_jobs import IndexingCancelled
+from ollama_client import OLLAMA_BASE_URL
+from context_assembly import PackedContextRetriever, context_token_budget
+import dataset_registry
+from dataset_registry import file_sha256
 from logger import logger
+from metrics import collect_stages, stage, stages_ms
 
 dotenv.load_dotenv()
 
+PERSIST_DIRECTORY = "chroma_db"
+DATASETS_DIR = Path("datasets")
+COLLECTION_NAME = "langchain"
+MANIFEST_DIRNAME = "manifests"
+# Points at the collection currently being served and the one it replaced
+ACTIVE_INDEX_FILENAME = "active.json"
+# flock'ed by whichever worker is building or pruning collections
+WRITER_LOCK_FILENAME = "writer.lock"
+WRITER_LOCK_POLL_SECONDS = 0.5
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+INDEX_BATCH_SIZE = 256
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "4096"))
+INGEST_BATCH_ROWS = int(os.getenv("INGEST_BATCH_ROWS", "1000"))
+# "rows": one "column: value" document per row, as CSVLoader produces;
+# "blocks": consecutive rows share one document with a single header line. Blocks
+# embed far fewer documents but retrieve single rows worse (see benchmarks/run_suite.py),
+# so they are opt-in
+DOCUMENT_FORMATS = ("rows", "blocks")
+DOCUMENT_FORMAT = os.getenv("DOCUMENT_FORMAT", "rows")
+# A block ends after this many rows or before it grows past this many characters
+ROW_BLOCK_ROWS = int(os.getenv("ROW_BLOCK_ROWS", "50"))
+ROW_BLOCK_CHARS = int(os.getenv("ROW_BLOCK_CHARS", str(CHUNK_SIZE)))
+# "chroma", or "numpy" for the in-process memory-mapped store in numpy_index.py
+VECTOR_STORES = ("chroma", "numpy")
+VECTOR_STORE = os.getenv("VECTOR_STORE", "chroma")
+NUMPY_INDEX_DIRNAME = "numpy"
+
 def delete_vector_db(persist_directory):
     """Force delete the existing vector database and recreate it with correct permissions."""
     if os.path.exists(persist_directory):
@@ -26,82 +70,611 @@ def delete_vector_db(persist_directory):
         except Exception as e:
             logger.error(f"Error deleting vector database: {e}")
 
-def setup_qa_chain(force_reload=False):
+def open_vector_store(collection_name, vector_store=VECTOR_STORE):
+    """Open (or create) a collection in the given vector store backend."""
+    if vector_store == "numpy":
+        from numpy_index import NumpyVectorStore
+        return NumpyVectorStore(Path(PERSIST_DIRECTORY) / NUMPY_INDEX_DIRNAME / collection_name, get_embeddings())
+    if vector_store != "chroma":
+        raise Exception(f"Unknown vector store {vector_store!r}, expected one of {VECTOR_STORES}")
+    return Chroma(
+        collection_name=collection_name,
+        embedding_function=get_embeddings(),
+        persist_directory=PERSIST_DIRECTORY
+    )
+
+def collection_name_for(file_hash):
+    """Each dataset version is indexed into its own collection, keyed by its content hash."""
+    return f"{COLLECTION_NAME}_{file_hash[:16]}"
+
+def chunk_id(doc):
+    """Content-derived chunk id, so identical text always maps to the same stored vector."""
+    return hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+
+def _manifest_path(persist_directory, collection_name):
+    return Path(persist_directory) / MANIFEST_DIRNAME / f"{collection_name}.json"
+
+def load_manifest(persist_directory, collection_name):
+    """Return the stored index manifest for a collection, or None if there is none."""
+    path = _manifest_path(persist_directory, collection_name)
+    if not path.exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable index manifest {path}: {e}")
+        return None
+
+def save_manifest(persist_directory, collection_name, manifest):
+    """Atomically write the index manifest for a collection."""
+    path = _manifest_path(persist_directory, collection_name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+
+def document_settings(document_format=DOCUMENT_FORMAT):
+    """The settings that determine chunk contents, recorded in each manifest."""
+    if document_format not in DOCUMENT_FORMATS:
+        raise Exception(f"Unknown document format {document_format!r}, expected one of {DOCUMENT_FORMATS}")
+    settings = {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "document_format": document_format}
+    if document_format == "blocks":
+        settings.update(row_block_rows=ROW_BLOCK_ROWS, row_block_chars=ROW_BLOCK_CHARS)
+    return settings
+
+def manifest_is_current(manifest, file_hash, document_format=DOCUMENT_FORMAT, vector_store=VECTOR_STORE):
+    """True if the manifest was built from this exact file with the current chunking settings and store."""
+    if manifest is None or manifest.get("file_sha256") != file_hash:
+        return False
+    if manifest.get("vector_store", "chroma") != vector_store:
+        return False
+    # Manifests from before document formats existed were built from rows
+    recorded = {"document_format": "rows", **manifest}
+    return all(recorded.get(k) == v for k, v in document_settings(document_format).items())
+
+def load_active_index(persist_directory):
+    """Return {"collection": ..., "previous": ..., "generation": ...} for the served index, or None."""
+    path = Path(persist_directory) / ACTIVE_INDEX_FILENAME
+    if not path.exists():
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable active index pointer {path}: {e}")
+        return None
+
+def activate_collection(persist_directory, collection_name):
+    """
+    Atomically record `collection_name` as the served index. The collection it
+    replaces is remembered so it is not pruned while in-flight queries still use it.
+    The generation counter goes up whenever the served collection changes; workers
+    watch it to know when to switch.
+    """
+    active = load_active_index(persist_directory) or {}
+    previous = active.get("collection")
+    generation = active.get("generation", 0)
+    if previous == collection_name:
+        previous = active.get("previous")
+    else:
+        generation += 1
+    path = Path(persist_directory) / ACTIVE_INDEX_FILENAME
+    tmp_path = path.with_suffix(f".json.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"collection": collection_name, "previous": previous, "generation": generation}, f)
+    os.replace(tmp_path, path)
+    return previous
+
+@contextmanager
+def index_writer_lock(persist_directory, cancel_event=None, progress=None):
+    """
+    Hold the index's single-writer lock, shared by every worker process on this host.
+    Builds wait here for one running in another worker; `cancel_event` is still honoured.
+    """
+    os.makedirs(persist_directory, exist_ok=True)
+    with open(Path(persist_directory) / WRITER_LOCK_FILENAME, "a") as lock_file:
+        if fcntl is None:
+            # No flock on this platform: only safe with a single worker
+            yield
+            return
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if cancel_event is not None and cancel_event.is_set():
+                    raise IndexingCancelled("Indexing cancelled")
+                if not waiting:
+                    logger.info("Waiting for another worker to finish writing the index")
+                    if progress is not None:
+                        progress(waiting_for_writer=True)
+                    waiting = True
+                time.sleep(WRITER_LOCK_POLL_SECONDS)
+        try:
+            if waiting and progress is not None:
+                progress(waiting_for_writer=False)
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def prune_collections(persist_directory, keep):
+    """Drop index collections (and their manifests) other than those in `keep`."""
+    client = chromadb.PersistentClient(path=persist_directory)
+    for collection in client.list_collections():
+        name = collection.name
+        if name in keep or not (name == COLLECTION_NAME or name.startswith(f"{COLLECTION_NAME}_")):
+            continue
+        client.delete_collection(name)
+        manifest_path = _manifest_path(persist_directory, name)
+        if manifest_path.exists():
+            manifest_path.unlink()
+        logger.info(f"Pruned index collection {name}")
+    numpy_dir = Path(persist_directory) / NUMPY_INDEX_DIRNAME
+    for path in numpy_dir.iterdir() if numpy_dir.exists() else []:
+        if path.name in keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        manifest_path = _manifest_path(persist_directory, path.name)
+        if manifest_path.exists():
+            manifest_path.unlink()
+        logger.info(f"Pruned numpy index {path.name}")
+
+def iter_csv_batches(file_path, batch_rows=INGEST_BATCH_ROWS):
+    """
+    Stream a CSV as lists of row Documents, `batch_rows` at a time.
+    Produces the same page_content and metadata as CSVLoader, but never holds
+    more than one batch of rows in memory.
+    """
+    with open(file_path, newline="") as csvfile:
+        csv_reader = csv.DictReader(csvfile)
+        batch = []
+        for i, row in enumerate(csv_reader):
+            content = "\n".join(
+                f"{k.strip()}: {v.strip() if v is not None else v}"
+                for k, v in row.items()
+            )
+            batch.append(Document(page_content=content, metadata={"source": str(file_path), "row": i}))
+            if len(batch) >= batch_rows:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def iter_record_values(record, file_path, batch_rows=INGEST_BATCH_ROWS):
+    """
+    Stream a registered dataset as (column names, rows of stripped cell strings,
+    number of the first row) batches of `batch_rows` rows. Cells are the CSV's own
+    text, as iter_csv_values gives them, parsed by pyarrow instead of row by row.
+    """
+    row = 0
+    pending = []
+    for batch in dataset_registry.open_source_text(file_path, record):
+        names = [name.strip() for name in batch.schema.names]
+        columns = [column.to_pylist() for column in batch.columns]
+        pending.extend([v.strip() for v in values] for values in zip(*columns))
+        # Batches start at fixed row offsets, whatever the CSV block boundaries
+        start = 0
+        while len(pending) - start >= batch_rows:
+            yield names, pending[start:start + batch_rows], row
+            start += batch_rows
+            row += batch_rows
+        pending = pending[start:]
+    if pending:
+        yield names, pending, row
+
+def iter_csv_values(file_path, batch_rows=INGEST_BATCH_ROWS):
+    """The CSV counterpart of iter_record_values; short rows are padded with empty cells."""
+    with open(file_path, newline="") as csvfile:
+        csv_reader = csv.reader(csvfile)
+        names = [name.strip() for name in next(csv_reader, [])]
+        batch, first_row = [], 0
+        for values in csv_reader:
+            values = [v.strip() for v in values[:len(names)]]
+            batch.append(values + [""] * (len(names) - len(values)))
+            if len(batch) >= batch_rows:
+                yield names, batch, first_row
+                first_row += len(batch)
+                batch = []
+        if batch:
+            yield names, batch, first_row
+
+def iter_record_batches(record, file_path, batch_rows=INGEST_BATCH_ROWS):
+    """
+    Stream a registered dataset as row Documents with the same page_content and
+    metadata as iter_csv_batches.
+    """
+    for names, rows, first_row in iter_record_values(record, file_path, batch_rows):
+        yield [
+            Document(
+                page_content="\n".join(f"{k}: {v}" for k, v in zip(names, values)),
+                metadata={"source": str(file_path), "row": first_row + i}
+            )
+            for i, values in enumerate(rows)
+        ]
+
+def _block_line(values):
+    # Separators and line breaks inside cells would break the table layout
+    return "\t".join(" ".join(v.split()) for v in values)
+
+def row_block_documents(names, rows, first_row, source, max_rows=ROW_BLOCK_ROWS, max_chars=ROW_BLOCK_CHARS):
+    """
+    Group consecutive rows into table-shaped Documents: a header line with the column
+    names, then one tab-separated line per row. A block ends after `max_rows` rows
+    or before it would exceed `max_chars`; a single longer row gets a block of its own.
+    Metadata holds the first ("row") and last ("row_end") row number of the block.
+    """
+    header = _block_line(names)
+    docs = []
+    lines, size, start = [], len(header), first_row
+
+    def flush():
+        docs.append(Document(
+            page_content="\n".join([header] + lines),
+            metadata={"source": source, "row": start, "row_end": start + len(lines) - 1}
+        ))
+
+    for i, values in enumerate(rows):
+        line = _block_line(values)
+        if lines and (len(lines) >= max_rows or size + 1 + len(line) > max_chars):
+            flush()
+            lines, size, start = [], len(header), first_row + i
+        lines.append(line)
+        size += 1 + len(line)
+    if lines:
+        flush()
+    return docs
+
+def iter_block_batches(file_path, batch_rows=INGEST_BATCH_ROWS, record=None):
     """
-    Setup the QA chain with the latest dataset using Ollama with Llama 3.2.
+    Stream a dataset as row-block Documents. Blocks never span batches, and batches
+    start at fixed row offsets, so appending rows leaves earlier blocks (and their
+    embeddings) unchanged.
+    """
+    if record is not None:
+        batches = iter_record_values(record, file_path, batch_rows)
+    else:
+        batches = iter_csv_values(file_path, batch_rows)
+    for names, rows, first_row in batches:
+        yield row_block_documents(names, rows, first_row, str(file_path))
+
+def iter_chunk_batches(
+    file_path, text_splitter, batch_rows=INGEST_BATCH_ROWS, record=None, document_format=DOCUMENT_FORMAT
+):
+    """
+    Split each streamed row batch into chunks as it is read, parsed by pyarrow when the
+    dataset is registered and row by row otherwise. Row blocks already fit
+    a chunk, so the splitter only breaks up single rows that are too long on their own.
+    """
+    if document_format == "blocks":
+        batches = iter_block_batches(file_path, batch_rows, record)
+    elif record is not None:
+        batches = iter_record_batches(record, file_path, batch_rows)
+    else:
+        batches = iter_csv_batches(file_path, batch_rows)
+    while True:
+        with stage("read_rows"):
+            batch = next(batches, None)
+        if batch is None:
+            return
+        with stage("split"):
+            chunks = text_splitter.split_documents(batch)
+        yield chunks
+
+def sync_vector_index(vectordb, chunk_batches, manifest=None, progress=None, cancel_event=None):
+    """
+    Bring the collection in line with the streamed `chunk_batches`: embed only chunks
+    whose content hash is not indexed yet and delete indexed chunks that are no longer
+    present. Each batch is embedded and written before the next one is read, so the
+    first rows are searchable early and only chunk ids are kept across batches.
+    Returns the chunk ids now in the collection and the number added and removed.
+
+    `progress(**fields)` is called after every batch; setting `cancel_event` stops the
+    sync with IndexingCancelled before the next batch.
+    """
+    if manifest is not None:
+        existing_ids = set(manifest.get("chunk_ids", []))
+    else:
+        # No manifest (first run or after a crash): trust what the collection holds
+        existing_ids = set(vectordb.get(include=[])["ids"])
+
+    chunk_ids = {}
+    added = 0
+    rows = 0
+    for documents in chunk_batches:
+        if cancel_event is not None and cancel_event.is_set():
+            raise IndexingCancelled("Indexing cancelled")
+        new_docs = {}
+        for doc in documents:
+            doc_id = chunk_id(doc)
+            if doc_id in chunk_ids:
+                continue
+            chunk_ids[doc_id] = None
+            if doc_id not in existing_ids:
+                new_docs[doc_id] = doc
+
+        new_ids = list(new_docs)
+        for start in range(0, len(new_ids), INDEX_BATCH_SIZE):
+            batch_ids = new_ids[start:start + INDEX_BATCH_SIZE]
+            # Embedding is its own nested stage, so this only counts the vector store write
+            with stage("index_write"):
+                vectordb.add_texts(
+                    texts=[new_docs[i].page_content for i in batch_ids],
+                    metadatas=[new_docs[i].metadata for i in batch_ids],
+                    ids=batch_ids
+                )
+        added += len(new_ids)
+        if documents:
+            metadata = documents[-1].metadata
+            rows = metadata.get("row_end", metadata.get("row", rows - 1)) + 1
+        if progress is not None:
+            progress(rows=rows, chunks=len(chunk_ids), embedded=added)
+
+    stale_ids = [i for i in existing_ids if i not in chunk_ids]
+    with stage("index_delete"):
+        for start in range(0, len(stale_ids), INDEX_BATCH_SIZE):
+            vectordb.delete(ids=stale_ids[start:start + INDEX_BATCH_SIZE])
+
+    return list(chunk_ids), added, len(stale_ids)
+
+def build_qa_prompt(qa_chain, question):
+    """
+    Run the chain's retrieval step and render the same "stuff" prompt RetrievalQA would
+    send, so the answer can be generated or streamed straight from Ollama.
+    Returns the prompt, the model name, the Ollama generation options and the context
+    packing stats (None for retrievers that do not pack to a token budget).
+    """
+    if isinstance(qa_chain.retriever, PackedContextRetriever):
+        docs, context_stats = qa_chain.retriever.assemble(question)
+    else:
+        docs, context_stats = qa_chain.retriever.get_relevant_documents(question), None
+    stuff_chain = qa_chain.combine_documents_chain
+    with stage("build_prompt"):
+        context = stuff_chain.document_separator.join(
+            format_document(doc, stuff_chain.document_prompt) for doc in docs
+        )
+        prompt = stuff_chain.llm_chain.prompt.format(
+            **{stuff_chain.document_variable_name: context, "question": question}
+        )
+    llm = stuff_chain.llm_chain.llm
+    return prompt, llm.model, {"temperature": llm.temperature, "num_ctx": llm.num_ctx}, context_stats
+
+def dataset_path_for_version(version):
+    """The dataset file an index version was built from, if it is still present."""
+    manifest = load_manifest(PERSIST_DIRECTORY, version) if version else None
+    if manifest is None:
+        return None
+    path = DATASETS_DIR / manifest.get("dataset", "")
+    return path if path.is_file() else None
+
+def index_version(qa_chain):
+    """The index version a chain answers from, or None for chains built elsewhere."""
+    return getattr(qa_chain.retriever, "index_version", None) or None
+
+def check_ollama():
+    """Raise if the Ollama server is not reachable."""
+    try:
+        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags")
+        if response.status_code != 200:
+            raise Exception("Ollama server is not running")
+    except Exception as e:
+        logger.error(f"Error connecting to Ollama server: {e}")
+        raise Exception(f"Please ensure Ollama server is running at {OLLAMA_BASE_URL}")
+
+def list_dataset_files():
+    """CSV datasets available for indexing, oldest first."""
+    if not DATASETS_DIR.exists():
+        return []
+    return sorted(DATASETS_DIR.glob("*.csv"), key=lambda x: x.stat().st_mtime)
+
+def resolve_dataset(dataset_id):
+    """Map a dataset id (its file name in the datasets directory) to its path, or None."""
+    if not dataset_id or Path(dataset_id).name != dataset_id:
+        return None
+    path = DATASETS_DIR / dataset_id
+    return path if path.is_file() and path.suffix == ".csv" else None
+
+def build_dataset_index(
+    dataset_path, force_reload=False, progress=None, cancel_event=None,
+    document_format=DOCUMENT_FORMAT, vector_store=VECTOR_STORE
+):
+    """
+    Make sure `dataset_path` is fully indexed into its own collection and return
+    (vectordb, collection_name). `document_format` picks how rows become documents
+    (see DOCUMENT_FORMATS); switching it re-indexes the changed chunks only.
+    `vector_store` picks the backend (see VECTOR_STORES).
+
+    Chunks are keyed by a hash of their content and repeated text is served from the
+    embedding cache, so only new chunks are encoded. If a byte-identical file has
+    already been indexed, nothing is re-read. `force_reload` diffs against the ids
+    actually stored in the vector store instead of the manifest.
+    """
+    persist_directory = PERSIST_DIRECTORY
+    os.makedirs(persist_directory, exist_ok=True)
+
+    # Shared embedding model, backed by the on-disk vector cache
+    embedding = get_embeddings()
+
+    file_hash = file_sha256(dataset_path)
+    collection_name = collection_name_for(file_hash)
+
+    # Open this version's collection (created on first use)
+    vectordb = open_vector_store(collection_name, vector_store)
+    manifest = load_manifest(persist_directory, collection_name)
+
+    if manifest_is_current(manifest, file_hash, document_format, vector_store):
+        logger.info(f"Index is up to date for {dataset_path.name}, skipping embedding")
+        return vectordb, collection_name
+
+    # Stream, split & embed the dataset batch by batch; registered files are parsed by pyarrow
+    record = dataset_registry.register_csv(dataset_path, file_hash)
+    if progress is not None:
+        progress(dataset=dataset_path.name, total_rows=record["n_rows"] if record else None)
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    chunk_batches = iter_chunk_batches(dataset_path, text_splitter, record=record, document_format=document_format)
+
+    # A missing manifest (first build or an interrupted one) diffs against the stored ids
+    # The manifest lists what another backend holds after a switch of vector store
+    if manifest is not None and manifest.get("vector_store", "chroma") != vector_store:
+        manifest = None
+    chunk_ids, added, removed = sync_vector_index(
+        vectordb, chunk_batches, None if force_reload else manifest,
+        progress=progress, cancel_event=cancel_event
+    )
+    if vector_store == "numpy":
+        with stage("index_partition"):
+            vectordb.build_partitions()
+    save_manifest(persist_directory, collection_name, {
+        "dataset": dataset_path.name,
+        "file_sha256": file_hash,
+        **document_settings(document_format),
+        "vector_store": vector_store,
+        "chunk_ids": chunk_ids
+    })
+    logger.info(
+        f"Indexed {dataset_path.name} into {collection_name} as {document_format}: {len(chunk_ids)} chunks, "
+        f"{added} added, {removed} removed"
+    )
+    logger.info(f"Embedding cache: {embedding.stats()}")
+    return vectordb, collection_name
+
+def open_dataset_index(dataset_path):
+    """
+    Reopen an already built index for `dataset_path` as (vectordb, collection_name),
+    or return None if it needs building.
+    """
+    file_hash = file_sha256(dataset_path)
+    collection_name = collection_name_for(file_hash)
+    if not manifest_is_current(load_manifest(PERSIST_DIRECTORY, collection_name), file_hash):
+        return None
+    return open_vector_store(collection_name), collection_name
+
+def open_active_index():
+    """
+    Reopen the index other workers published as the default, as
+    (vectordb, collection_name, generation), or None if there is none yet.
+    Only reads: serving workers never write to a published collection.
+    """
+    active = load_active_index(PERSIST_DIRECTORY)
+    if not active or not active.get("collection"):
+        return None
+    collection_name = active["collection"]
+    manifest = load_manifest(PERSIST_DIRECTORY, collection_name)
+    if manifest is None:
+        return None
+    # Served from whichever backend the publishing worker built it in
+    vectordb = open_vector_store(collection_name, manifest.get("vector_store", "chroma"))
+    return vectordb, collection_name, active.get("generation", 0)
+
+def create_qa_chain(vectordb, index_version=""):
+    """
+    RetrievalQA chain over an index using Ollama with Llama 3.2.
+    `index_version` (the collection name) is kept on the retriever to key per-version caches.
+    """
+    # Initialize Ollama LLM with Llama 3.2
+    llm = Ollama(
+        model="llama3.2",
+        base_url=OLLAMA_BASE_URL,
+        temperature=0.7,
+        num_ctx=LLM_NUM_CTX  # Context window size
+    )
+
+    # Only as many chunks as fit the context window next to the prompt and the answer
+    retriever = PackedContextRetriever(
+        vectorstore=vectordb,
+        token_budget=context_token_budget(LLM_NUM_CTX, QA_PROMPT.template),
+        index_version=index_version
+    )
+
+    return RetrievalQA.from_chain_type(
+        llm=llm,
+        chain_type="stuff",
+        retriever=retriever,
+        chain_type_kwargs={"prompt": QA_PROMPT},
+        return_source_documents=False
+    )
+
+def prune_stale_collections(persist_directory, keep):
+    """
+    Drop collections whose dataset file is gone, plus interrupted builds, keeping
+    `keep` and every collection that still backs a file in the datasets directory.
+    """
+    keep = set(keep)
+    manifest_dir = Path(persist_directory) / MANIFEST_DIRNAME
+    for path in manifest_dir.glob("*.json") if manifest_dir.exists() else []:
+        manifest = load_manifest(persist_directory, path.stem)
+        if manifest is not None and (DATASETS_DIR / manifest.get("dataset", "")).is_file():
+            keep.add(path.stem)
+    prune_collections(persist_directory, keep)
+
+def setup_qa_chain(
+    force_reload=False, progress=None, cancel_event=None, dataset_path=None,
+    document_format=DOCUMENT_FORMAT, vector_store=VECTOR_STORE, publish=True
+):
+    """
+    Setup the QA chain for a dataset (the latest one by default) using Ollama with Llama 3.2.
+
+    Each dataset version is built into its own collection, so chains already being
+    served are untouched until the new one is complete. With `publish` the dataset
+    becomes the default one for questions that do not name a dataset; without it the
+    index is only built, for questions that name it.
+    `progress` and `cancel_event` are passed to sync_vector_index for background jobs;
+    `document_format` and `vector_store` to build_dataset_index.
     """
     try:
         logger.info("Starting QA chain setup")
-        
+
         # Check if Ollama is running
-        try:
-            response = requests.get("http://localhost:11434/api/tags")
-            if response.status_code != 200:
-                raise Exception("Ollama server is not running")
-        except Exception as e:
-            logger.error(f"Error connecting to Ollama server: {e}")
-            raise Exception("Please ensure Ollama server is running on port 11434")
-            
-        # Check datasets directory
-        datasets_dir = Path("datasets")
-        if not datasets_dir.exists():
-            logger.error("Datasets directory not found")
-            raise Exception("No datasets directory found")
-        
-        # Get latest dataset
-        csv_files = list(datasets_dir.glob("*.csv"))
-        if not csv_files:
-            logger.warning("No CSV files found in datasets directory. QA chain will not be initialized.")
-            return None
-        
-        latest_dataset = max(csv_files, key=lambda x: x.stat().st_mtime)
-        logger.info(f"Selected dataset: {latest_dataset}")
-        
-        # Database directory
-        persist_directory = "chroma_db"
-        delete_vector_db(persist_directory)  # Ensure a fresh DB
-        
-        # Initialize Ollama LLM with Llama 3.2
-        llm = Ollama(
-            model="llama3.2",
-            base_url="http://localhost:11434",
-            temperature=0.7,
-            num_ctx=4096  # Context window size
-        )
+        check_ollama()
 
-        # Load & split dataset
-        loader = CSVLoader(str(latest_dataset))
-        data = loader.load()
+        if dataset_path is None:
+            # Check datasets directory
+            if not DATASETS_DIR.exists():
+                logger.error("Datasets directory not found")
+                raise Exception("No datasets directory found")
 
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        text = text_splitter.split_documents(data)
+            # Get latest dataset
+            csv_files = list_dataset_files()
+            if not csv_files:
+                logger.warning("No CSV files found in datasets directory. QA chain will not be initialized.")
+                return None
+            dataset_path = csv_files[-1]
+        dataset_path = Path(dataset_path)
+        logger.info(f"Selected dataset: {dataset_path}")
 
-        # Create embeddings
-        embedding = HuggingFaceEmbeddings(
-            model_name="BAAI/bge-base-en",
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
-        )
+        # One writer at a time across all workers; a build of the same file that was
+        # waiting here finds the manifest current and skips straight to activation
+        with index_writer_lock(PERSIST_DIRECTORY, cancel_event, progress):
+            started = time.perf_counter()
+            with collect_stages() as stages:
+                vectordb, collection_name = build_dataset_index(
+                    dataset_path, force_reload=force_reload, progress=progress, cancel_event=cancel_event,
+                    document_format=document_format, vector_store=vector_store
+                )
+            logger.info(
+                f"Index for {dataset_path.name} ready in {time.perf_counter() - started:.1f}s",
+                extra={"fields": {"stages_ms": stages_ms(stages)}}
+            )
 
-        # Create new vector database
-        vectordb = Chroma.from_documents(
-            documents=text,
-            embedding=embedding, 
-            persist_directory=persist_directory
-        )
+            if publish:
+                # Publish the new default, keeping the one it replaces for queries still using it
+                previous = activate_collection(PERSIST_DIRECTORY, collection_name)
+                keep = {collection_name, previous}
+            else:
+                active = load_active_index(PERSIST_DIRECTORY) or {}
+                keep = {collection_name, active.get("collection"), active.get("previous")}
+            prune_stale_collections(PERSIST_DIRECTORY, keep=keep)
 
-        retriever = vectordb.as_retriever(search_type="similarity", search_kwargs={"k": 100})
+        qa_chain = create_qa_chain(vectordb, collection_name)
 
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=retriever,
-            return_source_documents=False
-        )
-        
         logger.info("QA chain setup completed successfully")
         return qa_chain
-        
+
+    except IndexingCancelled:
+        logger.info("QA chain setup cancelled")
+        raise
     except Exception as e:
         logger.error(f"Error in setup_qa_chain: {str(e)}", exc_info=True)
-        raise 
\ No newline at end of file
+        raise
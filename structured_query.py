@@ -0,0 +1,310 @@
+import os
+import re
+import json
+import functools
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import dataset_registry
+from logger import logger
+from metrics import stage
+
+# Questions matching this are tried as structured queries before falling back to RAG
+STRUCTURED_QUESTION_PATTERN = re.compile(
+    r"\b(average|avg|mean|median|sum|total|count|how many|number of|maximum|minimum|max|min|"
+    r"highest|lowest|largest|smallest|top \d+|per|for each|by each|group(?:ed)? by|"
+    r"standard deviation|std|distinct|unique|which rows|list all|show all|where)\b",
+    re.IGNORECASE
+)
+STRUCTURED_DEFAULT_LIMIT = 50
+STRUCTURED_MAX_LIMIT = int(os.getenv("STRUCTURED_MAX_LIMIT", "1000"))
+# Rows shown in the text answer; the full result is returned alongside it
+ANSWER_MAX_ROWS = 20
+
+AGG_FUNCS = {"count", "sum", "mean", "median", "min", "max", "std", "nunique"}
+NUMERIC_FUNCS = {"sum", "mean", "median", "std"}
+FILTER_OPS = {"==", "!=", ">", ">=", "<", "<=", "in", "not in", "contains"}
+ORDERING_OPS = {">", ">=", "<", "<="}
+
+class QuerySpecError(ValueError):
+    """Raised when an LLM-produced query spec does not validate against the dataset."""
+
+def looks_structured(question: str) -> bool:
+    """Cheap check for aggregation, filter and group-by questions."""
+    return bool(STRUCTURED_QUESTION_PATTERN.search(question))
+
+@functools.lru_cache(maxsize=32)
+def _registered(path: str, size: int, mtime_ns: int) -> Optional[Dict[str, Any]]:
+    return dataset_registry.register_csv(path)
+
+def dataset_record(dataset_path) -> Optional[Dict[str, Any]]:
+    """Registry record for a dataset file, without re-hashing it while it is unchanged."""
+    stat = os.stat(dataset_path)
+    return _registered(str(dataset_path), stat.st_size, stat.st_mtime_ns)
+
+def dataset_schema(dataset_path) -> Dict[str, str]:
+    """Column name -> broad kind ("number", "text" or "boolean") for a dataset."""
+    record = dataset_record(dataset_path)
+    if record is not None:
+        kinds = {}
+        for column in record["columns"]:
+            kind = column["type"]
+            if kind.startswith(("int", "uint", "float", "double")):
+                kinds[column["name"]] = "number"
+            elif kind == "bool":
+                kinds[column["name"]] = "boolean"
+            else:
+                kinds[column["name"]] = "text"
+        return kinds
+    sample = pd.read_csv(dataset_path, nrows=1000)
+    return {
+        str(col): "number" if pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+        else "boolean" if pd.api.types.is_bool_dtype(dtype) else "text"
+        for col, dtype in sample.dtypes.items()
+    }
+
+def build_spec_prompt(question: str, schema: Dict[str, str]) -> str:
+    columns = "\n".join(f"- {name} ({kind})" for name, kind in schema.items())
+    return f"""You translate questions about a table into a JSON query spec.
+
+Table columns:
+{columns}
+
+Return only a JSON object with these keys:
+- "kind": "aggregate" (statistics, counts, group-bys), "filter" (list matching rows) or "free_text" (anything else)
+- "filters": list of {{"column", "op", "value"}}; op is one of {sorted(FILTER_OPS)}; "in"/"not in" take a list
+- "group_by": list of column names
+- "aggregations": list of {{"column", "func"}}; func is one of {sorted(AGG_FUNCS)}; use column "*" with func "count" to count rows
+- "columns": columns to return for "filter" queries (empty for all)
+- "order_by": {{"column", "descending"}} or null; for aggregates the column may be "<func>_<column>"
+- "limit": maximum number of rows to return
+
+Example: "average marks per class for students older than 15" ->
+{{"kind": "aggregate", "filters": [{{"column": "age", "op": ">", "value": 15}}], "group_by": ["class"], "aggregations": [{{"column": "marks", "func": "mean"}}], "columns": [], "order_by": null, "limit": 50}}
+
+Question: {question}
+JSON:"""
+
+def parse_spec(text: str) -> Dict[str, Any]:
+    """Parse the model's JSON, tolerating text around the object."""
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match is None:
+        raise QuerySpecError("No JSON object in the query spec")
+    try:
+        spec = json.loads(match.group(0))
+    except ValueError as e:
+        raise QuerySpecError(f"Query spec is not valid JSON: {e}")
+    if not isinstance(spec, dict):
+        raise QuerySpecError("Query spec must be a JSON object")
+    return spec
+
+def _aggregate_name(func: str, column: str) -> str:
+    return "count" if column == "*" else f"{func}_{column}"
+
+def validate_spec(spec: Dict[str, Any], schema: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Check an LLM-produced spec against the whitelist of operations and the dataset's
+    columns, returning a normalized copy. Raises QuerySpecError on anything else.
+    """
+    kind = spec.get("kind")
+    if kind not in ("aggregate", "filter", "free_text"):
+        raise QuerySpecError(f"Unknown query kind: {kind}")
+
+    def check_column(name, numeric=False):
+        if not isinstance(name, str) or name not in schema:
+            raise QuerySpecError(f"Unknown column: {name}")
+        if numeric and schema[name] != "number":
+            raise QuerySpecError(f"Column {name} is not numeric")
+        return name
+
+    def check_list(key):
+        value = spec.get(key) or []
+        if not isinstance(value, list):
+            raise QuerySpecError(f"{key} must be a list, got {value!r}")
+        return value
+
+    filters = []
+    for f in check_list("filters"):
+        if not isinstance(f, dict) or f.get("op") not in FILTER_OPS:
+            raise QuerySpecError(f"Invalid filter: {f}")
+        column = check_column(f.get("column"), numeric=f["op"] in ORDERING_OPS)
+        value = f.get("value")
+        if f["op"] in ("in", "not in") and not isinstance(value, list):
+            value = [value]
+        filters.append({"column": column, "op": f["op"], "value": value})
+
+    group_by = [check_column(name) for name in check_list("group_by")]
+
+    aggregations = []
+    for agg in check_list("aggregations"):
+        if not isinstance(agg, dict) or agg.get("func") not in AGG_FUNCS:
+            raise QuerySpecError(f"Invalid aggregation: {agg}")
+        column = agg.get("column")
+        if column == "*":
+            if agg["func"] != "count":
+                raise QuerySpecError("Only count can be applied to all rows")
+        else:
+            check_column(column, numeric=agg["func"] in NUMERIC_FUNCS)
+        aggregations.append({"column": column, "func": agg["func"]})
+    if kind == "aggregate" and not aggregations:
+        aggregations = [{"column": "*", "func": "count"}]
+
+    columns = [check_column(name) for name in check_list("columns")]
+
+    order_by = spec.get("order_by")
+    if order_by:
+        if not isinstance(order_by, dict):
+            raise QuerySpecError(f"Invalid order_by: {order_by}")
+        allowed = set(group_by) | {_aggregate_name(a["func"], a["column"]) for a in aggregations}
+        if kind == "filter":
+            allowed |= set(schema)
+        if not isinstance(order_by.get("column"), str) or order_by["column"] not in allowed:
+            raise QuerySpecError(f"Cannot order by {order_by.get('column')}")
+        order_by = {"column": order_by["column"], "descending": bool(order_by.get("descending"))}
+
+    limit = spec.get("limit") or STRUCTURED_DEFAULT_LIMIT
+    # bool is an int subclass, but `"limit": true` is not a row count
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+        raise QuerySpecError(f"Invalid limit: {limit}")
+
+    return {
+        "kind": kind,
+        "filters": filters,
+        "group_by": group_by,
+        "aggregations": aggregations if kind == "aggregate" else [],
+        "columns": columns,
+        "order_by": order_by,
+        "limit": min(limit, STRUCTURED_MAX_LIMIT)
+    }
+
+def referenced_columns(spec: Dict[str, Any], schema: Dict[str, str]) -> List[str]:
+    """Columns a spec touches, so only those are loaded."""
+    if spec["kind"] == "filter" and not spec["columns"]:
+        return list(schema)
+    names = [f["column"] for f in spec["filters"]] + spec["group_by"] + spec["columns"]
+    names += [a["column"] for a in spec["aggregations"] if a["column"] != "*"]
+    if spec["order_by"] and spec["order_by"]["column"] in schema:
+        names.append(spec["order_by"]["column"])
+    return list(dict.fromkeys(names))
+
+def load_columns(dataset_path, columns: List[str]) -> pd.DataFrame:
+    """Load only `columns`, from the memory-mapped columnar copy when there is one."""
+    record = dataset_record(dataset_path)
+    if record is not None:
+        return dataset_registry.load_frame(record, columns)
+    return pd.read_csv(dataset_path, usecols=columns)
+
+def _filter_mask(series: pd.Series, op: str, value: Any) -> np.ndarray:
+    if op == "contains":
+        return series.astype(str).str.contains(str(value), case=False, regex=False, na=False).to_numpy()
+    if op in ("in", "not in"):
+        values = value
+        if pd.api.types.is_numeric_dtype(series.dtype):
+            values = pd.to_numeric(pd.Series(values), errors="coerce").dropna().tolist()
+        mask = series.isin(values).to_numpy()
+        return ~mask if op == "not in" else mask
+    if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise QuerySpecError(f"{series.name} is numeric, got {value!r}")
+    compare = {
+        "==": series.eq, "!=": series.ne, ">": series.gt,
+        ">=": series.ge, "<": series.lt, "<=": series.le
+    }[op]
+    return compare(value).fillna(False).to_numpy(dtype=bool)
+
+def execute_spec(spec: Dict[str, Any], df: pd.DataFrame) -> pd.DataFrame:
+    """Run a validated spec as vectorized pandas operations."""
+    if spec["filters"]:
+        mask = np.ones(len(df), dtype=bool)
+        for f in spec["filters"]:
+            mask &= _filter_mask(df[f["column"]], f["op"], f["value"])
+        df = df[mask]
+
+    if spec["kind"] == "aggregate":
+        named = {}
+        for agg in spec["aggregations"]:
+            name = _aggregate_name(agg["func"], agg["column"])
+            if agg["column"] == "*":
+                named[name] = (spec["group_by"][0], "size") if spec["group_by"] else None
+            else:
+                named[name] = (agg["column"], agg["func"])
+        if spec["group_by"]:
+            result = df.groupby(spec["group_by"], observed=True, sort=True).agg(**named).reset_index()
+        else:
+            result = pd.DataFrame([{
+                name: len(df) if how is None else df[how[0]].agg(how[1])
+                for name, how in named.items()
+            }])
+    else:
+        result = df
+
+    if spec["order_by"]:
+        result = result.sort_values(spec["order_by"]["column"], ascending=not spec["order_by"]["descending"])
+    if spec["kind"] == "filter" and spec["columns"]:
+        result = result[spec["columns"]]
+    return result.head(spec["limit"])
+
+def format_answer(result: pd.DataFrame) -> str:
+    """Plain-text rendering of a query result."""
+    if result.empty:
+        return "No rows match the question."
+    if result.shape == (1, 1):
+        value = result.iat[0, 0]
+        if isinstance(value, (float, np.floating)):
+            value = f"{value:.6g}"
+        return f"{result.columns[0]}: {value}"
+    text = result.head(ANSWER_MAX_ROWS).to_string(index=False)
+    if len(result) > ANSWER_MAX_ROWS:
+        text += f"\n... {len(result) - ANSWER_MAX_ROWS} more rows"
+    return text
+
+def run_structured_query(spec: Dict[str, Any], dataset_path) -> Dict[str, Any]:
+    """
+    Validate and execute a raw spec against a dataset. Returns None for free-text
+    questions; raises QuerySpecError if the spec is not valid for this dataset.
+    """
+    schema = dataset_schema(dataset_path)
+    spec = validate_spec(spec, schema)
+    if spec["kind"] == "free_text":
+        return None
+    with stage("structured_load"):
+        df = load_columns(dataset_path, referenced_columns(spec, schema))
+    with stage("structured_execute"):
+        result = execute_spec(spec, df)
+    logger.info(f"Structured query over {len(df)} rows of {Path(dataset_path).name} returned {len(result)} rows")
+    return {
+        "answer": format_answer(result),
+        "query": spec,
+        "result": json.loads(result.to_json(orient="records", date_format="iso"))
+    }
+
+async def answer_structured(question: str, dataset_path) -> Optional[Dict[str, Any]]:
+    """
+    Have the LLM translate the question into a query spec and execute it exactly.
+    Returns None when the question is free text or the spec is unusable, so callers
+    fall back to retrieval.
+    """
+    from ollama_client import ollama_client, run_blocking, OllamaError, INTERACTIVE
+
+    try:
+        schema = await run_blocking(dataset_schema, dataset_path)
+        text = await ollama_client.generate(
+            build_spec_prompt(question, schema), format="json", priority=INTERACTIVE, temperature=0
+        )
+    except OllamaError as e:
+        # OllamaBusy is not an OllamaError: a full queue still becomes a 429
+        logger.warning(f"Could not generate a query spec, falling back to retrieval: {e}")
+        return None
+    try:
+        return await run_blocking(run_structured_query, parse_spec(text), dataset_path)
+    except QuerySpecError as e:
+        logger.info(f"Structured query not usable, falling back to retrieval: {e}")
+        return None
+    except (TypeError, ValueError, KeyError) as e:
+        # A spec that validated but still does not fit the data (e.g. mixed-type columns)
+        logger.warning(f"Structured query failed, falling back to retrieval: {e}")
+        return None
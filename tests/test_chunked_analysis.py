@@ -0,0 +1,115 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from app.chunked_analysis import ColumnAggregate, DistinctSketch, QuantileSketch, analyze_csv_chunked, profile_chunks
+
+def _chunks(df, rows):
+    return [df.iloc[start:start + rows] for start in range(0, len(df), rows)]
+
+def test_distinct_sketch_is_exact_below_k():
+    sketch = DistinctSketch(k=64)
+    sketch.update(np.array([1, 2, 2, 3, 3, 3]))
+    sketch.update(np.array([3, 4]))
+    assert not sketch.saturated
+    assert sketch.estimate() == 4
+
+def test_distinct_sketch_estimate_is_close_once_saturated():
+    rng = np.random.default_rng(0)
+    values = rng.integers(0, 2 ** 40, size=200_000)
+    sketch = DistinctSketch(k=4096)
+    sketch.update(values)
+    assert sketch.saturated
+    exact = len(np.unique(values))
+    # Standard error of a KMV estimate is about 1 / sqrt(k), i.e. 1.6% here
+    assert sketch.estimate() == pytest.approx(exact, rel=0.05)
+
+def test_distinct_sketch_merge_equals_sketch_of_the_union():
+    rng = np.random.default_rng(1)
+    left, right = rng.integers(0, 50_000, size=40_000), rng.integers(25_000, 75_000, size=40_000)
+    merged, other, whole = DistinctSketch(k=1024), DistinctSketch(k=1024), DistinctSketch(k=1024)
+    merged.update(left)
+    other.update(right)
+    merged.merge(other)
+    whole.update(np.concatenate([left, right]))
+    np.testing.assert_array_equal(merged.hashes, whole.hashes)
+    assert merged.estimate() == whole.estimate()
+
+def _rank_error(sketch, data, qs):
+    ordered = np.sort(data)
+    estimates = sketch.quantiles(qs)
+    ranks = np.searchsorted(ordered, estimates, side="right") / len(ordered)
+    return np.max(np.abs(ranks - np.asarray(qs)))
+
+def test_quantile_sketch_keeps_total_weight_and_is_accurate():
+    rng = np.random.default_rng(2)
+    data = rng.lognormal(size=300_000)
+    sketch = QuantileSketch(k=1024)
+    for chunk in np.array_split(data, 37):
+        sketch.update(chunk)
+    _, weights = sketch.weighted_items()
+    assert weights.sum() == len(data)
+    assert sum(len(items) for items in sketch.levels) < len(data) / 10
+    assert _rank_error(sketch, data, [0.01, 0.25, 0.5, 0.75, 0.99]) < 0.01
+
+def test_merged_quantile_sketches_match_the_whole_stream():
+    rng = np.random.default_rng(3)
+    parts = [rng.normal(loc, size=50_000) for loc in (0, 5, 10)]
+    merged = QuantileSketch(k=1024, seed=1)
+    for i, part in enumerate(parts):
+        sketch = QuantileSketch(k=1024, seed=i + 2)
+        sketch.update(part)
+        merged.merge(sketch)
+    data = np.concatenate(parts)
+    _, weights = merged.weighted_items()
+    assert weights.sum() == len(data)
+    assert _rank_error(merged, data, [0.1, 0.5, 0.9]) < 0.01
+
+def test_empty_quantile_sketch_returns_nan():
+    assert np.isnan(QuantileSketch().quantiles([0.5])).all()
+
+def test_merged_moments_match_numpy():
+    rng = np.random.default_rng(4)
+    data = rng.normal(3, 2, size=10_000)
+    agg = ColumnAggregate()
+    for chunk in np.array_split(data, 7):
+        agg.merge_moments(len(chunk), chunk.mean(), ((chunk - chunk.mean()) ** 2).sum(), chunk.min(), chunk.max())
+    assert agg.count == len(data)
+    assert agg.mean == pytest.approx(data.mean())
+    assert agg.m2 / (agg.count - 1) == pytest.approx(data.var(ddof=1))
+    assert (agg.min, agg.max) == (data.min(), data.max())
+
+def test_chunked_profile_matches_a_single_chunk():
+    rng = np.random.default_rng(5)
+    df = pd.DataFrame({
+        "x": rng.normal(size=5000),
+        "n": rng.integers(0, 100, size=5000),
+        "label": rng.choice(["a", "b", "c"], size=5000, p=[0.6, 0.3, 0.1])
+    })
+    df.loc[::11, "x"] = np.nan
+    chunked, _ = profile_chunks(_chunks(df, 700))
+    whole, _ = profile_chunks([df])
+    for column in ("x", "n"):
+        for stat in ("null_count", "distinct_count", "min", "max"):
+            assert chunked["columns"][column][stat] == whole["columns"][column][stat]
+        for stat in ("mean", "std"):
+            assert chunked["columns"][column][stat] == pytest.approx(whole["columns"][column][stat])
+    assert chunked["columns"]["label"]["top_values"] == whole["columns"]["label"]["top_values"]
+    assert chunked["n_rows"] == len(df)
+
+def test_infinite_values_are_counted_and_left_out(tmp_path):
+    path = tmp_path / "data.csv"
+    path.write_text("x,y\n1,-1e308\ninf,1e308\n3,0\n")
+    analysis = analyze_csv_chunked(str(path))
+    # /api/analyze responds with JSON, which has no NaN or infinity
+    json.dumps(analysis, allow_nan=False)
+    profile, _ = profile_chunks(_chunks(pd.read_csv(path), 2))
+    x = profile["columns"]["x"]
+    assert x["infinite_count"] == 1
+    assert (x["min"], x["max"], x["mean"]) == (1.0, 3.0, 2.0)
+    assert x["histogram"]["counts"][0] == 1 and sum(x["histogram"]["counts"]) == 2
+    y = profile["columns"]["y"]
+    assert y["histogram"]["bin_edges"][0] == -1e308 and y["histogram"]["bin_edges"][-1] == 1e308
+    assert sum(y["histogram"]["counts"]) == 3
@@ -0,0 +1,41 @@
+import pytest
+
+import dataset_registry
+import ollama_utils
+
+CSV = (
+    "id, zip ,price,ratio,note,when\n"
+    "1,02134,2.0,1e3,plain,2024-01-05\n"
+    "2,00501,3.50, -0.0 ,\"quoted, with comma\",\n"
+    "3,,,NA,  padded  ,2024-02-29\n"
+)
+
+@pytest.fixture
+def dataset(tmp_path, monkeypatch):
+    monkeypatch.setattr(dataset_registry, "REGISTRY_DIR", tmp_path / "registry")
+    path = tmp_path / "data.csv"
+    path.write_text(CSV)
+    record = dataset_registry.register_csv(path)
+    assert record is not None
+    return path, record
+
+def _rows(batches):
+    return [(doc.page_content, doc.metadata) for batch in batches for doc in batch]
+
+def test_registered_rows_render_the_csv_text(dataset):
+    path, record = dataset
+    rows = _rows(ollama_utils.iter_record_batches(record, path, batch_rows=2))
+    assert rows == _rows(ollama_utils.iter_csv_batches(path, batch_rows=2))
+    # Cells are the source text, not the stored numbers
+    assert rows[0][0] == "id: 1\nzip: 02134\nprice: 2.0\nratio: 1e3\nnote: plain\nwhen: 2024-01-05"
+    assert rows[2][0] == "id: 3\nzip: \nprice: \nratio: NA\nnote: padded\nwhen: 2024-02-29"
+
+def test_registered_values_keep_fixed_batch_offsets(dataset):
+    path, record = dataset
+    batches = list(ollama_utils.iter_record_values(record, path, batch_rows=2))
+    assert [(first_row, len(rows)) for _, rows, first_row in batches] == [(0, 2), (2, 1)]
+    assert batches == list(ollama_utils.iter_csv_values(path, batch_rows=2))
+
+def test_registered_blocks_match_the_csv_blocks(dataset):
+    path, record = dataset
+    assert _rows(ollama_utils.iter_block_batches(path, 2, record)) == _rows(ollama_utils.iter_block_batches(path, 2))
@@ -0,0 +1,29 @@
+from embedding_service import EmbeddingCache
+
+VECTOR_BYTES = 8 * 4
+
+def _vectors(prefix, n):
+    return {f"{prefix}{i}": [float(i)] * 8 for i in range(n)}
+
+def _stored(cache):
+    return cache._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+def test_running_size_matches_the_table(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite3"), max_bytes=10 * VECTOR_BYTES)
+    cache.put_many(_vectors("a", 5))
+    # Replacing an entry must not count it twice
+    cache.put_many(_vectors("a", 2) | _vectors("b", 1))
+    assert cache.size_bytes() == _stored(cache) == 6 * VECTOR_BYTES
+    assert cache.get_many(["a1", "b0", "missing"]) == {"a1": [1.0] * 8, "b0": [0.0] * 8}
+
+def test_eviction_trims_below_the_budget_and_reopen_resumes_the_total(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    cache = EmbeddingCache(path, max_bytes=10 * VECTOR_BYTES)
+    cache.put_many(_vectors("a", 8))
+    cache.put_many(_vectors("b", 8))
+    assert cache.evictions > 0
+    assert cache.size_bytes() == _stored(cache) <= 9 * VECTOR_BYTES
+    # Least recently used go first
+    assert cache.get_many(["a0"]) == {}
+    assert len(cache.get_many(list(_vectors("b", 8)))) == 8
+    assert EmbeddingCache(path, max_bytes=10 * VECTOR_BYTES).size_bytes() == cache.size_bytes()
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from llm_scheduler import AdmissionScheduler, OllamaBusy, INTERACTIVE, DEFAULT, BULK
+
+async def _settle():
+    # Let woken waiters run their continuation
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_admits_up_to_max_concurrency_without_queueing():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=2, max_queue=4)
+        await scheduler.acquire()
+        await scheduler.acquire()
+        assert scheduler.stats()["active"] == 2
+        assert scheduler.stats()["queued"] == 0
+        scheduler.release()
+        scheduler.release()
+        assert scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+def test_waiters_are_admitted_by_priority_then_arrival():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1, max_queue=8)
+        await scheduler.acquire()
+        admitted = []
+
+        async def waiter(name, priority):
+            await scheduler.acquire(priority)
+            admitted.append(name)
+
+        tasks = [
+            asyncio.create_task(waiter(name, priority))
+            for name, priority in [("bulk", BULK), ("default-1", DEFAULT), ("interactive", INTERACTIVE), ("default-2", DEFAULT)]
+        ]
+        await _settle()
+        assert scheduler.stats()["queued"] == 4
+        for _ in tasks:
+            scheduler.release()
+            await _settle()
+        await asyncio.gather(*tasks)
+        assert admitted == ["interactive", "default-1", "default-2", "bulk"]
+        assert scheduler.stats()["active"] == 1
+        assert scheduler.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+def test_full_queue_raises_busy_with_retry_after():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1, max_queue=1, expected_seconds=4)
+        await scheduler.acquire()
+        queued = asyncio.create_task(scheduler.acquire())
+        await _settle()
+        with pytest.raises(OllamaBusy) as busy:
+            await scheduler.acquire()
+        # One request ahead in the queue plus the running one
+        assert busy.value.retry_after == 8
+        queued.cancel()
+        await _settle()
+
+    asyncio.run(scenario())
+
+def test_cancelled_waiter_is_skipped_and_frees_its_queue_place():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1, max_queue=1)
+        await scheduler.acquire()
+        cancelled = asyncio.create_task(scheduler.acquire(INTERACTIVE))
+        await _settle()
+        cancelled.cancel()
+        await _settle()
+        assert scheduler.stats()["queued"] == 0
+
+        # The queue place is free again, and the stale heap entry must not take the slot
+        waiter = asyncio.create_task(scheduler.acquire(BULK))
+        await _settle()
+        scheduler.release()
+        await asyncio.wait_for(waiter, 1)
+        assert scheduler.stats()["active"] == 1
+        assert scheduler.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+def test_slot_handed_to_a_cancelled_waiter_passes_to_the_next():
+    async def scenario():
+        scheduler = AdmissionScheduler(max_concurrency=1, max_queue=4)
+        await scheduler.acquire()
+        first = asyncio.create_task(scheduler.acquire())
+        second = asyncio.create_task(scheduler.acquire())
+        await _settle()
+        # Hand the slot to `first`, then cancel it before it gets to run
+        scheduler.release()
+        first.cancel()
+        await _settle()
+        assert first.cancelled()
+        await asyncio.wait_for(second, 1)
+        assert scheduler.stats()["active"] == 1
+        assert scheduler.stats()["queued"] == 0
+
+    asyncio.run(scenario())
+
+def test_release_updates_the_expected_generation_time():
+    scheduler = AdmissionScheduler(max_concurrency=1, max_queue=4, expected_seconds=10)
+    scheduler.active = 1
+    scheduler.release(20)
+    assert scheduler.stats()["expected_seconds"] == pytest.approx(12)
+    assert scheduler.retry_after() == 12
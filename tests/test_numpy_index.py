@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from langchain.vectorstores.utils import maximal_marginal_relevance
+
+from numpy_index import NumpyVectorStore, _mmr
+
+class TopicEmbeddings:
+    """One axis per known word, so "a b" is most similar to documents made of a and b."""
+
+    WORDS = ["apple", "banana", "cherry", "date", "elder", "fig", "grape", "honey"]
+
+    def _embed(self, text):
+        vector = np.zeros(len(self.WORDS), dtype=np.float32)
+        for word in text.split():
+            vector[self.WORDS.index(word)] += 1
+        return vector.tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+@pytest.fixture(params=["float16", "int8"])
+def store(request, tmp_path):
+    return NumpyVectorStore(tmp_path / "collection", TopicEmbeddings(), dtype=request.param)
+
+def _texts(docs):
+    return [doc.page_content for doc in docs]
+
+def test_empty_store_returns_no_documents(store):
+    assert store.similarity_search("apple") == []
+    assert store.max_marginal_relevance_search("apple") == []
+    assert store.get() == {"ids": []}
+
+def test_search_ranks_by_cosine_similarity_and_keeps_metadata(store):
+    store.add_texts(["apple", "banana", "apple banana", "cherry"], [{"row": i} for i in range(4)])
+    results = store.similarity_search_with_score("apple", k=2)
+    assert [doc.page_content for doc, _ in results] == ["apple", "apple banana"]
+    assert results[0][0].metadata == {"row": 0}
+    assert results[0][1] == pytest.approx(1.0, abs=1e-2)
+    assert results[1][1] == pytest.approx(2 ** -0.5, abs=1e-2)
+
+def test_reopened_store_serves_the_same_results(store, tmp_path):
+    store.add_texts(["apple", "banana"], ids=["a", "b"])
+    store.add_texts(["cherry"], ids=["c"])
+    reopened = NumpyVectorStore(tmp_path / "collection", TopicEmbeddings())
+    assert reopened.n_rows == 3
+    assert _texts(reopened.similarity_search("cherry", k=1)) == ["cherry"]
+    assert sorted(reopened.get()["ids"]) == ["a", "b", "c"]
+
+def test_deleted_documents_are_never_returned(store, tmp_path):
+    store.add_texts(["apple", "apple banana", "banana"], ids=["a", "ab", "b"])
+    store.delete(["a"])
+    assert _texts(store.similarity_search("apple", k=3)) == ["apple banana", "banana"]
+    reopened = NumpyVectorStore(tmp_path / "collection", TopicEmbeddings())
+    assert sorted(reopened.get()["ids"]) == ["ab", "b"]
+
+def test_interrupted_write_is_dropped_on_the_next_add(store, tmp_path):
+    store.add_texts(["apple", "banana"])
+    directory = tmp_path / "collection"
+    # A crash mid-append: half a vector row and a partial document line
+    with open(directory / "vectors.bin", "ab") as f:
+        f.write(b"\x01\x02\x03")
+    with open(directory / "docs.jsonl", "ab") as f:
+        f.write(b'{"id": "torn", "te')
+    reopened = NumpyVectorStore(directory, TopicEmbeddings())
+    assert reopened.n_rows == 2
+    reopened.add_texts(["cherry"])
+    assert reopened.n_rows == 3
+    assert _texts(reopened.similarity_search("cherry", k=1)) == ["cherry"]
+    assert _texts(reopened.similarity_search("banana", k=1)) == ["banana"]
+
+def test_partitioned_search_finds_old_and_new_rows(tmp_path):
+    rng = np.random.default_rng(0)
+    words = TopicEmbeddings.WORDS
+    texts = [" ".join(rng.choice(words, size=3)) for _ in range(400)]
+    store = NumpyVectorStore(tmp_path / "collection", TopicEmbeddings())
+    store.add_texts(texts)
+    store.build_partitions(min_rows=100, n_partitions=8)
+    assert store._centroids is not None
+    store.add_texts(["honey honey honey"])
+
+    query = store.embeddings.embed_query("honey")
+    exact_rows, exact_scores = store._search(query, 5, nprobe=8)
+    probed_rows, probed_scores = store._search(query, 5, nprobe=2)
+    assert store.n_rows - 1 in exact_rows
+    assert store.n_rows - 1 in probed_rows  # rows added after partitioning are always scanned
+    assert probed_scores[0] == pytest.approx(exact_scores[0])
+
+def test_mmr_picks_the_same_documents_as_langchain():
+    rng = np.random.default_rng(1)
+    candidates = rng.normal(size=(40, 16)).astype(np.float32)
+    candidates /= np.linalg.norm(candidates, axis=1, keepdims=True)
+    query = candidates[:5].mean(axis=0)
+    query /= np.linalg.norm(query)
+    for lambda_mult in (0.2, 0.5, 0.9):
+        expected = maximal_marginal_relevance(query, list(candidates), lambda_mult=lambda_mult, k=8)
+        assert _mmr(query, candidates, 8, lambda_mult) == expected
@@ -0,0 +1,187 @@
+import gc
+import asyncio
+
+import pytest
+
+from llm_scheduler import AdmissionScheduler, OllamaBusy
+from ollama_client import OllamaClient, OllamaError
+
+async def _settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+class FakeOllama(OllamaClient):
+    """OllamaClient with _request and _stream answered in-process and gated by the test."""
+
+    def __init__(self, max_concurrency=1, max_queue=4):
+        super().__init__(scheduler=AdmissionScheduler(max_concurrency=max_concurrency, max_queue=max_queue))
+        self.requests = []
+        self.streams = []
+        self.gate = asyncio.Event()
+        self.tokens: asyncio.Queue = asyncio.Queue()
+        self.stream_cancelled = False
+
+    async def _request(self, method, path, **kwargs):
+        self.requests.append(kwargs["json"])
+        await self.gate.wait()
+        return {"response": f"answer to {kwargs['json']['prompt']}"}
+
+    async def _stream(self, payload):
+        self.streams.append(payload)
+        try:
+            while True:
+                token = await self.tokens.get()
+                if token is None:
+                    return
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        except asyncio.CancelledError:
+            self.stream_cancelled = True
+            raise
+
+async def _collect(tokens):
+    return [token async for token in tokens]
+
+def test_identical_generations_share_one_request():
+    async def scenario():
+        client = FakeOllama()
+        callers = [asyncio.create_task(client.generate("q")) for _ in range(3)]
+        other = asyncio.create_task(client.generate("other"))
+        await _settle()
+        client.gate.set()
+        results = await asyncio.gather(*callers)
+        assert results == ["answer to q"] * 3
+        assert await other == "answer to other"
+        assert [r["prompt"] for r in client.requests] == ["q", "other"]
+        assert client._flights == {}
+        assert client.scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+def test_one_caller_leaving_does_not_cancel_the_shared_generation():
+    async def scenario():
+        client = FakeOllama()
+        leaving = asyncio.create_task(client.generate("q"))
+        staying = asyncio.create_task(client.generate("q"))
+        await _settle()
+        leaving.cancel()
+        await _settle()
+        client.gate.set()
+        assert await staying == "answer to q"
+        assert leaving.cancelled()
+        assert len(client.requests) == 1
+
+    asyncio.run(scenario())
+
+def test_last_caller_leaving_cancels_the_generation_and_frees_the_slot():
+    async def scenario():
+        client = FakeOllama()
+        callers = [asyncio.create_task(client.generate("q")) for _ in range(2)]
+        await _settle()
+        assert client.scheduler.stats()["active"] == 1
+        for caller in callers:
+            caller.cancel()
+        await _settle()
+        assert client._flights == {}
+        assert client.scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+def test_queued_caller_leaving_frees_its_queue_place():
+    async def scenario():
+        client = FakeOllama(max_concurrency=1, max_queue=1)
+        running = asyncio.create_task(client.generate("first"))
+        queued = asyncio.create_task(client.generate("second"))
+        await _settle()
+        assert client.scheduler.stats()["queued"] == 1
+        queued.cancel()
+        await _settle()
+        assert client.scheduler.stats()["queued"] == 0
+        client.gate.set()
+        assert await running == "answer to first"
+        assert [r["prompt"] for r in client.requests] == ["first"]
+
+    asyncio.run(scenario())
+
+def test_full_queue_raises_busy_before_the_stream_starts():
+    async def scenario():
+        client = FakeOllama(max_concurrency=1, max_queue=0)
+        running = asyncio.create_task(client.generate("first"))
+        await _settle()
+        with pytest.raises(OllamaBusy):
+            await client.open_stream("second")
+        assert client.streams == []
+        client.gate.set()
+        await running
+
+    asyncio.run(scenario())
+
+def test_late_stream_subscriber_gets_earlier_tokens_replayed():
+    async def scenario():
+        client = FakeOllama()
+        first = await client.open_stream("q")
+        first_tokens = []
+        await client.tokens.put("a")
+        await client.tokens.put("b")
+        first_tokens.append(await first.__anext__())
+        first_tokens.append(await first.__anext__())
+
+        second = await client.open_stream("q")
+        await client.tokens.put("c")
+        await client.tokens.put(None)
+        first_tokens += await _collect(first)
+        assert first_tokens == ["a", "b", "c"]
+        assert await _collect(second) == ["a", "b", "c"]
+        assert len(client.streams) == 1
+        assert client.scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+def test_stream_error_reaches_every_subscriber_and_frees_the_slot():
+    async def scenario():
+        client = FakeOllama()
+        first = await client.open_stream("q")
+        second = await client.open_stream("q")
+        await client.tokens.put("a")
+        await client.tokens.put(OllamaError("model crashed"))
+        for tokens in (first, second):
+            with pytest.raises(OllamaError, match="model crashed"):
+                await _collect(tokens)
+        assert client.scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+def test_last_stream_subscriber_leaving_cancels_the_generation():
+    async def scenario():
+        client = FakeOllama()
+        first = await client.open_stream("q")
+        second = await client.open_stream("q")
+        await client.tokens.put("a")
+        assert await first.__anext__() == "a"
+        await first.aclose()
+        await _settle()
+        assert not client.stream_cancelled
+        await second.aclose()
+        await _settle()
+        assert client.stream_cancelled
+        assert client._flights == {}
+        assert client.scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+def test_stream_subscriber_dropped_before_iterating_leaves_the_flight():
+    async def scenario():
+        client = FakeOllama()
+        tokens = await client.open_stream("q")
+        await _settle()
+        assert len(client.streams) == 1
+        # E.g. the response was abandoned before its body was ever read
+        del tokens
+        gc.collect()
+        await _settle()
+        assert client.stream_cancelled
+        assert client._flights == {}
+        assert client.scheduler.stats()["active"] == 0
+
+    asyncio.run(scenario())
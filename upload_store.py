@@ -0,0 +1,80 @@
+import os
+import re
+import uuid
+import hashlib
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import aiofiles
+from fastapi import UploadFile
+import dataset_registry
+from logger import logger
+from metrics import Counter, stage
+
+# Bytes read from the request and written to disk per step; memory use does not grow with the upload
+UPLOAD_CHUNK_BYTES = int(os.getenv("UPLOAD_CHUNK_BYTES", str(1 << 20)))
+
+UPLOADS = Counter("uploads_total", "Uploaded files, by whether the content was already stored.", ["duplicate"])
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes received in uploads.")
+
+class StoredUpload(NamedTuple):
+    path: Path
+    sha256: str
+    size_bytes: int
+    # The same bytes were already stored; nothing new was written
+    duplicate: bool
+
+def safe_filename(filename: Optional[str], default: str = "dataset.csv") -> str:
+    """The client's file name reduced to a plain name without path parts or odd characters."""
+    name = re.sub(r"[^A-Za-z0-9._-]", "_", Path(filename or "").name).lstrip(".")
+    return name or default
+
+def _existing(directory: Path, sha256: str, keep_name: bool) -> Optional[Path]:
+    if not keep_name:
+        path = directory / f"{sha256}.csv"
+        return path if path.is_file() else None
+    return next(directory.glob(f"{sha256[:16]}_*"), None)
+
+async def store_upload(file: UploadFile, directory, keep_name: bool = False) -> StoredUpload:
+    """
+    Stream an upload to `directory` in fixed-size chunks, hashing it on the way, and
+    store it under its content hash: `<sha256>.csv`, or `<sha256[:16]>_<name>` with
+    `keep_name` so the client's file name stays readable.
+
+    Chunks go to a private temporary file that is renamed into place at the end, so
+    concurrent uploads never see each other's partial files. If the content is already
+    stored, the temporary file is dropped and the existing path returned.
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    tmp_path = directory / f".upload-{uuid.uuid4().hex}.part"
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with stage("save_upload"):
+            async with aiofiles.open(tmp_path, "wb") as out:
+                while True:
+                    chunk = await file.read(UPLOAD_CHUNK_BYTES)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await out.write(chunk)
+        sha256 = digest.hexdigest()
+        UPLOAD_BYTES.inc(size)
+
+        existing = _existing(directory, sha256, keep_name)
+        if existing is not None:
+            UPLOADS.inc(duplicate="true")
+            logger.info(f"Upload of {file.filename} is a duplicate of {existing.name}")
+            return StoredUpload(existing, sha256, size, True)
+
+        path = directory / (f"{sha256[:16]}_{safe_filename(file.filename)}" if keep_name else f"{sha256}.csv")
+        os.replace(tmp_path, path)
+        # Later readers of this file can skip re-hashing it
+        dataset_registry.remember_sha256(path, sha256)
+        UPLOADS.inc(duplicate="false")
+        return StoredUpload(path, sha256, size, False)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()